@@ -0,0 +1,276 @@
+"""
+Offline micro-benchmarks for the bot's hot helpers.
+
+Runs against a temporary SQLite database and fake Discord objects, so no token or network access is needed:
+
+    uv run python bench/bench.py -o bench-$(git rev-parse --short HEAD).json
+    uv run python bench/bench.py --compare bench-abc1234.json
+
+Each benchmark is timed for several rounds and the fastest round is reported, in microseconds per call.
+"""
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import discord
+from sqlalchemy import select
+
+import util.ctf
+import util.db
+from util.cache import challenge_index, get_all_challs_from_ctx, get_unsolved_challs_from_ctx, render_cache
+from util.chall import get_challenge_paginator
+from util.db import Challenge, Ctf, User, get_session
+
+SIZES = (10, 100, 1000)
+CATEGORIES = ("crypto", "forensics", "misc", "pwn", "rev", "web")
+
+# trimmed copy of a real /api/v1/events/<id>/ response
+CTFTIME_EVENT = {
+    "id": 2345,
+    "title": "Example CTF 2025",
+    "description": (
+        "Example CTF is a jeopardy style CTF with challenges in web, pwn, crypto, reversing and forensics. "
+        "Join our Discord at https://discord.gg/exampleCTF for announcements and support. " * 12
+    ),
+    "url": "https://example-ctf.org",
+    "logo": "https://ctftime.org/media/events/example.png",
+    "start": "2025-05-17T08:00:00+00:00",
+    "finish": "2025-05-19T08:00:00+00:00",
+    "format": "Jeopardy",
+    "weight": 24.5,
+    "participants": 812,
+}
+
+
+# --- fake Discord objects ---
+class FakeThread:
+    def __init__(self, id: int):
+        self.id = id
+        self.jump_url = f"https://discord.com/channels/1/{id}"
+
+
+class FakeChannel:
+    def __init__(self, id: int, threads: list[FakeThread]):
+        self.id = id
+        self.threads = threads[: len(threads) // 2]
+        self.archived = threads[len(threads) // 2 :]
+
+    async def archived_threads(self, limit=None):
+        for thread in self.archived:
+            yield thread
+
+
+class FakeInteraction:
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+        self.channel = None
+
+
+class FakeAutocompleteContext:
+    def __init__(self, channel_id: int, value: str):
+        self.interaction = FakeInteraction(channel_id)
+        self.value = value
+
+
+class FakeCtftimeClient(util.ctf.CtftimeClient):
+    async def _fetch(self, event_id: int):
+        return dict(CTFTIME_EVENT, id=event_id)
+
+
+# --- fixtures ---
+async def populate() -> dict[int, tuple[FakeChannel, int]]:
+    """
+    One CTF per size, with a third of the challenges solved and half of them in a thread, half of which are
+    archived. Returns the channel and join message id of each.
+    """
+    fixtures = {}
+    async with get_session() as session:
+        users = [User(id=1000 + i) for i in range(20)]
+        session.add_all(users)
+        for size in SIZES:
+            ctf = Ctf(channel_id=size, join_message_id=100_000 + size)
+            session.add(ctf)
+            await session.flush()
+            challenges = [
+                Challenge(
+                    name=f"chal-{i}",
+                    category=CATEGORIES[i % len(CATEGORIES)],
+                    ctf_id=ctf.id,
+                    solved=i % 3 == 0,
+                    thread_id=size * 10_000 + i,
+                    members=users[i % 7 : i % 7 + 3],
+                )
+                for i in range(size)
+            ]
+            session.add_all(challenges)
+            threads = [FakeThread(c.thread_id) for c in challenges[::2]]
+            fixtures[size] = (FakeChannel(ctf.channel_id, threads), ctf.join_message_id)
+        await session.commit()
+    return fixtures
+
+
+# --- harness ---
+async def measure(func: Callable[[], Awaitable[Any]], rounds: int, min_time: float) -> dict[str, float]:
+    await func()  # warm up caches and lazy imports
+
+    # pick an iteration count that makes a round take about min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        timings.append((time.perf_counter() - start) / number * 1e6)
+    return {
+        "best_us": min(timings),
+        "median_us": statistics.median(timings),
+        "number": number,
+        "rounds": rounds,
+    }
+
+
+def benchmarks(fixtures: dict[int, tuple[FakeChannel, int]]) -> dict[str, Callable[[], Awaitable[Any]]]:
+    benches: dict[str, Callable[[], Awaitable[Any]]] = {}
+
+    for size, (channel, join_message_id) in fixtures.items():
+        channel_id = channel.id
+
+        async def paginator(channel=channel):
+            await get_challenge_paginator(channel)  # type: ignore[arg-type]
+
+        async def paginator_cold(channel=channel):
+            # as if the challenges had just been written to
+            render_cache.bump(channel.id)
+            await get_challenge_paginator(channel)  # type: ignore[arg-type]
+
+        async def autocomplete_all(channel_id=channel_id):
+            await get_all_challs_from_ctx(FakeAutocompleteContext(channel_id, "chal-1"))  # type: ignore[arg-type]
+
+        async def autocomplete_unsolved(channel_id=channel_id):
+            await get_unsolved_challs_from_ctx(FakeAutocompleteContext(channel_id, "5"))  # type: ignore[arg-type]
+
+        benches[f"get_challenge_paginator[{size}]"] = paginator
+        benches[f"get_challenge_paginator_cold[{size}]"] = paginator_cold
+        benches[f"autocomplete_all[{size}]"] = autocomplete_all
+        benches[f"autocomplete_unsolved[{size}]"] = autocomplete_unsolved
+
+    join_message_id = fixtures[SIZES[-1]][1]
+
+    async def ctf_by_join_message():
+        async with get_session() as session:
+            await session.scalar(select(Ctf).where(Ctf.join_message_id == join_message_id))
+
+    async def get_details():
+        await util.ctf.get_details("https://ctftime.org/event/2345")
+
+    parsed_event: util.ctf.EventInfo = {
+        "id": CTFTIME_EVENT["id"],
+        "title": CTFTIME_EVENT["title"],
+        "url": CTFTIME_EVENT["url"],
+        "logo": CTFTIME_EVENT["logo"],
+        "description": CTFTIME_EVENT["description"][:997] + "...",
+        "start": datetime.fromisoformat(CTFTIME_EVENT["start"]),
+        "finish": datetime.fromisoformat(CTFTIME_EVENT["finish"]),
+        "discord_inv": "https://discord.gg/exampleCTF",
+    }
+
+    async def details_to_embed():
+        await util.ctf.details_to_embed(parsed_event)
+
+    benches["ctf_by_join_message_id"] = ctf_by_join_message
+    benches["get_details"] = get_details
+    benches["details_to_embed"] = details_to_embed
+    return benches
+
+
+async def run(names: list[str] | None, rounds: int, min_time: float) -> dict[str, dict[str, float]]:
+    with tempfile.TemporaryDirectory() as path:
+        await util.db.init_db(path)
+        try:
+            fixtures = await populate()
+            await challenge_index.load()
+            util.ctf.ctftime = FakeCtftimeClient()
+
+            results = {}
+            for name, func in benchmarks(fixtures).items():
+                if names and not any(n in name for n in names):
+                    continue
+                results[name] = await measure(func, rounds, min_time)
+                print(f"{name:<36} {results[name]['best_us']:>12.1f} us", file=sys.stderr)
+            return results
+        finally:
+            await util.db.close_db()
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old: dict[str, Any], new: dict[str, Any]):
+    print(f"{'benchmark':<36} {'old us':>12} {'new us':>12} {'change':>8}")
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if before is None:
+            print(f"{name:<36} {'-':>12} {result['best_us']:>12.1f} {'new':>8}")
+            continue
+        change = (result["best_us"] - before["best_us"]) / before["best_us"] * 100
+        print(f"{name:<36} {before['best_us']:>12.1f} {result['best_us']:>12.1f} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare against")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per round (default 0.2)")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.names, args.rounds, args.min_time))
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "discord": discord.__version__,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
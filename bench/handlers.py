@@ -0,0 +1,342 @@
+"""
+End-to-end latency of the /chall add, /chall solve and /ctf add handlers against a stub Discord API.
+
+The cogs run unchanged on real py-cord objects, but every REST request is answered by a stub after a fixed delay
+instead of going to Discord, so a handler's time is dominated by how many requests it waits on one after another:
+
+    uv run python bench/handlers.py --latency 0.05 -o handlers-$(git rev-parse --short HEAD).json
+    uv run python bench/handlers.py --compare handlers-abc1234.json
+
+The per-channel rate budget of the dispatcher is lifted, repeated rounds would otherwise measure it instead of the
+handlers. Results are in microseconds per command, as with bench.py.
+"""
+import argparse
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import partial
+import inspect
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import discord
+from discord.ext import commands
+
+from bench import CTFTIME_EVENT, compare, git_commit, measure
+import util.ctf
+import util.db
+from util.cache import challenge_index
+from util.db import Challenge, Ctf, User, get_session
+from util.dispatch import dispatcher
+from util.threads import thread_cache
+
+GUILD_ID = 1
+BOT_ID = 2
+CHANNEL_ID = 10
+USER_IDS = range(1000, 1020)
+
+
+class StubDiscord:
+    """
+    Stands in for `HTTPClient.request`: waits `latency` seconds, then answers with just enough of a payload for
+    py-cord to build the object it expects.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests: Counter[str] = Counter()
+        self.channels: dict[int, dict[str, Any]] = {}
+        self._ids = itertools.count(10**17)
+
+    def channel(self, id: int, name: str, type: int = 0, parent_id: int | None = None) -> dict[str, Any]:
+        data = {
+            "id": str(id),
+            "type": type,
+            "guild_id": str(GUILD_ID),
+            "name": name,
+            "position": 0,
+            "permission_overwrites": [],
+            "parent_id": str(parent_id) if parent_id else None,
+        }
+        if type == discord.ChannelType.public_thread.value:
+            data["owner_id"] = str(BOT_ID)
+            data["thread_metadata"] = {
+                "archived": False,
+                "auto_archive_duration": 1440,
+                "archive_timestamp": datetime.now(timezone.utc).isoformat(),
+                "locked": False,
+            }
+        self.channels[id] = data
+        return data
+
+    def message(self, channel_id: int, content: str = "") -> dict[str, Any]:
+        return {
+            "id": str(next(self._ids)),
+            "channel_id": str(channel_id),
+            "author": {"id": str(BOT_ID), "username": "bot", "discriminator": "0", "avatar": None, "bot": True},
+            "content": content,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+        }
+
+    async def request(self, route, *, files=None, form=None, **kwargs) -> Any:
+        await asyncio.sleep(self.latency)
+        self.requests[f"{route.method} {route.path}"] += 1
+        payload = kwargs.get("json") or {}
+
+        match route.method, route.path:
+            case "POST", "/channels/{channel_id}/messages":
+                return self.message(route.channel_id, payload.get("content") or "")
+            case "PATCH", "/channels/{channel_id}/messages/{message_id}":
+                return self.message(route.channel_id, payload.get("content") or "")
+            case "POST", "/channels/{channel_id}/messages/{message_id}/threads":
+                return self.channel(next(self._ids), payload["name"], 11, route.channel_id)
+            case "PATCH", "/channels/{channel_id}":
+                data = self.channels[int(route.channel_id)]
+                data["name"] = payload.get("name", data["name"])
+                if "archived" in payload:
+                    data["thread_metadata"]["archived"] = payload["archived"]
+                return data
+            case "POST", "/guilds/{guild_id}/channels":
+                data = self.channel(next(self._ids), payload["name"])
+                data["permission_overwrites"] = [
+                    dict(o, allow=str(o["allow"]), deny=str(o["deny"])) for o in payload["permission_overwrites"]
+                ]
+                return data
+            case "POST", "/guilds/{guild_id}/roles":
+                return role(next(self._ids), payload["name"])
+            case "GET", "/channels/{channel_id}/threads/archived/public":
+                return {"threads": [], "members": [], "has_more": False}
+            case "POST", "/guilds/{guild_id}/scheduled-events":
+                return dict(payload, id=str(next(self._ids)), guild_id=str(GUILD_ID), status=1)
+            case _:
+                # reactions, pins and thread members have no body
+                return None
+
+
+def role(id: int, name: str) -> dict[str, Any]:
+    return {
+        "id": str(id),
+        "name": name,
+        "permissions": "0",
+        "position": 0,
+        "color": 0,
+        "colors": {"primary_color": 0},
+        "hoist": False,
+        "managed": False,
+        "mentionable": False,
+    }
+
+
+class StubContext:
+    """
+    The parts of an ApplicationContext the handlers use. Interaction responses take the same latency as REST
+    requests.
+    """
+
+    def __init__(self, stub: StubDiscord, state, channel: discord.TextChannel, user_id: int):
+        self.stub = stub
+        self.state = state
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id
+        self.author = SimpleNamespace(
+            id=user_id,
+            mention=f"<@{user_id}>",
+            guild_permissions=discord.Permissions.all(),
+        )
+        self.interaction = SimpleNamespace(channel=channel, guild=channel.guild)
+
+    async def defer(self, *args, **kwargs):
+        await asyncio.sleep(self.stub.latency)
+
+    async def respond(self, *args, **kwargs) -> discord.Message:
+        await asyncio.sleep(self.stub.latency)
+        self.stub.requests["interaction response"] += 1
+        return self.state.create_message(channel=self.channel, data=self.stub.message(self.channel.id))
+
+
+class StubCtftimeClient(util.ctf.CtftimeClient):
+    async def _fetch(self, event_id: int):
+        # always running, so /ctf add accepts it
+        now = datetime.now(timezone.utc)
+        return dict(
+            CTFTIME_EVENT,
+            id=event_id,
+            start=(now - timedelta(hours=1)).isoformat(),
+            finish=(now + timedelta(days=2)).isoformat(),
+        )
+
+
+def make_bot(stub: StubDiscord) -> tuple[commands.Bot, discord.TextChannel]:
+    bot = commands.Bot(intents=discord.Intents.default())
+    bot.http.request = stub.request  # type: ignore[method-assign]
+    state = bot._connection
+    user = {"id": str(BOT_ID), "username": "bot", "discriminator": "0", "avatar": None, "bot": True}
+    state.user = discord.ClientUser(state=state, data=user)  # type: ignore[arg-type]
+
+    guild = discord.Guild(
+        state=state,
+        data={  # type: ignore[arg-type]
+            "id": str(GUILD_ID),
+            "name": "bench",
+            "roles": [role(GUILD_ID, "@everyone")],
+            "members": [{"user": user, "roles": [], "joined_at": datetime.now(timezone.utc).isoformat()}],
+            "member_count": 1,
+        },
+    )
+    state._add_guild(guild)
+    channel = discord.TextChannel(state=state, guild=guild, data=stub.channel(CHANNEL_ID, "example-ctf"))
+    guild._add_channel(channel)
+
+    bot.load_extension("cogs.ctf")
+    bot.load_extension("cogs.chall")
+    return bot, channel
+
+
+async def populate(stub: StubDiscord, channel: discord.TextChannel, unsolved: int) -> Ctf:
+    """
+    A CTF in `channel` with `unsolved` challenges that each have a thread.
+    """
+    async with get_session() as session:
+        users = [User(id=id) for id in USER_IDS]
+        session.add_all(users)
+        ctf = Ctf(channel_id=channel.id, join_message_id=CHANNEL_ID + 1, guild_id=GUILD_ID)
+        session.add(ctf)
+        await session.flush()
+        for i in range(unsolved):
+            data = stub.channel(next(stub._ids), f"pwn/todo-{i}", 11, channel.id)
+            thread = discord.Thread(guild=channel.guild, state=channel._state, data=data)  # type: ignore[arg-type]
+            session.add(
+                Challenge(
+                    name=f"todo-{i}",
+                    category="pwn",
+                    ctf_id=ctf.id,
+                    thread_id=thread.id,
+                    guild_id=GUILD_ID,
+                    members=users[i % 5 : i % 5 + 2],
+                )
+            )
+            channel.guild._add_thread(thread)
+        await session.commit()
+    return ctf
+
+
+def benchmarks(
+    stub: StubDiscord, bot: commands.Bot, channel: discord.TextChannel, unsolved: int
+) -> dict[str, Callable[[], Awaitable[Any]]]:
+    chall_cog = bot.get_cog("chall")
+    ctf_cog = bot.get_cog("ctf")
+    state = bot._connection
+    added = itertools.count()
+    solved = iter(range(unsolved))
+    joined = itertools.count()
+
+    def context(user_id: int = USER_IDS[0]) -> StubContext:
+        return StubContext(stub, state, channel, user_id)
+
+    async def chall_add_new():
+        await chall_cog.add.callback(chall_cog, context(), f"new-{next(added)}", "web")
+
+    async def chall_add_existing():
+        # a new member joins a challenge that already has a thread
+        i = next(joined)
+        await chall_cog.add.callback(chall_cog, context(USER_IDS[10 + i % 10]), f"todo-{i // 10}", None)
+
+    async def chall_solve():
+        await chall_cog.solve.callback(chall_cog, context(), f"todo-{unsolved - 1 - next(solved)}", None)
+
+    # commits from before /ctf add had a use_role option can still be measured for --compare
+    has_roles = "use_role" in inspect.signature(ctf_cog.add.callback).parameters
+
+    async def ctf_add(**options):
+        await ctf_cog.add.callback(ctf_cog, context(), "bench", "https://ctftime.org/event/2345", **options)
+
+    benches = {
+        "chall_add_new": chall_add_new,
+        "chall_add_existing": chall_add_existing,
+        "chall_solve": chall_solve,
+        "ctf_add": partial(ctf_add, use_role=False) if has_roles else ctf_add,
+    }
+    if has_roles:
+        benches["ctf_add_role"] = partial(ctf_add, use_role=True)
+    return benches
+
+
+async def run(names: list[str] | None, rounds: int, min_time: float, latency: float) -> dict[str, dict[str, float]]:
+    stub = StubDiscord(latency)
+    bot, channel = make_bot(stub)
+    dispatcher.rate = dispatcher.burst = 1_000_000
+    with tempfile.TemporaryDirectory() as path:
+        await util.db.init_db(path)
+        try:
+            # enough challenges that solves and joins never run out
+            unsolved = 2000
+            await populate(stub, channel, unsolved)
+            await challenge_index.load()
+            util.ctf.ctftime = StubCtftimeClient()
+            await thread_cache.threads(channel)
+
+            results = {}
+            for name, func in benchmarks(stub, bot, channel, unsolved).items():
+                if names and not any(n in name for n in names):
+                    continue
+                results[name] = await measure(func, rounds, min_time)
+                print(f"{name:<36} {results[name]['best_us']:>12.1f} us", file=sys.stderr)
+            return results
+        finally:
+            await util.db.close_db()
+            dispatcher.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare against")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=1, help="seconds per round (default 1)")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per Discord request (default 0.05)")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.names, args.rounds, args.min_time, args.latency))
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "discord": discord.__version__,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "latency": args.latency,
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
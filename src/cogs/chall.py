@@ -1,14 +1,31 @@
+import asyncio
 import os
 import random
 
 import discord
 from discord import guild_only
 from discord.commands import SlashCommandGroup
-from discord.ext import commands
-from sqlalchemy import and_, select
-
-from util.chall import get_challenge_paginator
-from util.db import Ctf, User, get_all_challs_from_ctx, get_conn, Challenge, get_unsolved_challs_from_ctx
+from discord.ext import commands, pages
+from sqlalchemy import select, update
+from sqlalchemy.orm import contains_eager, selectinload
+
+from util.archive import archived_challenge_rows, get_archive
+from util.chall import (
+    board,
+    create_challenge_threads,
+    get_challenge_paginator,
+    join_thread,
+    mark_thread_solved,
+    parse_challenge_list,
+    render_challenge_pages,
+    set_thread_id,
+)
+from util.cache import challenge_index, get_all_challs_from_ctx, get_unsolved_challs_from_ctx
+from util.db import Ctf, Challenge, get_or_create_user, get_session
+from util.dispatch import Priority, edit, request, respond, run_all, send
+from util.metrics import metrics
+from util.stats import record_added, record_removed, record_solved, record_solver
+from util.threads import thread_cache
 
 dev_guild = os.environ.get("BOT_DEV_GUILD", None)
 
@@ -26,6 +43,27 @@ class chall(commands.Cog):
         guild_ids=[int(dev_guild)] if dev_guild else None,
     )
 
+    @commands.Cog.listener()
+    @metrics.instrument("listener")
+    async def on_thread_create(self, thread: discord.Thread):
+        thread_cache.add(thread)
+
+    @commands.Cog.listener()
+    @metrics.instrument("listener")
+    async def on_raw_thread_update(self, payload: discord.RawThreadUpdateEvent):
+        # also fires for threads py-cord doesn't cache, e.g. when they are archived or reopened
+        if payload.thread is not None:
+            thread_cache.add(payload.thread)
+
+    @commands.Cog.listener()
+    @metrics.instrument("listener")
+    async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent):
+        if thread_cache.remove(payload.parent_id, payload.thread_id):
+            # the board links to the thread
+            channel = self.bot.get_channel(payload.parent_id)
+            if type(channel) is discord.TextChannel:
+                board.refresh(channel)
+
     @chall_group.command(description="Add a new challenge, or work with someone else on an existing challenge")
     @discord.option("name", type=str, description="Challenge name")
     @discord.option(
@@ -38,72 +76,77 @@ class chall(commands.Cog):
         name: str,
         category: str | None,
     ):
-        with get_conn() as conn:
-            ctf = conn.scalar(select(Ctf).where(Ctf.channel_id == ctx.channel_id))
+        async with get_session() as session:
+            ctf = await session.scalar(select(Ctf).where(Ctf.channel_id == ctx.channel_id))
             if not ctf:
-                return await ctx.respond("Invalid channel!", ephemeral=True)
+                return await respond(ctx, "Invalid channel!", ephemeral=True)
 
-            challenge = conn.scalar(
-                select(Challenge).join(Ctf).where(and_(Challenge.name == name, Ctf.channel_id == ctx.channel_id))
+            challenge = await session.scalar(
+                select(Challenge)
+                .where(Challenge.ctf_id == ctf.id, Challenge.name == name)
+                .options(selectinload(Challenge.members))
             )
 
             if challenge:
                 if challenge.solved:
-                    return await ctx.respond("Challenge already solved", ephemeral=True)
+                    return await respond(ctx, "Challenge already solved", ephemeral=True)
 
                 # check if challenge.members is unchanged
                 # if unchanged, inform the user that the challenge is already added
                 # if changed, append the user to workon
-                user = conn.scalar(select(User).where(User.id == ctx.author.id))
-                if not user:
-                    user = User(id=ctx.author.id)
-                    conn.add(user)
-
-                if ctx.author.id not in [user.id for user in challenge.members]:
-                    # add to thread if thread exists
-                    thread = ctx.bot.get_channel(challenge.thread_id)
-                    if thread and type(thread) is discord.Thread:
-                        await thread.add_user(ctx.author)
-
-                    # append to members list
-                    user = conn.scalar(select(User).where(User.id == ctx.author.id))
-                    if not user:
-                        user = User(id=ctx.author.id)
-                        conn.add(user)
-                    old_members_list = challenge.members[:]  # pass by value
-                    challenge.members.append(user)
-                    conn.commit()
-                    user_list = "+".join([f"<@{user.id}>" for user in old_members_list])
-                    await ctx.send(f"{ctx.author.mention} is working on `{name}` together with {user_list}")
-
-                    paginator = await get_challenge_paginator(ctx, ctx.channel_id)
-                    return await paginator.respond(ctx.interaction)
-
-                # unchanged, return error
-                return await ctx.respond("Challenge already added", ephemeral=True)
-            else:
-                if not category:
-                    await ctx.respond("Category required for new challenge", ephemeral=True)
-                    return
-
-                user = conn.scalar(select(User).where(User.id == ctx.author.id))
-                if not user:
-                    user = User(id=ctx.author.id)
-                    conn.add(user)
-
-                _category = category.lower()
-
-                thread_name = f"{_category}/{name}"
-                message = await ctx.send(f"`{thread_name}`")
-                thread = await message.create_thread(name=thread_name)
-                await thread.add_user(ctx.author)
-
-                challenge = Challenge(name=name, category=_category, ctf=ctf, members=[user], thread_id=thread.id)
-
-                conn.add(challenge)
-                conn.commit()
+                if ctx.author.id in [user.id for user in challenge.members]:
+                    # unchanged, return error
+                    return await respond(ctx, "Challenge already added", ephemeral=True)
+
+                # append to members list
+                user = await get_or_create_user(session, ctx.author.id)
+                old_members_list = challenge.members[:]  # pass by value
+                challenge.members.append(user)
+                await session.commit()
+
+        if challenge:
+            user_list = "+".join([f"<@{user.id}>" for user in old_members_list])
+            steps = [respond(ctx, f"{ctx.author.mention} is working on `{name}` together with {user_list}")]
+            if type(ctx.channel) is discord.TextChannel:
+                # add to thread if thread exists, while the response is on its way
+                steps.append(join_thread(ctx.channel, challenge.thread_id, ctx.author))
+                board.refresh(ctx.channel)
+            await run_all(*steps)
+            return
+
+        if not category:
+            await respond(ctx, "Category required for new challenge", ephemeral=True)
+            return
+
+        _category = category.lower()
+
+        # the row goes in before any request is made, its thread is attached once it exists, as with /chall import
+        async with get_session() as session:
+            user = await get_or_create_user(session, ctx.author.id)
+            challenge = Challenge(
+                name=name, category=_category, ctf_id=ctf.id, members=[user], thread_id=0, guild_id=ctf.guild_id
+            )
+            session.add(challenge)
+            await record_added(session, ctf, [challenge])
+            await session.commit()
+        challenge_index.add(ctf.channel_id, name)
+
+        async def create_thread():
+            thread_name = f"{_category}/{name}"
+            message = await send(ctx.channel, f"`{thread_name}`", priority=Priority.ACTION)
+            thread = await request(Priority.ACTION, ctx.channel.id, message.create_thread, name=thread_name)
+            thread_cache.add(thread)
+            await run_all(
+                request(Priority.ACTION, thread.id, thread.add_user, ctx.author),
+                set_thread_id(challenge.id, thread.id),
+            )
 
-                return await ctx.respond(f"Challenge `{_category}/{name}` added", ephemeral=True)
+        try:
+            await run_all(respond(ctx, f"Challenge `{_category}/{name}` added", ephemeral=True), create_thread())
+        finally:
+            # the board links to the thread, and lists the challenge even if its thread couldn't be created
+            if type(ctx.channel) is discord.TextChannel:
+                board.refresh(ctx.channel)
 
     @chall_group.command(desription="Remove a challenge")
     @discord.option("name", type=str, autocomplete=get_all_challs_from_ctx)
@@ -113,33 +156,36 @@ class chall(commands.Cog):
         ctx: discord.ApplicationContext,
         name: str,
     ):
-        with get_conn() as conn:
-            if type(ctx.channel) is discord.Thread:
-                channel = ctx.channel.parent
-            else:
-                channel = ctx.channel
-            if type(channel) is not discord.TextChannel:
-                return await ctx.respond("Invalid channel!")
-
-            challenge = conn.scalar(
+        if type(ctx.channel) is discord.Thread:
+            channel = ctx.channel.parent
+        else:
+            channel = ctx.channel
+        if type(channel) is not discord.TextChannel:
+            return await respond(ctx, "Invalid channel!")
+
+        async with get_session() as session:
+            challenge = await session.scalar(
                 select(Challenge)
                 .join(Challenge.ctf)
                 .where(Challenge.name == name)
                 .where(Ctf.channel_id == channel.id)
+                .options(selectinload(Challenge.members), contains_eager(Challenge.ctf))
             )
             if not challenge:
-                return await ctx.respond(f"Challenge `{name}` not found", ephemeral=True)
+                return await respond(ctx, f"Challenge `{name}` not found", ephemeral=True)
 
-            thread = ctx.bot.get_channel(challenge.thread_id)
-            if thread and type(thread) == discord.Thread:
-                await thread.delete()
+            await record_removed(session, challenge.ctf, challenge)
+            await session.delete(challenge)
+            await session.commit()
+        challenge_index.remove(channel.id, challenge.name)
 
-            conn.delete(challenge)
-            conn.commit()
-            await ctx.respond(f"Challenge `{challenge.name}` removed", ephemeral=True)
+        thread = await thread_cache.get(channel, challenge.thread_id)
+        if thread:
+            await request(Priority.ACTION, thread.id, thread.delete)
+            thread_cache.remove(channel.id, thread.id)
 
-            paginator = await get_challenge_paginator(ctx, ctf)
-            return await paginator.respond(ctx.interaction, target=channel)
+        board.refresh(channel)
+        return await respond(ctx, f"Challenge `{challenge.name}` removed", ephemeral=True)
 
     @chall_group.command(description="Mark challenge as solved, or add yourself to the list of solvers")
     @discord.option(
@@ -159,99 +205,187 @@ class chall(commands.Cog):
         name: str | None,
         category: str | None,
     ):
-        with get_conn() as conn:
-            if type(ctx.channel) is discord.Thread:
-                channel = ctx.channel.parent
-                thread = ctx.channel
-            elif type(ctx.channel) is discord.TextChannel:
-                channel = ctx.channel
-                thread = None
-            else:
-                return await ctx.respond("Invalid channel!", ephemeral=True)
-            if type(channel) is not discord.TextChannel:
-                return await ctx.respond("Invalid channel!")
-
-            ctf = conn.scalar(select(Ctf).where(Ctf.channel_id == channel.id))
+        if type(ctx.channel) is discord.Thread:
+            channel = ctx.channel.parent
+            thread = ctx.channel
+        elif type(ctx.channel) is discord.TextChannel:
+            channel = ctx.channel
+            thread = None
+        else:
+            return await respond(ctx, "Invalid channel!", ephemeral=True)
+        if type(channel) is not discord.TextChannel:
+            return await respond(ctx, "Invalid channel!")
+
+        async with get_session() as session:
+            ctf = await session.scalar(select(Ctf).where(Ctf.channel_id == channel.id))
             if not ctf:
-                return await ctx.respond("Invalid channel!", ephemeral=True)
-
-            user = conn.scalar(select(User).where(User.id == ctx.author.id))
-            if not user:
-                user = User(id=ctx.author.id)
-                conn.add(user)
+                return await respond(ctx, "Invalid channel!", ephemeral=True)
 
             if name:
-                challenge = conn.scalar(
-                    select(Challenge).join(Ctf).where(Challenge.name == name).where(Ctf.channel_id == ctx.channel_id)
+                challenge = await session.scalar(
+                    select(Challenge)
+                    .where(Challenge.ctf_id == ctf.id, Challenge.name == name)
+                    .options(selectinload(Challenge.members))
                 )
             elif thread is not None:
-                challenge = conn.scalar(
+                challenge = await session.scalar(
                     select(Challenge)
-                    .join(Ctf)
-                    .where(Challenge.thread_id == thread.id)
-                    .where(Ctf.channel_id == channel.id)
+                    .where(Challenge.ctf_id == ctf.id, Challenge.thread_id == thread.id)
+                    .options(selectinload(Challenge.members))
                 )
             else:
-                return await ctx.respond(
+                return await respond(ctx, 
                     "Challenge name required since command not invoked from challenge thread", ephemeral=True
                 )
 
+            user = await get_or_create_user(session, ctx.author.id)
+
             if not challenge:
                 if not category:
-                    return await ctx.respond("Category required for new challenge", ephemeral=True)
-                challenge = Challenge(name=name, members=[user], ctf=ctf, category=category.lower(), thread_id=0)
-                conn.add(challenge)
+                    return await respond(ctx, "Category required for new challenge", ephemeral=True)
+                challenge = Challenge(
+                    name=name,
+                    members=[user],
+                    ctf_id=ctf.id,
+                    category=category.lower(),
+                    thread_id=0,
+                    solved=True,
+                    guild_id=ctf.guild_id,
+                )
+                session.add(challenge)
+                await record_added(session, ctf, [challenge])
+                newly_solved = True
             elif not challenge.solved:
-                thread = ctx.bot.get_channel(challenge.thread_id)
-                if thread and type(thread) is discord.Thread:
-                    await thread.edit(name=f"{challenge.category}/{challenge.name} [SOLVED]")
-
-                challenge.solved_by = list(set(challenge.members + [user])) # uniq
+                if user not in challenge.members:
+                    challenge.members.append(user)
                 challenge.solved = True
-                conn.commit()
-
-                emoji = random.choice([":partying_face:", ":fire:", ":tada:", ":confetti_ball:"])
-                user_list = "+".join([f"<@{user.id}>" for user in challenge.solved_by])
-                content = f"{emoji * 3} {user_list} solved `{challenge.category}/{challenge.name}`!"
-                await ctx.send(content)
-                # send the same message in the main ctf channel if currently in thread
-                if thread is not None and type(channel) is discord.TextChannel:
-                    await channel.send(content)
-
-                # whether in thread or main channel, always send the chall list to the main channel
-                paginator = await get_challenge_paginator(ctx, ctf)
-                return await paginator.respond(ctx.interaction, target=channel)
+                await record_solved(session, ctf, challenge, [member.id for member in challenge.members])
+                newly_solved = True
+            elif user not in challenge.members:
+                challenge.members.append(user)
+                await record_solver(session, ctf, user.id)
+                newly_solved = False
             else:
-                if user.id not in challenge.solved_by:
-                    challenge.solved_by = challenge.solved_by + [user]
-                    conn.commit()
-
-                    emoji = random.choice([":partying_face:", ":fire:", ":tada:", ":confetti_ball:"])
-
-                    user_list = "+".join([f"<@{user.id}>" for user in challenge.solved_by])
-                    await ctx.send(f"{emoji * 3} {user_list} solved `{challenge.category}/{challenge.name}`!")
-                    paginator = await get_challenge_paginator(ctx, channel.id)
-                    return await paginator.respond(ctx.interaction, target=channel)
-                else:
-                    return await ctx.respond("You have already solved this challenge!", ephemeral=True)
+                return await respond(ctx, "You have already solved this challenge!", ephemeral=True)
+
+            await session.commit()
+            solvers = challenge.members[:]
+        challenge_index.set_solved(channel.id, challenge.name)
+
+        # whether in thread or main channel, the board lives in the main channel
+        board.refresh(channel)
+
+        emoji = random.choice([":partying_face:", ":fire:", ":tada:", ":confetti_ball:"])
+        user_list = "+".join([f"<@{user.id}>" for user in solvers])
+        content = f"{emoji * 3} {user_list} solved `{challenge.category}/{challenge.name}`!"
+        steps = [respond(ctx, content)]
+        if newly_solved:
+            steps.append(mark_thread_solved(channel, challenge))
+            # send the same message in the main ctf channel if currently in thread
+            if thread is not None:
+                steps.append(send(channel, content))
+        await run_all(*steps)
 
     @chall_group.command(description="List challenges")
     @guild_only()
     async def list(self, ctx: discord.ApplicationContext):
-        with get_conn() as conn:
-            if type(ctx.channel) is discord.Thread:
-                channel = ctx.channel.parent
-            else:
-                channel = ctx.channel
-            if type(channel) is not discord.TextChannel:
-                return await ctx.respond("Invalid channel!", ephemeral=True)
+        if type(ctx.channel) is discord.Thread:
+            channel = ctx.channel.parent
+        else:
+            channel = ctx.channel
+        if type(channel) is not discord.TextChannel:
+            return await respond(ctx, "Invalid channel!", ephemeral=True)
+
+        async with get_session() as session:
+            ctf = await session.scalar(select(Ctf).where(Ctf.channel_id == channel.id))
+        if ctf:
+            paginator = await get_challenge_paginator(channel)
+        elif (archive := await get_archive(channel.id)) is not None:
+            out = render_challenge_pages(archived_challenge_rows(archive), await thread_cache.threads(channel))
+            paginator = pages.Paginator(
+                pages=[discord.Embed(title="Challenges (archived)", description=c) for c in out]
+            )
+        else:
+            return await respond(ctx, "Invalid channel!", ephemeral=True)
 
-            ctf = conn.scalar(select(Ctf).where(Ctf.channel_id == channel.id))
+        await request(Priority.INTERACTION, None, paginator.respond, ctx.interaction)
+
+    @chall_group.command(name="import", description="Add challenges in bulk from a CTFd JSON export or a CSV file")
+    @discord.option(
+        "file", type=discord.Attachment, description="JSON or CSV file listing challenge names and categories"
+    )
+    @guild_only()
+    async def import_(self, ctx: discord.ApplicationContext, file: discord.Attachment):
+        channel = ctx.channel
+        if type(channel) is not discord.TextChannel:
+            return await respond(ctx, "Invalid channel!", ephemeral=True)
+
+        async with get_session() as session:
+            ctf = await session.scalar(select(Ctf).where(Ctf.channel_id == channel.id))
             if not ctf:
-                return await ctx.respond("Invalid channel!", ephemeral=True)
+                return await respond(ctx, "Invalid channel!", ephemeral=True)
+            existing = set((await session.scalars(select(Challenge.name).where(Challenge.ctf_id == ctf.id))).all())
+
+        try:
+            challenges = parse_challenge_list(await file.read(), file.filename)
+        except (ValueError, UnicodeDecodeError) as e:
+            return await respond(ctx, f"Could not read `{file.filename}`: {e}", ephemeral=True)
+
+        challenges = [(name, category) for name, category in challenges if name not in existing]
+        if not challenges:
+            return await respond(ctx, "No new challenges to import", ephemeral=True)
+
+        # every row goes in with one transaction, threads are attached once they exist
+        async with get_session() as session:
+            rows = [
+                Challenge(name=name, category=category, ctf_id=ctf.id, thread_id=0, guild_id=ctf.guild_id)
+                for name, category in challenges
+            ]
+            session.add_all(rows)
+            await record_added(session, ctf, rows)
+            await session.commit()
+        for name, _ in challenges:
+            challenge_index.add(channel.id, name)
+
+        total = len(rows)
+        done = 0
+
+        def on_done():
+            nonlocal done
+            done += 1
+
+        await respond(ctx, f"Importing {total} challenges...")
+        progress = await ctx.interaction.original_response()
+
+        async def report_progress():
+            reported = 0
+            while True:
+                await asyncio.sleep(2)
+                if done != reported:
+                    reported = done
+                    await edit(progress, content=f"Importing challenges: {done}/{total}")
+
+        reporter = asyncio.create_task(report_progress())
+        try:
+            thread_ids, failed = await create_challenge_threads(
+                channel, [(c.id, c.name, c.category) for c in rows], on_done
+            )
+        finally:
+            reporter.cancel()
+
+        if thread_ids:
+            async with get_session() as session:
+                await session.execute(
+                    update(Challenge), [{"id": id, "thread_id": thread_id} for id, thread_id in thread_ids.items()]
+                )
+                await session.commit()
+
+        board.refresh(channel)
 
-            paginator = await get_challenge_paginator(ctx, channel.id)
-            await paginator.respond(ctx.interaction)
+        content = f"Imported {total} challenges"
+        if failed:
+            content += f" ({failed} threads could not be created)"
+        await edit(progress, content=content)
 
 
 def setup(bot):
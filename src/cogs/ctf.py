@@ -1,19 +1,33 @@
 from dateutil import parser
 from datetime import datetime, timezone, timedelta
+import logging
 import pytz
 import os
 
 import discord
 from discord import guild_only
 from discord.commands import SlashCommandGroup
-from discord.ext import commands, tasks
-from sqlalchemy import select
+from discord.ext import commands, pages
+from sqlalchemy import delete, select, update
 
 import util.ctf
-from util.db import get_conn, Ctf
+from util.archive import ARCHIVE_LOCK_THREADS, archived_challenge_rows, archiver, get_archive
+from util.cache import challenge_index, join_index, render_cache
+from util.chall import get_challenge_rows
+from util.db import get_session, Ctf
+from util.dispatch import Priority, edit, request, respond, run_all, send
+from util.export import exporter
+from util.joins import join_queue
+from util.metrics import metrics
+from util.roles import CTF_ROLES, ctf_roles
+from util.stats import get_stats, stats_embed
+from util.threads import thread_cache
+from util.timers import timers
 
 dev_guild = os.environ.get("DEV_GUILD", None)
 
+TIMECHECK_INTERVAL = 30 * 60
+
 class HumanReadableTime_to_Datetime(commands.Converter):
     async def convert(self, ctx, argument):
         date = parser.parse(argument)
@@ -27,8 +41,6 @@ class ctf(commands.Cog):
     Commands related to CTFs.
     """
 
-    timers = []
-
     def __init__(self, bot):
         self.bot = bot
 
@@ -38,47 +50,64 @@ class ctf(commands.Cog):
         guild_ids=[int(dev_guild)] if dev_guild else None,
     )
 
-    # TODO: rate limit this
+    async def get_ctf_channel(self, join_message_id: int, channel_id: int) -> discord.TextChannel | None:
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            try:
+                channel = await self.bot.fetch_channel(channel_id)
+            except discord.NotFound:
+                # channel was deleted, forget about the ctf
+                async with get_session() as session:
+                    ctf_id = await session.scalar(select(Ctf.id).where(Ctf.join_message_id == join_message_id))
+                    await session.execute(delete(Ctf).where(Ctf.id == ctf_id))
+                    await session.commit()
+                join_index.remove(join_message_id)
+                if ctf_id is not None:
+                    await timers.remove_ctf(ctf_id)
+                challenge_index.forget(channel_id)
+                render_cache.forget(channel_id)
+                thread_cache.forget(channel_id)
+                return None
+        return channel if type(channel) is discord.TextChannel else None
+
     @commands.Cog.listener()
     @guild_only()
+    @metrics.instrument("listener")
     async def on_raw_reaction_add(self, reaction: discord.RawReactionActionEvent):
+        # almost every reaction in the guild is on some other message
+        channel_id = join_index.get(reaction.message_id)
+        if channel_id is None:
+            return
+
         user = self.bot.get_user(reaction.user_id)
-        if user.bot:
+        if user is None or user.bot:
             return
 
-        with get_conn() as conn:
-            ctf = conn.scalar(select(Ctf).where(Ctf.join_message_id == reaction.message_id))
-            if ctf is None:
-                return
+        channel = await self.get_ctf_channel(reaction.message_id, channel_id)
+        if channel is None:
+            return
 
-            channel = await self.bot.fetch_channel(ctf.channel_id)
-            if channel is None:
-                conn.delete(ctf)
-            else:
-                await channel.send(f"{user.mention} is joining the channel")
-                await channel.set_permissions(user, view_channel=True)
+        join_queue.request(channel, user, join=True)
 
-    # TODO: rate limit this
     @commands.Cog.listener()
     @guild_only()
+    @metrics.instrument("listener")
     async def on_raw_reaction_remove(self, reaction: discord.RawReactionActionEvent):
+        # almost every reaction in the guild is on some other message
+        channel_id = join_index.get(reaction.message_id)
+        if channel_id is None:
+            return
+
         user = self.bot.get_user(reaction.user_id)
-        if user.bot:
+        if user is None or user.bot:
             return
 
-        with get_conn() as conn:
-            ctf = conn.scalar(select(Ctf).where(Ctf.join_message_id == reaction.message_id))
-            if ctf is None:
-                return
+        channel = await self.get_ctf_channel(reaction.message_id, channel_id)
+        if channel is None:
+            return
 
-            channel = await self.bot.fetch_channel(ctf.channel_id)
-            if channel is None:
-                conn.delete(ctf)
-            else:
-                await channel.send(f"{user.mention} is leaving the channel")
-                await channel.set_permissions(user, view_channel=False)
+        join_queue.request(channel, user, join=False)
 
-    # TODO: enumerate and show upcoming events
     @ctf_group.command(description="View details of a specific CTF")
     @discord.option(name="ctftime_link", type=str, description="CTFtime link of CTF")
     @guild_only()
@@ -90,20 +119,62 @@ class ctf(commands.Cog):
         event_info = await util.ctf.get_details(ctftime_link)
         if event_info is False:
             # ctf doesn't exist
-            await ctx.respond("Invalid CTFtime event link/id", ephemeral=True)
+            await respond(ctx, "Invalid CTFtime event link/id", ephemeral=True)
             return
 
         embed = await util.ctf.details_to_embed(event_info)
 
-        await ctx.respond(embed=embed)
+        await respond(ctx, embed=embed)
+
+    @ctf_group.command(description="List upcoming CTFs from CTFtime")
+    @discord.option(
+        name="days", type=int, description="How many days ahead to list (default 7)",
+        min_value=1, max_value=util.ctf.CTFTIME_FEED_DAYS, default=7,
+    )
+    @discord.option(
+        name="format", type=str, description="Only list CTFs of this format",
+        choices=util.ctf.FORMATS, default=None,
+    )
+    @discord.option(name="after", type=str, description="List from this date instead of now", default=None)
+    @guild_only()
+    async def upcoming(
+        self, ctx: discord.ApplicationContext,
+        days: int, format: str | None, after: str | None
+    ):
+        # answered from the feed snapshot, CTFtime is only fetched in the background
+        feed = util.ctf.upcoming
+        if feed.fetched_at is None:
+            await respond(ctx, "Upcoming CTFs haven't been fetched from CTFtime yet, try again later", ephemeral=True)
+            return
+
+        if after is None:
+            start = datetime.now(timezone.utc)
+        else:
+            try:
+                start = await HumanReadableTime_to_Datetime().convert(ctx, after)
+            except (ValueError, OverflowError):
+                await respond(ctx, "Invalid date", ephemeral=True)
+                return
+
+        events = feed.query(start, start + timedelta(days=days), format)
+        if not events:
+            await respond(ctx, "No upcoming CTFs found", ephemeral=True)
+            return
+
+        paginator = pages.Paginator(pages=util.ctf.upcoming_to_embeds(events, feed.fetched_at))
+        await request(Priority.INTERACTION, None, paginator.respond, ctx.interaction)
 
     @ctf_group.command(description="Create channel for a CTF. The CTF end time must be in the future.")
     @discord.option(name="team_name", type=str, description="Team name")
     @discord.option(name="ctftime_link", type=str, description="CTFtime link or numeric ID")
+    @discord.option(
+        name="use_role", type=bool, description="Let members in through a role for this CTF instead of one by one",
+        default=CTF_ROLES,
+    )
     @guild_only()
     async def add(
         self, ctx: discord.ApplicationContext,
-        team_name: str, ctftime_link: str
+        team_name: str, ctftime_link: str, use_role: bool
    ):
         await ctx.defer()
 
@@ -111,7 +182,7 @@ class ctf(commands.Cog):
         event_info = await util.ctf.get_details(ctftime_link)
         if event_info is False:
             # ctf doesn't exist
-            await ctx.followup.send("Invalid CTFtime event link/id")
+            await respond(ctx, "Invalid CTFtime event link/id")
             return
 
         now = datetime.now(timezone.utc) + timedelta(0, 10)
@@ -119,22 +190,33 @@ class ctf(commands.Cog):
         # Check if timing is valid
         if now > event_info["finish"]:
             # ctf has already ended
-            await ctx.followup.send("CTF is over")
+            await respond(ctx, "CTF is over")
             return
 
-        # create text channel for CTF
-        with get_conn() as conn:
-            channel = await util.ctf.create_channel(ctx, event_info)
-
-            if channel is None:
-                await ctx.followup.send("Error creating channel")
-                return
+        async def create_channel() -> tuple[discord.TextChannel | None, discord.Role | None]:
+            # the role has to exist before the channel, its view permission is set when the channel is created
+            role = await ctf_roles.create(ctx.guild, event_info["title"]) if use_role and ctx.guild else None
+            try:
+                channel = await util.ctf.create_channel(ctx, event_info, role)
+            except discord.HTTPException:
+                logging.exception("Failed to create a CTF channel")
+                channel = None
+            if channel is None and role is not None:
+                await ctf_roles.delete(role.guild, [role.id], reason="CTF channel could not be created")
+                role = None
+            return channel, role
+
+        # create text channel for CTF, and post the join message while it is being created
+        embed = await util.ctf.details_to_embed(event_info)
+        (channel, role), join_msg = await run_all(
+            create_channel(), respond(ctx, embed=embed.set_footer(text="React with ✋ to join the channel."))
+        )
 
-            embed = await util.ctf.details_to_embed(event_info)
-            join_msg = await ctx.followup.send(embed=embed.set_footer(text="React with ✋ to join the channel."))
-            # join_msg = await join_interaction.original_response()
-            await join_msg.add_reaction("✋")
+        if channel is None:
+            await edit(join_msg, priority=Priority.INTERACTION, content="Error creating channel", embed=None)
+            return
 
+        async def create_event():
             # create scheduled event
             try:
                 # will fail if dates aren't valid (eg. start == end, start > end)
@@ -144,7 +226,10 @@ class ctf(commands.Cog):
                     start_time = now
 
                 assert ctx.interaction.guild is not None
-                await ctx.interaction.guild.create_scheduled_event(
+                await request(
+                    Priority.ACTION,
+                    None,
+                    ctx.interaction.guild.create_scheduled_event,
                     name=event_info["title"],
                     start_time=start_time,
                     end_time=event_info["finish"],
@@ -153,43 +238,120 @@ class ctf(commands.Cog):
             except Exception as e:
                 print(e)
 
-            ctf = Ctf(channel_id=channel.id, join_message_id=join_msg.id)
-            conn.add(ctf)
-
-            # edit embed to include creds
-            password = await util.ctf.generate_creds()
-            embed.add_field(
-                name="Credentials",
-                value=f"Team name: `{team_name}`\nPassword: `{password}`",
+        # the ctf is stored as soon as its channel and join message exist, the rest doesn't have to be waited on
+        async with get_session() as session:
+            ctf = Ctf(
+                channel_id=channel.id, join_message_id=join_msg.id, guild_id=ctx.guild_id,
+                finish=int(event_info["finish"].timestamp()), role_id=role.id if role else None,
             )
-            private_msg = await channel.send(embed=embed)
-            await private_msg.pin()
-
-            conn.commit()
-
-
-    @tasks.loop(seconds=1)
-    async def timecheck_task(self):
-        interval = timedelta(minutes=30)
-
-        self.timers = [i for i in self.timers if not i["expired"]]
+            session.add(ctf)
+            await session.commit()
+        join_index.add(join_msg.id, channel.id, ctf.role_id)
+
+        # announce the start, remind every interval and announce the end in the ctf channel
+        await timers.add(
+            channel.id, event_info["start"], event_info["finish"], TIMECHECK_INTERVAL, ctf_id=ctf.id,
+            announce_start=True, guild_id=ctx.guild_id,
+        )
+
+        # edit embed to include creds
+        password = await util.ctf.generate_creds()
+        embed.add_field(
+            name="Credentials",
+            value=f"Team name: `{team_name}`\nPassword: `{password}`",
+        )
+
+        async def post_credentials():
+            private_msg = await send(channel, embed=embed, priority=Priority.ACTION)
+            await request(Priority.ACTION, channel.id, private_msg.pin)
+
+        await run_all(
+            request(Priority.ACTION, join_msg.channel.id, join_msg.add_reaction, "✋"),
+            create_event(),
+            post_credentials(),
+        )
+
+    @ctf_group.command(description="Show solves per player, category and CTF across every CTF")
+    @guild_only()
+    async def stats(self, ctx: discord.ApplicationContext):
+        # counters kept up to date by the challenge commands, only the rows shown are read
+        async with get_session() as session:
+            players, categories, ctfs = await get_stats(session, ctx.guild_id)
+        await respond(ctx, embed=stats_embed(players, categories, ctfs))
+
+    @ctf_group.command(description="Archive this CTF, moving its challenges out of the active CTFs")
+    @discord.option(
+        name="lock_threads", type=bool, description="Close and lock the challenge threads",
+        default=ARCHIVE_LOCK_THREADS,
+    )
+    @discord.option(
+        name="delete_role", type=bool, description="Delete the CTF's role, hiding this channel from its members",
+        default=False,
+    )
+    @guild_only()
+    async def archive(self, ctx: discord.ApplicationContext, lock_threads: bool, delete_role: bool):
+        if not ctx.author.guild_permissions.manage_channels:
+            return await respond(ctx, "You need the Manage Channels permission to archive a CTF", ephemeral=True)
 
-        tz = pytz.timezone("Asia/Singapore")
-        for event in self.timers:
-            now = datetime.now(tz)
-
-            if now >= event["end"]:
-                await event["channel"].send("CTF has ended!")
-                event["expired"] = True
-                continue
-            elif now >= event["start"] and event["last_pinged"] and now - event["last_pinged"] >= interval:
-                event["last_pinged"] = now
-                await event["channel"].send(f"CTF ends <t:{int(event["end"].timestamp())}:R>")
-                continue
-            # elif now >= event["start"] and event["last_pinged"] <= event["start"]:
-            #     await event["channel"].send("CTF has started")
-            #     continue
+        async with get_session() as session:
+            ctf_id = await session.scalar(select(Ctf.id).where(Ctf.channel_id == ctx.channel_id))
+        if ctf_id is None:
+            return await respond(ctx, "Invalid channel!", ephemeral=True)
 
+        await ctx.defer()
+        result = await archiver.archive(ctf_id, lock_threads, delete_role)
+        if result is None:
+            return await respond(ctx, "CTF was already archived")
+
+        content = f"Archived {result.challenges} challenges"
+        if result.threads_locked:
+            content += f" and locked {result.threads_locked} threads"
+        if result.role_deleted:
+            content += ", and deleted the CTF's role"
+        await respond(ctx, content)
+
+    @ctf_group.command(description="Export every challenge thread of this CTF as a zip, e.g. for writeups")
+    @guild_only()
+    async def export(self, ctx: discord.ApplicationContext):
+        channel = ctx.channel
+        if type(channel) is not discord.TextChannel:
+            return await respond(ctx, "Invalid channel!", ephemeral=True)
+
+        # archived CTFs can be exported too
+        if join_index.is_ctf_channel(channel.id):
+            challenges = await get_challenge_rows(channel.id)
+        elif (archive := await get_archive(channel.id)) is not None:
+            challenges = archived_challenge_rows(archive)
+        else:
+            return await respond(ctx, "Invalid channel!", ephemeral=True)
+
+        # claimed before the response is awaited, so a second /ctf export can't start in between
+        if not exporter.try_start(channel.id):
+            return await respond(ctx, "An export of this CTF is already running", ephemeral=True)
+        try:
+            # the export can outlive the interaction, so the result is posted to the channel
+            await respond(ctx, f"Exporting {len(challenges)} challenges, the file will be posted here when it is done")
+            path = await exporter.export(channel, challenges)
+        except Exception:
+            logging.exception(f"Failed to export {channel.id}")
+            return await send(channel, "Export failed", priority=Priority.ACTION)
+        finally:
+            exporter.finish(channel.id)
+
+        size = os.path.getsize(path)
+        if size <= channel.guild.filesize_limit:
+            try:
+                await send(channel, "Export finished", file=discord.File(path), priority=Priority.ACTION)
+                os.remove(path)
+                return
+            except discord.HTTPException:
+                logging.exception(f"Failed to upload the export of {channel.id}")
+        await send(
+            channel,
+            f"The export is {size / 1024 / 1024:.1f} MiB, too large to upload. It was saved on the bot's host as "
+            f"`{path}`",
+            priority=Priority.ACTION,
+        )
 
     @ctf_group.command(description="Set a recurring time check for an ongoing event.")
     async def timecheck(
@@ -197,18 +359,19 @@ class ctf(commands.Cog):
         start_time: HumanReadableTime_to_Datetime,
         end_time: HumanReadableTime_to_Datetime,
     ):
-        tz = pytz.timezone("Asia/Singapore")
-        self.timers.append({
-            "start": start_time,
-            "end": end_time,
-            "channel": ctx.channel,
-            "expired": False,
-            "last_pinged": datetime.now(tz)
-        })
-        return await ctx.respond("Time check added", ephemeral=True)
+        async with get_session() as session:
+            ctf_id = await session.scalar(select(Ctf.id).where(Ctf.channel_id == ctx.channel_id))
+            if ctf_id is not None:
+                # the archive sweep goes by the latest end time
+                await session.execute(update(Ctf).where(Ctf.id == ctf_id).values(finish=int(end_time.timestamp())))
+                await session.commit()
+
+        # ping every interval once the ctf has started, then once more when it ends
+        await timers.add(
+            ctx.channel_id, start_time, end_time, TIMECHECK_INTERVAL, ctf_id=ctf_id, guild_id=ctx.guild_id
+        )
+        return await respond(ctx, "Time check added", ephemeral=True)
 
 
 def setup(bot):
-    cog = ctf(bot)
-    cog.timecheck_task.start()
-    bot.add_cog(cog)
+    bot.add_cog(ctf(bot))
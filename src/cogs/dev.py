@@ -3,7 +3,10 @@ import discord
 from discord.commands import SlashCommandGroup
 from discord.ext import commands
 
-from util.db import get_conn, Ctf
+from util.cache import join_index
+from util.db import get_session, Ctf
+from util.dispatch import respond
+from util.metrics import metrics
 
 dev_guild = os.environ.get("DEV_GUILD", None)
 
@@ -14,7 +17,6 @@ class dev(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.db = get_conn()
 
     dev_group = SlashCommandGroup(
         "dev", "Dev commands", guild_ids=[int(dev_guild)] if dev_guild else None
@@ -30,12 +32,25 @@ class dev(commands.Cog):
         join_message_id: str,
     ):
         if not ctx.author.id == self.bot.owner_id:
-            return await ctx.respond("Unauthorized", ephemeral=True)
-        with get_conn() as conn:
-            ctf = Ctf(channel_id=channel_id, join_message_id=join_message_id)
-            conn.add(ctf)
-            conn.commit()
-            await ctx.respond("Added ctf", ephemeral=True)
+            return await respond(ctx, "Unauthorized", ephemeral=True)
+        # the command may be run from another guild than the channel's
+        channel = self.bot.get_channel(int(channel_id))
+        guild_id = channel.guild.id if isinstance(channel, discord.abc.GuildChannel) else None
+        async with get_session() as session:
+            ctf = Ctf(channel_id=channel_id, join_message_id=join_message_id, guild_id=guild_id)
+            session.add(ctf)
+            await session.commit()
+        join_index.add(ctf.join_message_id, ctf.channel_id)
+        await respond(ctx, "Added ctf", ephemeral=True)
+
+    @dev_group.command(description="Show command latencies, database and Discord request counts")
+    async def stats(self, ctx: discord.ApplicationContext):
+        if not ctx.author.id == self.bot.owner_id:
+            return await respond(ctx, "Unauthorized", ephemeral=True)
+        summary = metrics.summary()
+        if len(summary) > 1900:
+            summary = summary[:1900] + "\n..."
+        await respond(ctx, f"```\n{summary}\n```", ephemeral=True)
 
 
 def setup(bot):
@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 import logging
 import os
 import time
@@ -6,29 +7,92 @@ import traceback
 import discord
 from discord import guild_only
 from discord.ext import commands
-from sqlalchemy import select
 
-from util.db import get_conn, Ctf
+import util.ctf
+from util.archive import archiver
+from util.backup import maintenance
+from util.cache import challenge_index, join_index, render_cache
+from util.chall import board
+from util.commands import command_tree_hash, restore_command_ids, save_command_ids
+from util.db import close_db, init_db
+from util.dispatch import dispatcher, respond
+from util.export import exporter
+from util.joins import join_queue
+from util.metrics import METRICS_PORT, metrics, serve
+from util.roles import CTF_ROLES, ctf_roles
+from util.scheduler import scheduler
+from util.shards import backfill_guild_ids, shard_stats, shards
+from util.threads import thread_cache
+from util.timers import timers
 
 
 username = os.environ.get("BOT_NAME", "CTF-cord v2")
 token = os.environ.get("BOT_TOKEN")
 dev_guild = os.environ.get("BOT_DEV_GUILD", None)
-logging.basicConfig(level=logging.INFO)
+# every line says which shards it came from when running one process per shard range
+logging.basicConfig(
+    level=logging.INFO,
+    format=f"%(levelname)s:[{shards.label()}] %(name)s:%(message)s" if shards.enabled else logging.BASIC_FORMAT,
+)
 intents = discord.Intents.default()
 intents.members = True
+started = time.perf_counter()
+
+class CtfCord(commands.AutoShardedBot if shards.enabled else commands.Bot):
+    metrics_runner = None
+
+    async def invoke_application_command(self, ctx: discord.ApplicationContext):
+        async with metrics.track("command", ctx.command.qualified_name):
+            await super().invoke_application_command(ctx)
+
+    async def on_connect(self):
+        # replaces the unconditional sync in commands.Bot.on_connect
+        async with phase("commands"):
+            digest = command_tree_hash(self)
+            if restore_command_ids(self, digest):
+                logging.info("Command tree unchanged, skipping sync")
+            else:
+                await self.sync_commands()
+                save_command_ids(self, digest)
+            help_embeds[False] = build_help_embed(False)
+            help_embeds[True] = build_help_embed(True)
 
-bot = commands.Bot(
+    async def close(self):
+        maintenance.stop()
+        archiver.stop()
+        util.ctf.upcoming.stop()
+        scheduler.stop()
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+        await util.ctf.ctftime.close()
+        await super().close()
+        dispatcher.close()
+        await close_db()
+
+bot = CtfCord(
     case_insensitive=True,
     description="CTF management Discord bot",
     intents=intents,
+    **({"shard_count": shards.count, "shard_ids": shards.ids} if shards.enabled else {}),
 )
 
 @bot.event
+@metrics.instrument("listener")
 async def on_ready():
     assert bot.user is not None
-    await bot.user.edit(username=username)
-    logging.info("Bot is running")
+    if bot.user.name != username:
+        await bot.user.edit(username=username)
+    await backfill_guild_ids(bot)
+    # timers that fell due while the bot was down fire now, once their channels are cached
+    scheduler.start()
+    if CTF_ROLES:
+        # in the background, each CTF moved onto a role is a burst of role changes
+        ctf_roles.start_migration(bot)
+    logging.info(f"Bot is running, ready {time.perf_counter() - started:.1f}s after start")
+
+@bot.event
+async def on_shard_ready(shard_id: int):
+    logging.info(f"Shard {shard_id} ready {time.perf_counter() - started:.1f}s after start")
 
 # error fallback
 @bot.event
@@ -36,88 +100,173 @@ async def on_application_command_error(ctx, e):
     message = "Sorry, something went wrong."
     print(f'ERROR!\n----------\n{ctx.author.name} ({ctx.author.id}) at {time.strftime("%H%M")}:\n')
     traceback.print_exception(type(e), e, e.__traceback__)
+    if ctx.command is not None:
+        metrics.record_error("command", ctx.command.qualified_name)
     print("----------")
-    await ctx.respond(message, ephemeral=True)
+    await respond(ctx, message, ephemeral=True)
 
-@guild_only()
-@bot.slash_command(description="Usage instructions", guild_ids=[int(dev_guild)] if dev_guild else None)
-async def help(ctx: discord.ApplicationContext):
+def build_help_embed(in_ctf: bool) -> discord.Embed:
     embed = discord.Embed(
         title="Usage",
         colour=discord.Colour.blurple()
     )
 
-    if type(ctx.channel) is discord.Thread:
-        channel = ctx.channel.parent
+    value = ""
+    if not in_ctf:
+        ctf_cog = bot.get_cog("ctf")
+        assert ctf_cog is not None
+
+        ctf_group = ctf_cog.get_commands()[0]
+        assert type(ctf_group) is discord.SlashCommandGroup
+        ctf_commands = {c.name: c for c in ctf_group.walk_commands()}
+        ctf_details, ctf_add = ctf_commands["details"], ctf_commands["add"]
+        ctf_upcoming, ctf_stats = ctf_commands["upcoming"], ctf_commands["stats"]
+        assert type(ctf_add) is discord.SlashCommand
+        assert type(ctf_stats) is discord.SlashCommand
+        assert type(ctf_details) is discord.SlashCommand
+        assert type(ctf_upcoming) is discord.SlashCommand
+
+        value += f"**Adding CTFs**\n"
+
+        value += f"{ctf_upcoming.mention}\n"
+        value += "List CTFs starting soon on CTFtime, optionally only of one format."
+        value += "\n\n"
+
+        value += f"{ctf_details.mention}\n"
+        value += "Scrape details from CTFtime and display in the channel."
+        value += "\n\n"
+
+        value += f"{ctf_add.mention}\n"
+        value += ("Create a private channel which participating members can opt-in to join, and a scheduled "
+        "Discord event based on the start and end time stated in CTFtime. Auto-generated credentials will be "
+        "provided in the private channel. Can only be invoked on CTFs that are not yet over.")
+        value += "\n\n"
+
+        value += f"{ctf_stats.mention}\n"
+        value += "Show the top solvers, solves per category and recent CTFs, with the average time to solve."
     else:
-        channel = ctx.channel
+        chall_cog = bot.get_cog("chall")
+        assert chall_cog is not None
 
-    if channel is None:
-        return await ctx.respond("Invalid channel!")
+        chall_group = chall_cog.get_commands()[0]
+        assert type(chall_group) is discord.SlashCommandGroup
+
+        chall_commands = {c.name: c for c in chall_group.walk_commands()}
+        chall_add, chall_remove = chall_commands["add"], chall_commands["remove"]
+        chall_solve, chall_lst, chall_import = chall_commands["solve"], chall_commands["list"], chall_commands["import"]
+
+        assert type(chall_add) is discord.SlashCommand
+        assert type(chall_remove) is discord.SlashCommand
+        assert type(chall_solve) is discord.SlashCommand
+        assert type(chall_lst) is discord.SlashCommand
+        assert type(chall_import) is discord.SlashCommand
+
+        value += "**Managing challenges**\n"
+        value += "*In this channel and within challenge threads, you can invoke commands to manage challenges*"
+        value += "\n\n"
+
+        value += f"{chall_add.mention}\n"
+        value += ("Indicate yourself as working on a new challenge, and create a thread for it. If the challenge "
+        "has already been added, the `category` parameter can be omitted, and you will be added to the list of "
+        "people working on the challenge.")
+        value += "\n\n"
 
-    with get_conn() as conn:
-        ctf = conn.scalar(select(Ctf).where(Ctf.channel_id == channel.id))
-        value = ""
-        if not ctf:
-            ctf_cog = ctx.bot.get_cog("ctf")
-            assert ctf_cog is not None
+        value += f"{chall_solve.mention}\n"
+        value += ("Mark a challenge as solved. If the challenge has already been solved, you will be added to the "
+        "list of people who solved the challenge. If invoked in the challenge's thread, the `name` parameter is "
+        "optional. If the challenge has not been added before, the `category` parameter is required.")
+        value += "\n\n"
 
-            ctf_group = ctf_cog.get_commands()[0]
-            assert type(ctf_group) is discord.SlashCommandGroup
-            [ctf_details, ctf_add] = ctf_group.walk_commands()
-            assert type(ctf_add) is discord.SlashCommand
-            assert type(ctf_details) is discord.SlashCommand
+        value += f"{chall_lst.mention}\n"
+        value += "View the current list of challenges in progress and challenges solved by category."
+        value += "\n\n"
 
-            value += f"**Adding CTFs**\n"
+        value += f"{chall_import.mention}\n"
+        value += ("Add many challenges at once from an attached file, either a CTFd challenge list in JSON or a CSV "
+        "file with `name` and `category` columns. A thread is created for each challenge.")
+        value += "\n\n"
 
-            value += f"{ctf_details.mention}\n"
-            value += "Scrape details from CTFtime and display in the channel."
-            value += "\n\n"
+        value += f"{chall_remove.mention}\n"
+        value += "Remove a challenge and delete its thread."
+        value += "\n\n"
 
-            value += f"{ctf_add.mention}\n"
-            value += ("Create a private channel which participating members can opt-in to join, and a scheduled "
-            "Discord event based on the start and end time stated in CTFtime. Auto-generated credentials will be "
-            "provided in the private channel. Can only be invoked on CTFs that are not yet over.")
-        else:
-            chall_cog = ctx.bot.get_cog("chall")
-            assert chall_cog is not None
+        ctf_cog = bot.get_cog("ctf")
+        assert ctf_cog is not None
+        ctf_commands = {c.name: c for c in ctf_cog.get_commands()[0].walk_commands()}
+        ctf_export, ctf_archive = ctf_commands["export"], ctf_commands["archive"]
+        assert type(ctf_export) is discord.SlashCommand
+        assert type(ctf_archive) is discord.SlashCommand
 
-            chall_group = chall_cog.get_commands()[0]
-            assert type(chall_group) is discord.SlashCommandGroup
+        value += f"{ctf_export.mention}\n"
+        value += ("Export the messages and attachments of every challenge thread as a zip file, e.g. for writing "
+        "up. The file is posted in this channel when it is ready.")
+        value += "\n\n"
 
-            [chall_add, chall_remove, chall_solve, chall_lst] = chall_group.walk_commands()
+        value += f"{ctf_archive.mention}\n"
+        value += ("Archive the CTF once it is over and optionally lock its challenge threads. Finished CTFs are also "
+        "archived automatically. The challenge list stays available with /chall list, and the members of a CTF "
+        "with a role keep access to the channel unless the role is deleted with `delete_role`.")
 
-            assert type(chall_add) is discord.SlashCommand
-            assert type(chall_remove) is discord.SlashCommand
-            assert type(chall_solve) is discord.SlashCommand
-            assert type(chall_lst) is discord.SlashCommand
+    embed.description = value
+    return embed
 
-            value += "**Managing challenges**\n"
-            value += "*In this channel and within challenge threads, you can invoke commands to manage challenges*"
-            value += "\n\n"
+# built once the command ids are known, see on_connect
+help_embeds: dict[bool, discord.Embed] = {}
 
-            value += f"{chall_add.mention}\n"
-            value += ("Indicate yourself as working on a new challenge, and create a thread for it. If the challenge "
-            "has already been added, the `category` parameter can be omitted, and you will be added to the list of "
-            "people working on the challenge.")
-            value += "\n\n"
+@guild_only()
+@bot.slash_command(description="Usage instructions", guild_ids=[int(dev_guild)] if dev_guild else None)
+async def help(ctx: discord.ApplicationContext):
+    if type(ctx.channel) is discord.Thread:
+        channel = ctx.channel.parent
+    else:
+        channel = ctx.channel
 
-            value += f"{chall_solve.mention}\n"
-            value += ("Mark a challenge as solved. If the challenge has already been solved, you will be added to the "
-            "list of people who solved the challenge. If invoked in the challenge's thread, the `name` parameter is "
-            "optional. If the challenge has not been added before, the `category` parameter is required.")
-            value += "\n\n"
+    if channel is None:
+        return await respond(ctx, "Invalid channel!")
 
-            value += f"{chall_lst.mention}\n"
-            value += "View the current list of challenges in progress and challenges solved by category."
-            value += "\n\n"
+    in_ctf = join_index.is_ctf_channel(channel.id)
+    embed = help_embeds.get(in_ctf) or build_help_embed(in_ctf)
+    await respond(ctx, embed=embed)
 
-            value += f"{chall_remove.mention}\n"
-            value += "Remove a challenge and delete its thread."
+@asynccontextmanager
+async def phase(name: str):
+    start = time.perf_counter()
+    async with metrics.track("startup", name):
+        yield
+    logging.info(f"Startup: {name} took {(time.perf_counter() - start) * 1000:.0f}ms")
 
-        embed.description = value
+async def startup():
+    # everything the handlers read is loaded before connecting, so the first events are served from memory
+    async with phase("database"):
+        await init_db()
+    async with phase("caches"):
+        await join_index.load()
+        await challenge_index.load()
+    async with phase("timers"):
+        await timers.load(bot)
+    async with phase("upcoming"):
+        util.ctf.upcoming.load()
+    maintenance.start()
+    archiver.start(bot)
+    util.ctf.upcoming.start()
 
-        await ctx.respond(embed=embed)
+    metrics.attach_http(bot.http)
+    metrics.register("ctftime_cache", util.ctf.ctftime.stats)
+    metrics.register("upcoming", util.ctf.upcoming.stats)
+    metrics.register("dispatch", dispatcher.stats)
+    metrics.register("join_queue", join_queue.stats)
+    metrics.register("board", board.stats)
+    metrics.register("render_cache", render_cache.stats)
+    metrics.register("threads", thread_cache.stats)
+    metrics.register("scheduler", scheduler.stats)
+    metrics.register("storage", maintenance.stats)
+    metrics.register("archive", archiver.stats)
+    metrics.register("export", exporter.stats)
+    metrics.register("roles", ctf_roles.stats)
+    if shards.enabled:
+        metrics.register("shard", lambda: shard_stats(bot))
+    if METRICS_PORT:
+        bot.metrics_runner = await serve(int(METRICS_PORT))
 
 def cmd(cog: commands.Cog, command: str) -> discord.ApplicationCommand:
     available_commands = cog.get_commands()
@@ -128,4 +277,5 @@ if __name__ == "__main__":
     bot.load_extension("cogs.dev")
     bot.load_extension("cogs.chall")
 
+    bot.loop.run_until_complete(startup())
     bot.run(token)
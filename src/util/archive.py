@@ -0,0 +1,250 @@
+"""
+Archive mode: finished CTFs are moved out of the live tables into one compressed row each.
+
+A CTF's challenges and their members are serialised into the archives table and deleted from ctfs, challenges,
+chall_to_members and timers in one transaction, so the tables every command queries only hold active CTFs. The
+solve statistics are counters of their own and are left as they are, and /chall list in an archived channel is
+answered from the archive. The members' role of a role-based CTF is kept, as it is their only access to the
+channel, unless /ctf archive is asked to delete it (see util.roles).
+"""
+import asyncio
+from dataclasses import dataclass
+import json
+import logging
+import os
+import time
+from typing import Any
+import zlib
+
+import discord
+from sqlalchemy import delete, desc, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+
+from util.cache import challenge_index, join_index, render_cache
+from util.chall import ChallengeRow, board
+from util.db import Archive, Challenge, Ctf, Timer, chall_to_members, get_session
+from util.dispatch import Priority, request, run_all
+from util.roles import ctf_roles
+from util.scheduler import Job, scheduler
+from util.shards import shards
+from util.threads import thread_cache
+from util.timers import timers
+
+ARCHIVE_AFTER = float(os.environ.get("ARCHIVE_AFTER", 24 * 60 * 60))
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", 60 * 60))
+ARCHIVE_LOCK_THREADS = os.environ.get("ARCHIVE_LOCK_THREADS", "1") != "0"
+
+
+@dataclass
+class ArchiveResult:
+    challenges: int
+    threads_locked: int = 0
+    role_deleted: bool = False
+
+
+def dump_archive(ctf: Ctf, challenges: list[Challenge]) -> bytes:
+    data = {
+        "ctf": {
+            "id": ctf.id,
+            "channel_id": ctf.channel_id,
+            "join_message_id": ctf.join_message_id,
+            "board_message_id": ctf.board_message_id,
+            "guild_id": ctf.guild_id,
+            "finish": ctf.finish,
+            "role_id": ctf.role_id,
+        },
+        "challenges": [
+            {
+                "id": c.id,
+                "name": c.name,
+                "category": c.category,
+                "solved": c.solved,
+                "thread_id": c.thread_id,
+                "added_at": c.added_at,
+                "solved_at": c.solved_at,
+                "members": [user.id for user in c.members],
+            }
+            for c in challenges
+        ],
+    }
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode(), 9)
+
+
+def load_archive(data: bytes) -> dict[str, Any]:
+    return json.loads(zlib.decompress(data))
+
+
+async def get_archive(channel_id: int) -> dict[str, Any] | None:
+    """
+    The most recent archive of the CTF in `channel_id`.
+    """
+    async with get_session() as session:
+        data = await session.scalar(
+            select(Archive.data).where(Archive.channel_id == channel_id).order_by(desc(Archive.ctf_id)).limit(1)
+        )
+    return load_archive(data) if data is not None else None
+
+
+def archived_challenge_rows(archive: dict[str, Any]) -> list[ChallengeRow]:
+    # in the same order as get_challenge_rows
+    challenges = sorted(archive["challenges"], key=lambda c: (c["category"], c["id"]))
+    return [
+        ChallengeRow(c["id"], c["name"], c["category"], c["solved"], c["thread_id"], c["members"])
+        for c in challenges
+    ]
+
+
+class Archiver:
+    """
+    Archives CTFs on request and, every `interval` seconds, every CTF that finished more than `after` seconds ago.
+    An interval of 0 disables the sweep.
+    """
+
+    def __init__(
+        self,
+        after: float = ARCHIVE_AFTER,
+        interval: float = ARCHIVE_INTERVAL,
+        lock_threads: bool = ARCHIVE_LOCK_THREADS,
+    ):
+        self.after = after
+        self.interval = interval
+        self.lock_threads = lock_threads
+
+        self.archived = 0
+        self.threads_locked = 0
+        self.failed = 0
+
+        self.bot: discord.Client | None = None
+        self._job: Job | None = None
+
+    def start(self, bot: discord.Client):
+        self.bot = bot
+        if self.interval > 0:
+            self._job = scheduler.schedule(time.time() + self.interval, self._run)
+
+    def stop(self):
+        if self._job is not None:
+            scheduler.cancel(self._job)
+            self._job = None
+
+    def stats(self) -> dict[str, int]:
+        return {"archived": self.archived, "threads_locked": self.threads_locked, "failed": self.failed}
+
+    async def _run(self):
+        self._job = scheduler.schedule(time.time() + self.interval, self._run)
+        try:
+            await self.sweep()
+        except Exception:
+            self.failed += 1
+            logging.exception("Archive sweep failed")
+
+    async def sweep(self) -> int:
+        """
+        Archive every finished CTF of this process's shards. Returns how many were archived.
+        """
+        cutoff = int(time.time() - self.after)
+        async with get_session() as session:
+            ctf_ids = (
+                await session.scalars(
+                    select(Ctf.id).where(Ctf.finish.is_not(None), Ctf.finish <= cutoff, shards.filter(Ctf.guild_id))
+                )
+            ).all()
+
+        archived = 0
+        # one at a time, each CTF's thread edits are already a burst of their own
+        for ctf_id in ctf_ids:
+            if await self.archive(ctf_id, self.lock_threads) is not None:
+                archived += 1
+        if archived:
+            logging.info(f"Archived {archived} finished CTFs")
+        return archived
+
+    async def archive(
+        self, ctf_id: int, lock_threads: bool | None = None, delete_role: bool = False
+    ) -> ArchiveResult | None:
+        """
+        Move a CTF into the archive. Returns None if it doesn't exist, e.g. because it was archived already.
+
+        Deleting the role of a role-based CTF hides the channel from everyone who took part, so the sweep never does.
+        """
+        async with get_session() as session:
+            ctf = await session.get(Ctf, ctf_id)
+            if ctf is None:
+                return None
+            challenges = (
+                await session.scalars(
+                    select(Challenge).where(Challenge.ctf_id == ctf_id).options(selectinload(Challenge.members))
+                )
+            ).all()
+            challenge_ids = [c.id for c in challenges]
+            # their jobs are cancelled once the rows are gone
+            timer_ids = (await session.scalars(select(Timer.id).where(Timer.ctf_id == ctf_id))).all()
+
+            session.add(
+                Archive(
+                    ctf_id=ctf.id,
+                    channel_id=ctf.channel_id,
+                    guild_id=ctf.guild_id,
+                    archived_at=int(time.time()),
+                    data=dump_archive(ctf, list(challenges)),
+                )
+            )
+            await session.execute(delete(chall_to_members).where(chall_to_members.c.Challenge.in_(challenge_ids)))
+            await session.execute(delete(Challenge).where(Challenge.ctf_id == ctf_id))
+            await session.execute(delete(Timer).where(Timer.ctf_id == ctf_id))
+            await session.execute(delete(Ctf).where(Ctf.id == ctf_id))
+            try:
+                await session.commit()
+            except IntegrityError:
+                # another process archived it first
+                return None
+
+        join_index.remove(ctf.join_message_id)
+        challenge_index.forget(ctf.channel_id)
+        render_cache.forget(ctf.channel_id)
+        board.forget(ctf.channel_id)
+        timers.cancel(timer_ids)
+        self.archived += 1
+
+        result = ArchiveResult(len(challenges))
+        channel = self.bot.get_channel(ctf.channel_id) if self.bot is not None else None
+        guild = self.bot.get_guild(ctf.guild_id) if self.bot is not None and ctf.guild_id is not None else None
+
+        async def close():
+            if type(channel) is discord.TextChannel and (self.lock_threads if lock_threads is None else lock_threads):
+                thread_ids = {c.thread_id for c in challenges if c.thread_id}
+                result.threads_locked = await self.close_threads(channel, thread_ids)
+
+        async def remove_role():
+            # one request takes the role from every member, instead of an overwrite edit per member
+            if delete_role and ctf.role_id is not None and guild is not None:
+                result.role_deleted = await ctf_roles.delete(guild, [ctf.role_id]) > 0
+
+        await run_all(close(), remove_role())
+        thread_cache.forget(ctf.channel_id)
+        return result
+
+    async def close_threads(self, channel: discord.TextChannel, thread_ids: set[int]) -> int:
+        """
+        Archive and lock the given threads of a channel concurrently. Returns how many were changed.
+        """
+        threads = await thread_cache.threads(channel)
+        targets = [
+            thread
+            for thread_id, thread in threads.items()
+            if thread_id in thread_ids and not (thread.archived and thread.locked)
+        ]
+        results = await asyncio.gather(
+            *(request(Priority.UPDATE, thread.id, thread.edit, archived=True, locked=True) for thread in targets),
+            return_exceptions=True,
+        )
+        failed = [r for r in results if isinstance(r, BaseException)]
+        for error in failed:
+            logging.warning(f"Failed to lock a challenge thread in {channel.id}: {error}")
+        locked = len(targets) - len(failed)
+        self.threads_locked += locked
+        return locked
+
+
+archiver = Archiver()
@@ -0,0 +1,130 @@
+"""
+Background database maintenance: WAL checkpoints and online backup snapshots, both run from the scheduler so that
+no command's commit has to pay for them.
+"""
+import asyncio
+from datetime import datetime, timezone
+import logging
+import os
+import sqlite3
+import time
+
+from sqlalchemy import text
+
+from util.db import SQLITE_CHECKPOINT_INTERVAL, SQLITE_JOURNAL_MODE, get_database_file, get_session
+from util.scheduler import Job, scheduler
+
+SQLITE_BACKUP_INTERVAL = float(os.environ.get("SQLITE_BACKUP_INTERVAL", 6 * 60 * 60))
+SQLITE_BACKUP_DIR = os.environ.get("SQLITE_BACKUP_DIR")
+SQLITE_BACKUP_KEEP = int(os.environ.get("SQLITE_BACKUP_KEEP", 7))
+
+
+class Maintenance:
+    """
+    Runs a passive WAL checkpoint every `checkpoint_interval` seconds and writes a snapshot of the database to
+    `backup_dir` every `backup_interval` seconds, keeping the newest `keep` snapshots. An interval of 0 disables
+    the job.
+
+    Snapshots are taken with the sqlite3 backup API on a separate connection in a worker thread. In WAL mode the
+    snapshot only holds a read lock, so the bot keeps writing while it runs.
+    """
+
+    def __init__(
+        self,
+        checkpoint_interval: float = SQLITE_CHECKPOINT_INTERVAL,
+        backup_interval: float = SQLITE_BACKUP_INTERVAL,
+        backup_dir: str | None = SQLITE_BACKUP_DIR,
+        keep: int = SQLITE_BACKUP_KEEP,
+    ):
+        self.checkpoint_interval = checkpoint_interval
+        self.backup_interval = backup_interval
+        self.backup_dir = backup_dir
+        self.keep = keep
+
+        self.checkpoints = 0
+        self.wal_pages = 0
+        self.backups = 0
+        self.failed = 0
+        self.last_backup: float | None = None
+
+        self._jobs: dict[str, Job] = {}
+
+    def start(self):
+        if self.checkpoint_interval > 0 and SQLITE_JOURNAL_MODE == "WAL":
+            self._every("checkpoint", self.checkpoint_interval, self.checkpoint)
+        if self.backup_interval > 0:
+            self._every("backup", self.backup_interval, self.backup)
+
+    def stop(self):
+        for job in self._jobs.values():
+            scheduler.cancel(job)
+        self._jobs.clear()
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "checkpoints": self.checkpoints,
+            "wal_pages": self.wal_pages,
+            "backups": self.backups,
+            "failed": self.failed,
+            "last_backup_age": time.time() - self.last_backup if self.last_backup else -1,
+        }
+
+    def _every(self, name: str, interval: float, job):
+        async def run():
+            self._jobs[name] = scheduler.schedule(time.time() + interval, run)
+            try:
+                await job()
+            except Exception:
+                self.failed += 1
+                logging.exception(f"Database {name} failed")
+
+        self._jobs[name] = scheduler.schedule(time.time() + interval, run)
+
+    async def checkpoint(self) -> tuple[int, int, int]:
+        """
+        Copy committed pages from the WAL back into the database without waiting on readers or writers. Returns
+        SQLite's (busy, wal pages, checkpointed pages).
+        """
+        async with get_session() as session:
+            busy, log, checkpointed = (await session.execute(text("PRAGMA wal_checkpoint(PASSIVE)"))).one()
+        self.checkpoints += 1
+        self.wal_pages = log
+        return busy, log, checkpointed
+
+    async def backup(self) -> str:
+        """
+        Write a snapshot of the database and prune old ones. Returns the snapshot's path.
+        """
+        source = get_database_file()
+        backup_dir = self.backup_dir or os.path.join(os.path.dirname(source), "backups")
+        os.makedirs(backup_dir, exist_ok=True)
+
+        name = f"data-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.db"
+        path = os.path.join(backup_dir, name)
+        await asyncio.to_thread(snapshot, source, path)
+        self.backups += 1
+        self.last_backup = time.time()
+
+        snapshots = sorted(f for f in os.listdir(backup_dir) if f.startswith("data-") and f.endswith(".db"))
+        for old in snapshots[: max(0, len(snapshots) - self.keep)]:
+            os.remove(os.path.join(backup_dir, old))
+        return path
+
+
+def snapshot(source: str, destination: str):
+    # copy everything in one step so the snapshot is consistent, into a temporary file so a crash never leaves a
+    # half-written backup behind
+    partial = destination + ".partial"
+    src = sqlite3.connect(source)
+    try:
+        dst = sqlite3.connect(partial)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    os.replace(partial, destination)
+
+
+maintenance = Maintenance()
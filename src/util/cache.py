@@ -0,0 +1,239 @@
+"""
+In-memory indexes over the database. They are loaded once at startup and kept up to date by the handlers that write
+the underlying rows, so hot paths can answer without a query.
+"""
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import os
+
+import discord
+from sqlalchemy import select
+
+from util.db import Challenge, Ctf, get_session
+from util.metrics import metrics
+from util.shards import shards
+
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", 64))
+
+
+class JoinIndex:
+    """
+    Maps join message ids to their CTF channel ids, so the reaction listeners can ignore reactions on every other
+    message without touching the database. Also answers whether a channel is a CTF channel, and which role its
+    members get if it uses one.
+    """
+
+    def __init__(self):
+        self._channels: dict[int, int] = {}
+        self._ctf_channels: dict[int, int] = {}  # channel id -> number of join messages
+        self._roles: dict[int, int] = {}  # channel id -> role id
+
+    async def load(self):
+        async with get_session() as session:
+            rows = await session.execute(
+                select(Ctf.join_message_id, Ctf.channel_id, Ctf.role_id).where(shards.filter(Ctf.guild_id))
+            )
+            self._channels = {}
+            self._ctf_channels = {}
+            self._roles = {}
+            for join_message_id, channel_id, role_id in rows:
+                self.add(join_message_id, channel_id, role_id)
+
+    def add(self, join_message_id: int, channel_id: int, role_id: int | None = None):
+        self.remove(join_message_id)
+        self._channels[join_message_id] = channel_id
+        self._ctf_channels[channel_id] = self._ctf_channels.get(channel_id, 0) + 1
+        if role_id is not None:
+            self._roles[channel_id] = role_id
+
+    def remove(self, join_message_id: int):
+        channel_id = self._channels.pop(join_message_id, None)
+        if channel_id is None:
+            return
+        self._ctf_channels[channel_id] -= 1
+        if not self._ctf_channels[channel_id]:
+            del self._ctf_channels[channel_id]
+            self._roles.pop(channel_id, None)
+
+    def set_role(self, channel_id: int, role_id: int):
+        if channel_id in self._ctf_channels:
+            self._roles[channel_id] = role_id
+
+    def role(self, channel_id: int) -> int | None:
+        return self._roles.get(channel_id)
+
+    def get(self, join_message_id: int) -> int | None:
+        return self._channels.get(join_message_id)
+
+    def is_ctf_channel(self, channel_id: int) -> bool:
+        return channel_id in self._ctf_channels
+
+    def __contains__(self, join_message_id: int) -> bool:
+        return join_message_id in self._channels
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+
+
+class ChallengeIndex:
+    """
+    Challenge names and solved flags per CTF channel, for autocomplete.
+
+    Names are kept sorted by their lowercase form so prefix matches are found by bisection, and the rest of the list
+    is scanned for substring matches. Results are ranked exact > prefix > word prefix > substring.
+    """
+
+    def __init__(self):
+        self._solved: dict[int, dict[str, bool]] = {}
+        self._sorted: dict[int, list[tuple[str, str]]] = {}
+
+    async def load(self):
+        async with get_session() as session:
+            rows = await session.execute(
+                select(Ctf.channel_id, Challenge.name, Challenge.solved).join(Ctf).where(shards.filter(Ctf.guild_id))
+            )
+            self._solved = {}
+            self._sorted = {}
+            for channel_id, name, solved in rows:
+                self._solved.setdefault(channel_id, {})[name] = solved
+            for channel_id, names in self._solved.items():
+                self._sorted[channel_id] = sorted((name.lower(), name) for name in names)
+
+    def add(self, channel_id: int, name: str, solved: bool = False):
+        names = self._solved.setdefault(channel_id, {})
+        if name not in names:
+            insort(self._sorted.setdefault(channel_id, []), (name.lower(), name))
+        names[name] = solved
+
+    def set_solved(self, channel_id: int, name: str, solved: bool = True):
+        self.add(channel_id, name, solved)
+
+    def remove(self, channel_id: int, name: str):
+        names = self._solved.get(channel_id, {})
+        if names.pop(name, None) is None:
+            return
+        entries = self._sorted[channel_id]
+        del entries[bisect_left(entries, (name.lower(), name))]
+
+    def forget(self, channel_id: int):
+        self._solved.pop(channel_id, None)
+        self._sorted.pop(channel_id, None)
+
+    def search(self, channel_id: int, text: str, unsolved_only: bool = False, limit: int = 25) -> list[str]:
+        solved = self._solved.get(channel_id, {})
+        entries = self._sorted.get(channel_id, [])
+        query = text.strip().lower()
+
+        if not query:
+            return [name for _, name in entries if not (unsolved_only and solved[name])][:limit]
+
+        ranked: list[tuple[int, int, str, str]] = []
+
+        # prefix matches are one contiguous run of the sorted list
+        start = bisect_left(entries, (query, ""))
+        end = start
+        while end < len(entries) and entries[end][0].startswith(query):
+            lower, name = entries[end]
+            if not (unsolved_only and solved[name]):
+                ranked.append((0 if lower == query else 1, len(lower), lower, name))
+            end += 1
+
+        for lower, name in entries[:start] + entries[end:]:
+            if unsolved_only and solved[name]:
+                continue
+            index = lower.find(query)
+            if index == -1:
+                continue
+            word_start = not lower[index - 1].isalnum()
+            ranked.append((2 if word_start else 3, len(lower), lower, name))
+
+        ranked.sort()
+        return [name for *_, name in ranked[:limit]]
+
+
+class RenderCache:
+    """
+    Rendered challenge board pages per CTF channel.
+
+    Each channel has a version that is bumped after every write to its challenges or their members, and pages are
+    cached under (channel id, version), so a bump makes the old entry unreachable without having to invalidate it.
+    At most `maxsize` entries are kept, least recently used first out.
+    """
+
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._versions: dict[int, int] = {}
+        self._pages: OrderedDict[tuple[int, int], list[str]] = OrderedDict()
+
+    def version(self, channel_id: int) -> int:
+        return self._versions.get(channel_id, 0)
+
+    def bump(self, channel_id: int):
+        version = self.version(channel_id)
+        self._pages.pop((channel_id, version), None)
+        self._versions[channel_id] = version + 1
+
+    def get(self, channel_id: int) -> list[str] | None:
+        key = (channel_id, self.version(channel_id))
+        pages = self._pages.get(key)
+        if pages is None:
+            self.misses += 1
+            return None
+        self._pages.move_to_end(key)
+        self.hits += 1
+        return pages
+
+    def put(self, channel_id: int, version: int, pages: list[str]):
+        if version != self.version(channel_id):
+            # rendered from rows that were written to since
+            return
+        self._pages[(channel_id, version)] = pages
+        self._pages.move_to_end((channel_id, version))
+        while len(self._pages) > self.maxsize:
+            self._pages.popitem(last=False)
+
+    def forget(self, channel_id: int):
+        self._pages.pop((channel_id, self.version(channel_id)), None)
+        self._versions.pop(channel_id, None)
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._pages),
+        }
+
+
+join_index = JoinIndex()
+challenge_index = ChallengeIndex()
+render_cache = RenderCache()
+
+
+def ctf_channel_id(ctx: discord.AutocompleteContext) -> int | None:
+    # autocomplete can be invoked from a challenge thread, the index is keyed by the ctf channel
+    channel = ctx.interaction.channel
+    if type(channel) is discord.Thread:
+        return channel.parent_id
+    return ctx.interaction.channel_id
+
+
+@metrics.instrument("autocomplete")
+async def get_all_challs_from_ctx(ctx: discord.AutocompleteContext):
+    channel_id = ctf_channel_id(ctx)
+    if channel_id is None:
+        return []
+    return challenge_index.search(channel_id, ctx.value or "")
+
+
+@metrics.instrument("autocomplete")
+async def get_unsolved_challs_from_ctx(ctx: discord.AutocompleteContext):
+    channel_id = ctf_channel_id(ctx)
+    if channel_id is None:
+        return []
+    return challenge_index.search(channel_id, ctx.value or "", unsolved_only=True)
@@ -1,43 +1,292 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+from typing import Callable, Mapping, NamedTuple
+
 import discord
 from discord.ext import pages
-from sqlalchemy import select
-
-from util.db import get_conn, Challenge
-
-async def get_challenge_paginator(ctx: discord.ApplicationContext, channel_id: int) -> pages.Paginator:
-    with get_conn() as conn:
-        challenges = conn.scalars(
-            select(Challenge).where(Challenge.ctf.has(channel_id=channel_id)).order_by(Challenge.category)
-        ).all()
-
-        out: list[str] = [""]
-        index = 0
-
-        cur_cat = ""
-        for c in challenges:
-            if c.category != cur_cat:
-                cur_cat = c.category
-                out[index] += f"\n**{c.category}**\n"
-            elif len(out[index]) > 3000:  # only if not new category - we don't want double headers
-                index += 1
-                out.append(f"\n**{c.category}**\n")
-
-            # if thread exists, use the jump_url as title
-            thread = ctx.bot.get_channel(c.thread_id)
-            if not thread or type(thread) is not discord.Thread:
-                if c.solved:
-                    label = f"`{c.category}/{c.name} [SOLVED]`"
-                else:
-                    label = f"`{c.category}/{c.name}`"
-            else:
-                label = thread.jump_url
+from sqlalchemy import func, select, update
+
+from util.cache import render_cache
+from util.db import get_session, chall_to_members, Challenge, Ctf
+from util.dispatch import Priority, edit, request, send
+from util.threads import thread_cache
+
+BOARD_DEBOUNCE = float(os.environ.get("BOARD_DEBOUNCE", 3))
+IMPORT_CONCURRENCY = int(os.environ.get("IMPORT_CONCURRENCY", 3))
+
+
+class ChallengeRow(NamedTuple):
+    id: int
+    name: str
+    category: str
+    solved: bool
+    thread_id: int
+    member_ids: list[int]
 
-            user_list = "+".join([f"<@{user.id}>" for user in c.worked_on])
 
+async def get_challenge_rows(channel_id: int) -> list[ChallengeRow]:
+    """
+    Every challenge of the CTF in `channel_id` with its member ids, in one aggregate query.
+    """
+    async with get_session() as session:
+        rows = await session.execute(
+            select(
+                Challenge.id,
+                Challenge.name,
+                Challenge.category,
+                Challenge.solved,
+                Challenge.thread_id,
+                func.group_concat(chall_to_members.c.User),
+            )
+            .join(Ctf)
+            .outerjoin(chall_to_members, chall_to_members.c.Challenge == Challenge.id)
+            .where(Ctf.channel_id == channel_id)
+            .group_by(Challenge.id)
+            .order_by(Challenge.category, Challenge.id)
+        )
+        return [
+            ChallengeRow(id, name, category, solved, thread_id, [int(m) for m in members.split(",")] if members else [])
+            for id, name, category, solved, thread_id, members in rows
+        ]
+
+
+def render_challenge_pages(rows: list[ChallengeRow], threads: Mapping[int, discord.Thread]) -> list[str]:
+    out: list[str] = [""]
+    index = 0
+
+    cur_cat = ""
+    for c in rows:
+        if c.category != cur_cat:
+            cur_cat = c.category
+            out[index] += f"\n**{c.category}**\n"
+        elif len(out[index]) > 3000:  # only if not new category - we don't want double headers
+            index += 1
+            out.append(f"\n**{c.category}**\n")
+
+        # if thread exists, use the jump_url as title
+        thread = threads.get(c.thread_id)
+        if not thread:
             if c.solved:
-                out[index] += f"{label} ({user_list})\n"
+                label = f"`{c.category}/{c.name} [SOLVED]`"
             else:
-                out[index] += f"{label} ({user_list})\n"
+                label = f"`{c.category}/{c.name}`"
+        else:
+            label = thread.jump_url
+
+        user_list = "+".join([f"<@{user_id}>" for user_id in c.member_ids])
+
+        out[index] += f"{label} ({user_list})\n"
+
+    return out
+
+
+async def render_challenges(channel: discord.TextChannel) -> list[str]:
+    """
+    Rendered pages for a CTF channel, from the render cache unless its challenges or threads changed since.
+    """
+    out = render_cache.get(channel.id)
+    if out is None:
+        # read the version first, a write that lands during the query bumps it and the result is not cached
+        version = render_cache.version(channel.id)
+        rows = await get_challenge_rows(channel.id)
+        out = render_challenge_pages(rows, await thread_cache.threads(channel))
+        render_cache.put(channel.id, version, out)
+    return out
+
+
+async def get_challenge_paginator(channel: discord.TextChannel) -> pages.Paginator:
+    out = await render_challenges(channel)
+    paginator = pages.Paginator(pages=[discord.Embed(title="Challenges", description=c) for c in out])
+    return paginator
+
+
+# --- live challenge board ---
+class ChallengeBoard:
+    """
+    One pinned challenge board message per CTF channel, edited in place.
+
+    refresh() must be called after every write to a channel's challenges or their members. It invalidates the
+    channel's rendered pages and schedules an update. Updates for the same channel within `delay` seconds are merged
+    into one, and the message is only edited if the rendered board differs from what was last sent.
+    """
+
+    def __init__(self, delay: float = BOARD_DEBOUNCE):
+        self.delay = delay
+        self.edits = 0
+        self.skipped = 0
+
+        self._pending: dict[int, asyncio.Task[None]] = {}
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._rendered: dict[int, list[str]] = {}
+
+    def stats(self) -> dict[str, int]:
+        return {"pending": len(self._pending), "edits": self.edits, "skipped": self.skipped}
+
+    def refresh(self, channel: discord.TextChannel):
+        render_cache.bump(channel.id)
+        if channel.id in self._pending:
+            # an update is already scheduled and will pick up this change too
+            return
+        self._pending[channel.id] = asyncio.create_task(self._run(channel))
+
+    async def _run(self, channel: discord.TextChannel):
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            del self._pending[channel.id]
+
+        try:
+            async with self._locks.setdefault(channel.id, asyncio.Lock()):
+                await self.update(channel)
+        except Exception:
+            logging.exception(f"Failed to update challenge board in {channel.id}")
+
+    async def update(self, channel: discord.TextChannel):
+        out = await render_challenges(channel)
+        if self._rendered.get(channel.id) == out:
+            self.skipped += 1
+            return
+
+        async with get_session() as session:
+            ctf = await session.scalar(select(Ctf).where(Ctf.channel_id == channel.id))
+        if ctf is None:
+            return
+
+        embeds = board_embeds(out)
+        if ctf.board_message_id is not None:
+            try:
+                await edit(channel.get_partial_message(ctf.board_message_id), embeds=embeds)
+                self._rendered[channel.id] = out
+                self.edits += 1
+                return
+            except discord.NotFound:
+                # board message was deleted, post a new one
+                pass
+
+        message = await send(channel, embeds=embeds, priority=Priority.UPDATE)
+        await request(Priority.UPDATE, channel.id, message.pin)
+        self._rendered[channel.id] = out
+        self.edits += 1
+
+        async with get_session() as session:
+            await session.execute(update(Ctf).where(Ctf.id == ctf.id).values(board_message_id=message.id))
+            await session.commit()
+
+    def forget(self, channel_id: int):
+        self._rendered.pop(channel_id, None)
+
+
+def board_embeds(out: list[str]) -> list[discord.Embed]:
+    # a message holds at most 10 embeds and 6000 characters across all of them
+    embeds: list[discord.Embed] = []
+    total = 0
+    for page in out:
+        if len(embeds) == 10 or total + len(page) > 5800:
+            embeds[-1].set_footer(text="Board truncated, use /chall list to see every challenge")
+            break
+        embeds.append(discord.Embed(title="Challenges" if not embeds else None, description=page))
+        total += len(page)
+    return embeds
+
+
+board = ChallengeBoard()
+
+
+# --- challenge threads ---
+async def join_thread(channel: discord.TextChannel, thread_id: int, user: discord.abc.Snowflake):
+    thread = await thread_cache.get(channel, thread_id)
+    if thread is None:
+        return
+    if thread.archived:
+        # members can't be added to an archived thread
+        await request(Priority.ACTION, thread.id, thread.edit, archived=False)
+    await request(Priority.ACTION, thread.id, thread.add_user, user)
+
+
+async def mark_thread_solved(channel: discord.TextChannel, challenge: Challenge):
+    thread = await thread_cache.get(channel, challenge.thread_id)
+    if thread is None:
+        return
+    # an archived thread can only be renamed by reopening it
+    await request(
+        Priority.ACTION, thread.id, thread.edit, name=f"{challenge.category}/{challenge.name} [SOLVED]", archived=False
+    )
+
+
+async def set_thread_id(challenge_id: int, thread_id: int):
+    async with get_session() as session:
+        await session.execute(update(Challenge).where(Challenge.id == challenge_id).values(thread_id=thread_id))
+        await session.commit()
+
+
+# --- bulk import ---
+def parse_challenge_list(data: bytes, filename: str) -> list[tuple[str, str]]:
+    """
+    Read (name, category) pairs from a CTFd-style JSON export (a list of challenges, or the API's
+    {"data": [...]} response) or a CSV file with name and category columns. Raises ValueError if the file
+    can't be read.
+    """
+    text = data.decode("utf-8-sig")
+    if filename.lower().endswith(".csv"):
+        rows = list(csv.DictReader(io.StringIO(text)))
+    else:
+        try:
+            rows = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}") from e
+        if isinstance(rows, dict):
+            rows = rows.get("data", [])
+    if not isinstance(rows, list):
+        raise ValueError("Expected a list of challenges")
+
+    challenges: list[tuple[str, str]] = []
+    seen: set[str] = set()
+    for row in rows:
+        if not isinstance(row, dict):
+            raise ValueError("Expected a list of challenges")
+        row = {str(k).strip().lower(): v for k, v in row.items()}
+        name = str(row.get("name") or "").strip()
+        category = str(row.get("category") or "").strip().lower()
+        if not name or not category:
+            raise ValueError("Every challenge needs a name and a category")
+        if name in seen:
+            continue
+        seen.add(name)
+        challenges.append((name, category))
+    return challenges
+
+
+async def create_challenge_threads(
+    channel: discord.TextChannel,
+    challenges: list[tuple[int, str, str]],
+    on_done: Callable[[], None] | None = None,
+) -> tuple[dict[int, int], int]:
+    """
+    Create a seed message and thread for each (challenge id, name, category), a few at a time. The dispatcher keeps
+    them within the channel's rate budget. Returns the thread id of each challenge that succeeded and the number
+    that failed.
+    """
+    semaphore = asyncio.Semaphore(IMPORT_CONCURRENCY)
+    thread_ids: dict[int, int] = {}
+
+    async def create(challenge_id: int, name: str, category: str):
+        async with semaphore:
+            thread_name = f"{category}/{name}"
+            message = await send(channel, f"`{thread_name}`", priority=Priority.ACTION)
+            thread = await request(Priority.ACTION, channel.id, message.create_thread, name=thread_name)
+            thread_cache.add(thread)
+            thread_ids[challenge_id] = thread.id
+            if on_done:
+                on_done()
 
-        paginator = pages.Paginator(pages=[discord.Embed(title="Challenges", description=c) for c in out])
-        return paginator
+    results = await asyncio.gather(*(create(*c) for c in challenges), return_exceptions=True)
+    failed = 0
+    for result in results:
+        if isinstance(result, BaseException):
+            failed += 1
+            logging.error(f"Failed to create challenge thread in {channel.id}", exc_info=result)
+    return thread_ids, failed
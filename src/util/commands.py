@@ -0,0 +1,87 @@
+"""
+Skips the slash command sync on startup when the command tree has not changed since the last sync.
+
+The hash of every command's payload is stored next to the database along with the ids Discord assigned, so an
+unchanged tree only needs the ids restored instead of fetching and comparing every command. Delete
+`data/commands.json` to force a sync.
+"""
+import hashlib
+import json
+import logging
+import os
+
+from discord.ext import commands
+
+from util.db import get_database_file
+
+# built from sets, so their order changes with the hash seed of the process
+UNORDERED_FIELDS = ("contexts", "integration_types")
+
+
+def canonical(payload):
+    if isinstance(payload, dict):
+        return {
+            key: sorted(value) if key in UNORDERED_FIELDS and isinstance(value, list) else canonical(value)
+            for key, value in payload.items()
+        }
+    if isinstance(payload, list):
+        return [canonical(value) for value in payload]
+    return payload
+
+
+def command_tree_hash(bot: commands.Bot) -> str:
+    assert bot.user is not None
+    tree = sorted(
+        (
+            json.dumps(
+                {"command": canonical(cmd.to_dict()), "guild_ids": sorted(cmd.guild_ids or [])},
+                sort_keys=True,
+                default=str,
+            )
+            for cmd in bot.pending_application_commands
+        )
+    )
+    digest = hashlib.sha256(str(bot.user.id).encode())
+    for payload in tree:
+        digest.update(payload.encode())
+    return digest.hexdigest()
+
+
+def cache_path() -> str:
+    return os.path.join(os.path.dirname(get_database_file()), "commands.json")
+
+
+def restore_command_ids(bot: commands.Bot, digest: str) -> bool:
+    """
+    Restore the ids of an unchanged command tree. Returns False if the tree changed and has to be synced.
+    """
+    try:
+        with open(cache_path()) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if cached.get("hash") != digest:
+        return False
+
+    ids = cached["ids"]
+    for cmd in bot.pending_application_commands:
+        id = ids.get(command_key(cmd))
+        if id is None:
+            return False
+        # a str like the ids sync_commands sets, interactions look their command up by the id as sent by Discord
+        cmd.id = str(id)
+        bot._application_commands[cmd.id] = cmd
+    return True
+
+
+def save_command_ids(bot: commands.Bot, digest: str):
+    ids = {command_key(cmd): cmd.id for cmd in bot.pending_application_commands if cmd.id is not None}
+    try:
+        with open(cache_path(), "w") as f:
+            json.dump({"hash": digest, "ids": ids}, f)
+    except OSError:
+        logging.exception("Failed to save the command tree hash, commands will be synced again on restart")
+
+
+def command_key(cmd) -> str:
+    return f"{cmd.type}:{cmd.name}:{','.join(map(str, sorted(cmd.guild_ids or [])))}"
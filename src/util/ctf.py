@@ -1,12 +1,30 @@
-from datetime import datetime
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 import json
+import logging
+import os
 import secrets
-from typing import Literal, TypedDict
+import time
+from typing import Literal, NotRequired, TypedDict
 
+import aiohttp
 import discord
 from discord.utils import format_dt
 import regex
-import requests
+
+from util.db import get_database_file
+from util.dispatch import Priority, request
+from util.scheduler import Job, scheduler
+
+CTFTIME_API = os.environ.get("CTFTIME_API", "https://ctftime.org/api/v1")
+CTFTIME_CACHE_TTL = int(os.environ.get("CTFTIME_CACHE_TTL", 600))
+CTFTIME_CACHE_SIZE = int(os.environ.get("CTFTIME_CACHE_SIZE", 256))
+CTFTIME_FEED_INTERVAL = float(os.environ.get("CTFTIME_FEED_INTERVAL", 60 * 60))
+CTFTIME_FEED_DAYS = int(os.environ.get("CTFTIME_FEED_DAYS", 30))
+
+# CTFtime's event formats, as shown in its feed
+FORMATS = ["Jeopardy", "Attack-Defense", "Hack quest"]
 
 
 class TempEventInfo(TypedDict):
@@ -17,6 +35,7 @@ class TempEventInfo(TypedDict):
     logo: str
     start: str
     finish: str
+    format: NotRequired[str]
 
 
 class EventInfo(TypedDict):
@@ -30,6 +49,286 @@ class EventInfo(TypedDict):
     discord_inv: str | None
 
 
+# --- CTFtime API client ---
+class CtftimeClient:
+    """
+    Pooled CTFtime API client.
+
+    All requests share one aiohttp session. Event lookups are cached by id for `ttl` seconds (404s for a shorter
+    time), and concurrent lookups of the same id wait on a single in-flight request.
+    """
+
+    def __init__(
+        self,
+        base_url: str = CTFTIME_API,
+        ttl: float = CTFTIME_CACHE_TTL,
+        maxsize: int = CTFTIME_CACHE_SIZE,
+        negative_ttl: float = 60,
+        timeout: float = 10,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.timeout = timeout
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._session: aiohttp.ClientSession | None = None
+        self._cache: OrderedDict[int, tuple[float, TempEventInfo | None]] = OrderedDict()
+        self._inflight: dict[int, asyncio.Task[TempEventInfo | None]] = {}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={
+                    "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:61.0) Gecko/20100101 Firefox/61.0"
+                },  # CTFtime will 403 if this is not added
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=10, ttl_dns_cache=300),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "size": len(self._cache),
+        }
+
+    def clear(self):
+        self._cache.clear()
+
+    async def get_event(self, event_id: int) -> TempEventInfo | None:
+        """
+        Returns the raw CTFtime event, or None if CTFtime has no such event.
+        """
+        cached = self._cache.get(event_id)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self._cache.move_to_end(event_id)
+                self.hits += 1
+                return cached[1]
+            del self._cache[event_id]
+
+        task = self._inflight.get(event_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(event_id))
+            self._inflight[event_id] = task
+            task.add_done_callback(lambda t: self._fetch_done(event_id, t))
+        else:
+            self.coalesced += 1
+
+        # shield so that one cancelled caller doesn't cancel the request for everyone else
+        return await asyncio.shield(task)
+
+    async def _fetch(self, event_id: int) -> TempEventInfo | None:
+        async with self._get_session().get(f"{self.base_url}/events/{event_id}/") as resp:
+            if resp.status == 404:
+                return None
+            resp.raise_for_status()
+            return await resp.json(content_type=None)
+
+    async def get_events(self, start: datetime, finish: datetime, limit: int = 100) -> list[TempEventInfo]:
+        """
+        Every event starting between start and finish, not cached. CTFtime returns at most `limit` events per
+        request in order of their start, so longer lists are fetched in pages.
+        """
+        events: dict[int, TempEventInfo] = {}
+        after = int(start.timestamp())
+        while True:
+            params = {"limit": limit, "start": after, "finish": int(finish.timestamp())}
+            async with self._get_session().get(f"{self.base_url}/events/", params=params) as resp:
+                resp.raise_for_status()
+                page: list[TempEventInfo] = await resp.json(content_type=None)
+            for event in page:
+                events[event["id"]] = event
+            if len(page) < limit:
+                return list(events.values())
+
+            # continue from the last start, events sharing it are returned again and merged by id
+            last = int(datetime.fromisoformat(page[-1]["start"]).timestamp())
+            if last <= after:
+                return list(events.values())
+            after = last
+
+    def _fetch_done(self, event_id: int, task: asyncio.Task[TempEventInfo | None]):
+        self._inflight.pop(event_id, None)
+        if task.cancelled() or task.exception() is not None:
+            # errors are not cached, the next lookup will retry
+            return
+
+        event = task.result()
+        ttl = self.ttl if event is not None else self.negative_ttl
+        self._cache[event_id] = (time.monotonic() + ttl, event)
+        self._cache.move_to_end(event_id)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+
+ctftime = CtftimeClient()
+
+
+# --- upcoming events feed ---
+class UpcomingFeed:
+    """
+    Local snapshot of the CTFtime events starting in the next `days` days, so that /ctf upcoming never waits on
+    CTFtime.
+
+    The snapshot is refreshed every `interval` seconds from the scheduler and saved next to the database, so a
+    restart serves the last snapshot until the next refresh is due. Refreshes merge the fetched events into the
+    snapshot by id, and events are only dropped once they are over.
+    """
+
+    def __init__(self, interval: float = CTFTIME_FEED_INTERVAL, days: int = CTFTIME_FEED_DAYS):
+        self.interval = interval
+        self.days = days
+        self.fetched_at: float | None = None
+
+        self.refreshes = 0
+        self.failed = 0
+        self.added = 0
+        self.updated = 0
+
+        self._events: dict[int, TempEventInfo] = {}
+        self._times: dict[int, tuple[datetime, datetime]] = {}
+        self._job: Job | None = None
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def path(self) -> str:
+        return os.path.join(os.path.dirname(get_database_file()), "upcoming.json")
+
+    def load(self):
+        try:
+            with open(self.path()) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logging.exception("Failed to read the upcoming CTF snapshot, it will be fetched again")
+            return
+        self.fetched_at = snapshot["fetched_at"]
+        self._merge(snapshot["events"])
+        self._prune()
+
+    async def save(self):
+        snapshot = {"fetched_at": self.fetched_at, "events": list(self._events.values())}
+        await asyncio.to_thread(write_json, self.path(), snapshot)
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        # a snapshot loaded from disk is only refreshed once it is due
+        when = (self.fetched_at or 0) + self.interval
+        self._job = scheduler.schedule(max(when, time.time()), self._run)
+
+    def stop(self):
+        if self._job is not None:
+            scheduler.cancel(self._job)
+            self._job = None
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "events": len(self._events),
+            "refreshes": self.refreshes,
+            "failed": self.failed,
+            "added": self.added,
+            "updated": self.updated,
+            "age": time.time() - self.fetched_at if self.fetched_at else -1,
+        }
+
+    async def _run(self):
+        self._job = scheduler.schedule(time.time() + self.interval, self._run)
+        try:
+            await self.refresh()
+        except Exception:
+            self.failed += 1
+            logging.exception("Failed to refresh the upcoming CTFs")
+
+    async def refresh(self) -> tuple[int, int]:
+        """
+        Fetch the upcoming events and merge them into the snapshot. Returns how many were added and updated.
+        """
+        now = datetime.now(timezone.utc)
+        events = await ctftime.get_events(now, now + timedelta(days=self.days))
+        added, updated = self._merge(events)
+        self._prune()
+        self.fetched_at = time.time()
+        self.refreshes += 1
+        self.added += added
+        self.updated += updated
+        await self.save()
+        return added, updated
+
+    def _merge(self, events: list[TempEventInfo]) -> tuple[int, int]:
+        added = updated = 0
+        for event in events:
+            old = self._events.get(event["id"])
+            if old == event:
+                continue
+            if old is None:
+                added += 1
+            else:
+                updated += 1
+            self._events[event["id"]] = event
+            self._times[event["id"]] = (
+                datetime.fromisoformat(event["start"]),
+                datetime.fromisoformat(event["finish"]),
+            )
+        return added, updated
+
+    def _prune(self):
+        now = datetime.now(timezone.utc)
+        for event_id in [event_id for event_id, (_, finish) in self._times.items() if finish <= now]:
+            del self._events[event_id]
+            del self._times[event_id]
+
+    def get(self, event_id: int) -> TempEventInfo | None:
+        """
+        The event from the snapshot, None if it isn't in it or is already over.
+        """
+        times = self._times.get(event_id)
+        if times is None or times[1] <= datetime.now(timezone.utc):
+            return None
+        return self._events[event_id]
+
+    def query(self, after: datetime, before: datetime, format: str | None = None) -> list[TempEventInfo]:
+        """
+        Events running at any point between after and before, in order of their start.
+        """
+        matches = [
+            event_id
+            for event_id, (start, finish) in self._times.items()
+            if start < before
+            and finish > after
+            and (format is None or self._events[event_id].get("format", "").lower() == format.lower())
+        ]
+        matches.sort(key=lambda event_id: self._times[event_id][0])
+        return [self._events[event_id] for event_id in matches]
+
+
+def write_json(path: str, data):
+    # write to a temporary file first so a crash never leaves a truncated snapshot behind
+    partial = path + ".partial"
+    with open(partial, "w") as f:
+        json.dump(data, f)
+    os.replace(partial, path)
+
+
+upcoming = UpcomingFeed()
+
+
 # --- get CTF details ---
 async def get_details(ctftime_link: str) -> EventInfo | Literal[False]:
     # Check whether the link is valid
@@ -40,19 +339,14 @@ async def get_details(ctftime_link: str) -> EventInfo | Literal[False]:
     else:
         event_id = check.group()
 
-    # Grab data via API
-    req = requests.get(
-        f"https://ctftime.org/api/v1/events/{event_id}/",
-        headers={
-            "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:61.0) Gecko/20100101 Firefox/61.0"
-        },  # CTFtime will 403 if this is not added
-    )
-    if req.status_code == 404:
+    # Upcoming events come from the feed snapshot, anything else from the API (cached, shared between concurrent
+    # lookups)
+    temp_event_info = upcoming.get(int(event_id)) or await ctftime.get_event(int(event_id))
+    if temp_event_info is None:
         # CTFtime returned 404
         return False
 
     # ID is valid
-    temp_event_info: TempEventInfo = json.loads(req.content)
     event_info: EventInfo = {
         "id": temp_event_info["id"],
         "title": temp_event_info["title"],
@@ -106,11 +400,31 @@ async def details_to_embed(event_info: EventInfo) -> discord.Embed:
     return embed
 
 
+def upcoming_to_embeds(events: list[TempEventInfo], fetched_at: float, per_page: int = 10) -> list[discord.Embed]:
+    embeds = []
+    for index in range(0, len(events), per_page):
+        embed = discord.Embed(title="Upcoming CTFs", colour=discord.Colour.blurple())
+        for event in events[index : index + per_page]:
+            start = datetime.fromisoformat(event["start"])
+            finish = datetime.fromisoformat(event["finish"])
+            embed.add_field(
+                name=f"{event['title']} ({event.get('format') or 'unknown format'})"[:256],
+                value=f"{format_dt(start)} to {format_dt(finish)}\n<https://ctftime.org/event/{event['id']}>",
+                inline=False,
+            )
+        embed.set_footer(text="From CTFtime, updated")
+        embed.timestamp = datetime.fromtimestamp(fetched_at, timezone.utc)
+        embeds.append(embed)
+    return embeds
+
+
 async def generate_creds() -> str:
     return secrets.token_urlsafe(20)
 
 
-async def create_channel(ctx: discord.ApplicationContext, event_info: EventInfo) -> discord.TextChannel | None:
+async def create_channel(
+    ctx: discord.ApplicationContext, event_info: EventInfo, role: discord.Role | None = None
+) -> discord.TextChannel | None:
     # define perms
     if ctx.guild:
         perms = {
@@ -119,18 +433,27 @@ async def create_channel(ctx: discord.ApplicationContext, event_info: EventInfo)
             # don't add the author - they should react to the message to join
             # ctx.author: discord.PermissionOverwrite(view_channel=True),
         }
+        if role is not None:
+            # members join through the role instead of an overwrite each
+            perms[role] = discord.PermissionOverwrite(view_channel=True)
 
         # create channel
         category = ctx.interaction.channel.category if type(ctx.interaction.channel) == discord.TextChannel else None
         ctf_channel: discord.TextChannel | None = None
         if category:
-            ctf_channel = await category.create_text_channel(
+            ctf_channel = await request(
+                Priority.ACTION,
+                None,
+                category.create_text_channel,
                 event_info["title"],
                 topic=event_info["url"],
                 overwrites=perms,
             )
         else:
-            ctf_channel = await ctx.guild.create_text_channel(
+            ctf_channel = await request(
+                Priority.ACTION,
+                None,
+                ctx.guild.create_text_channel,
                 event_info["title"],
                 topic=event_info["url"],
                 overwrites=perms,
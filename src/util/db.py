@@ -1,11 +1,27 @@
 import os
 from typing import List
-import discord
-from sqlalchemy import Boolean, Column, Integer, Table, create_engine, select
-from sqlalchemy import create_engine, ForeignKey, String
-from sqlalchemy.orm import Mapped, Session, declarative_base, mapped_column, relationship
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, LargeBinary, String, Table, event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column, relationship
 
-engine = None
+from util import migrations
+from util.metrics import metrics
+
+# storage profile, see README
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL").upper()
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", -16000))  # pages, or KiB if negative
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 64 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))  # ms
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", 5))
+SQLITE_CHECKPOINT_INTERVAL = float(os.environ.get("SQLITE_CHECKPOINT_INTERVAL", 300))
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+engine: AsyncEngine | None = None
+session_factory: async_sessionmaker[AsyncSession] | None = None
+database_file: str | None = None
 
 Base = declarative_base()
 
@@ -13,18 +29,25 @@ chall_to_members = Table(
     "chall_to_members",
     Base.metadata,
     Column("Challenge", ForeignKey("challenges.id"), primary_key=True),
-    Column("User", ForeignKey("users.id"), primary_key=True)
+    Column("User", ForeignKey("users.id"), primary_key=True),
+    # the primary key covers lookups by challenge, this covers lookups by user
+    Index("ix_chall_to_members_user", "User"),
 )
 
 class Ctf(Base):
     __tablename__ = "ctfs"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    channel_id: Mapped[int] = mapped_column(Integer)
-    join_message_id: Mapped[int] = mapped_column(Integer)
+    channel_id: Mapped[int] = mapped_column(Integer, index=True)
+    join_message_id: Mapped[int] = mapped_column(Integer, index=True)
+    board_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    guild_id: Mapped[int | None] = mapped_column(Integer, nullable=True, index=True)
+    finish: Mapped[int | None] = mapped_column(Integer, nullable=True, index=True) # unix timestamp
+    role_id: Mapped[int | None] = mapped_column(Integer, nullable=True) # members' role, None for per-user overwrites
     challenges: Mapped[List["Challenge"]] = relationship("Challenge", back_populates="ctf")
 
 class Challenge(Base):
     __tablename__ = "challenges"
+    __table_args__ = (Index("ix_challenges_ctf_id_name", "ctf_id", "name", unique=True),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(String)
     category: Mapped[str] = mapped_column(String)
@@ -32,42 +55,129 @@ class Challenge(Base):
     ctf: Mapped["Ctf"] = relationship("Ctf", back_populates="challenges")
     members: Mapped[List["User"]]= relationship(secondary=chall_to_members, back_populates="challenges")
     solved: Mapped[bool] = mapped_column(Boolean, default=False)
-    thread_id: Mapped[int] = mapped_column(Integer)
+    thread_id: Mapped[int] = mapped_column(Integer, index=True)
+    guild_id: Mapped[int | None] = mapped_column(Integer, nullable=True, index=True)
+    # unix timestamps, unknown for challenges from before they were recorded
+    added_at: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    solved_at: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+class Timer(Base):
+    __tablename__ = "timers"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    ctf_id: Mapped[int | None] = mapped_column(Integer, ForeignKey("ctfs.id"), nullable=True, index=True)
+    channel_id: Mapped[int] = mapped_column(Integer) # channel or thread to post in
+    # unix timestamps
+    start: Mapped[int] = mapped_column(Integer)
+    end: Mapped[int] = mapped_column(Integer)
+    next_at: Mapped[int] = mapped_column(Integer)
+    interval: Mapped[int] = mapped_column(Integer) # seconds between reminders, 0 for none
+    announce_start: Mapped[bool] = mapped_column(Boolean, default=False)
+    guild_id: Mapped[int | None] = mapped_column(Integer, nullable=True, index=True)
 
 class User(Base):
     __tablename__ = "users"
     id: Mapped[int] = mapped_column(Integer, primary_key=True) # discord user id
     challenges: Mapped[List["Challenge"]] = relationship(secondary=chall_to_members, back_populates="members")
 
-def get_conn():
-    global engine
-    if not engine:
-        path = "data"
-        if not os.path.exists(path):
-            os.mkdir(path)
-        engine = create_engine(f"sqlite:///{os.path.join(path, 'data.db')}")
-        Base.metadata.create_all(engine)
-    return Session(engine)
-
-def get_all_challs_from_ctx(ctx: discord.AutocompleteContext):
-    with get_conn() as conn:
-        challenges = conn.scalars(
-            select(Challenge)
-            .join(Ctf)
-            .where(Ctf.channel_id == ctx.interaction.channel_id)
-        )
-        if not challenges:
-            return []
-        return [c.name for c in challenges]
-
-def get_unsolved_challs_from_ctx(ctx: discord.AutocompleteContext):
-    with get_conn() as conn:
-        challenges = conn.scalars(
-            select(Challenge)
-            .join(Ctf)
-            .where(Ctf.channel_id == ctx.interaction.channel_id)
-            .where(Challenge.solved == False)
-        )
-        if not challenges:
-            return []
-        return [c.name for c in challenges]
+class Archive(Base):
+    # a finished CTF moved out of the tables above by util.archive, its challenges and members in one blob
+    __tablename__ = "archives"
+    ctf_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    channel_id: Mapped[int] = mapped_column(Integer, index=True)
+    guild_id: Mapped[int | None] = mapped_column(Integer, nullable=True, index=True)
+    archived_at: Mapped[int] = mapped_column(Integer) # unix timestamp
+    data: Mapped[bytes] = mapped_column(LargeBinary) # zlib compressed JSON
+
+# solve statistics, kept up to date by util.stats in the same transaction as the challenge changes. guild_id is 0
+# until the guild of an old CTF is known
+class PlayerStats(Base):
+    __tablename__ = "player_stats"
+    __table_args__ = (Index("ix_player_stats_guild_id_solves", "guild_id", "solves"),)
+    guild_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    solves: Mapped[int] = mapped_column(Integer, default=0)
+
+class CategoryStats(Base):
+    __tablename__ = "category_stats"
+    __table_args__ = (Index("ix_category_stats_guild_id_solves", "guild_id", "solves"),)
+    guild_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    category: Mapped[str] = mapped_column(String, primary_key=True)
+    challenges: Mapped[int] = mapped_column(Integer, default=0)
+    solves: Mapped[int] = mapped_column(Integer, default=0)
+    # total and count of the add to solve times that are known
+    solve_seconds: Mapped[int] = mapped_column(Integer, default=0)
+    timed_solves: Mapped[int] = mapped_column(Integer, default=0)
+
+class CtfStats(Base):
+    __tablename__ = "ctf_stats"
+    __table_args__ = (Index("ix_ctf_stats_guild_id_ctf_id", "guild_id", "ctf_id"),)
+    ctf_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    guild_id: Mapped[int] = mapped_column(Integer)
+    channel_id: Mapped[int] = mapped_column(Integer)
+    challenges: Mapped[int] = mapped_column(Integer, default=0)
+    solves: Mapped[int] = mapped_column(Integer, default=0)
+    solve_seconds: Mapped[int] = mapped_column(Integer, default=0)
+    timed_solves: Mapped[int] = mapped_column(Integer, default=0)
+
+def configure_connection(dbapi_connection, connection_record):
+    """
+    Apply the storage profile to each new pooled connection.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    if SQLITE_JOURNAL_MODE == "WAL" and SQLITE_CHECKPOINT_INTERVAL > 0:
+        # util.backup checkpoints in the background instead of whichever commit crosses the threshold
+        cursor.execute("PRAGMA wal_autocheckpoint=0")
+    cursor.close()
+
+async def init_db(path: str = "data"):
+    """
+    Create the async engine and create or migrate the schema. Must be awaited once on the bot's loop before
+    get_session is used.
+    """
+    global engine, session_factory, database_file
+    if engine:
+        return
+    if SQLITE_JOURNAL_MODE not in JOURNAL_MODES:
+        raise ValueError(f"SQLITE_JOURNAL_MODE must be one of {', '.join(sorted(JOURNAL_MODES))}")
+    if SQLITE_SYNCHRONOUS not in SYNCHRONOUS_MODES:
+        raise ValueError(f"SQLITE_SYNCHRONOUS must be one of {', '.join(sorted(SYNCHRONOUS_MODES))}")
+    if not os.path.exists(path):
+        os.mkdir(path)
+    database_file = os.path.join(path, "data.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{database_file}", pool_size=SQLITE_POOL_SIZE)
+    event.listen(engine.sync_engine, "connect", configure_connection)
+    metrics.attach_engine(engine.sync_engine)
+    # objects stay usable after commit, so handlers can close the session before talking to Discord
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade, Base.metadata)
+
+async def close_db():
+    global engine, session_factory, database_file
+    if engine:
+        await engine.dispose()
+    engine = None
+    session_factory = None
+    database_file = None
+
+def get_session() -> AsyncSession:
+    if session_factory is None:
+        raise RuntimeError("Database not initialised, await init_db() first")
+    return session_factory()
+
+def get_database_file() -> str:
+    if database_file is None:
+        raise RuntimeError("Database not initialised, await init_db() first")
+    return database_file
+
+async def get_or_create_user(session: AsyncSession, user_id: int) -> User:
+    user = await session.get(User, user_id)
+    if not user:
+        user = User(id=user_id)
+        session.add(user)
+    return user
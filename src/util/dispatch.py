@@ -0,0 +1,248 @@
+"""
+Outbound Discord request queue.
+
+Every request the cogs make to Discord goes through `dispatcher` with a priority and a route (usually the channel
+id it touches). Requests are started in priority order, each route has its own rate budget so one busy channel
+can't starve the others, and an edit of a message that is still waiting in the queue replaces the earlier edit
+instead of being sent after it. Interaction responses skip the in-flight limit, since they have to land within
+Discord's 3 second deadline and don't count against channel rate limits.
+
+Commands start the requests that don't depend on each other together with `run_all`, so a handler waits about as
+long as its longest chain of requests rather than the sum of all of them.
+
+The dispatcher only ever awaits the callables it is given, so it can be driven by a stub transport.
+"""
+import asyncio
+import bisect
+from dataclasses import dataclass, field
+from enum import IntEnum
+from functools import partial
+import itertools
+import os
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+import discord
+
+from util.ratelimit import TokenBucket
+
+DISPATCH_CHANNEL_RATE = float(os.environ.get("DISPATCH_CHANNEL_RATE", 1))
+DISPATCH_CHANNEL_BURST = int(os.environ.get("DISPATCH_CHANNEL_BURST", 5))
+DISPATCH_MAX_INFLIGHT = int(os.environ.get("DISPATCH_MAX_INFLIGHT", 4))
+
+
+class Priority(IntEnum):
+    INTERACTION = 0  # interaction responses and followups
+    ACTION = 1  # changes a user is waiting on: threads, permissions, reactions
+    UPDATE = 2  # board and progress edits
+    ANNOUNCE = 3  # notices and echoes nobody is waiting on
+
+
+@dataclass(order=True)
+class Request:
+    priority: int
+    seq: int
+    route: Hashable | None = field(compare=False)
+    call: Callable[[], Awaitable[Any]] = field(compare=False)
+    merge_key: Hashable | None = field(compare=False)
+    future: asyncio.Future[Any] = field(compare=False)
+    enqueued: float = field(compare=False)
+
+
+class Dispatcher:
+    def __init__(
+        self,
+        rate: float = DISPATCH_CHANNEL_RATE,
+        burst: int = DISPATCH_CHANNEL_BURST,
+        max_inflight: int = DISPATCH_MAX_INFLIGHT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.clock = clock
+
+        self.merged = 0
+        self.failed = 0
+        self.completed = {p: 0 for p in Priority}
+        self.wait_total = {p: 0.0 for p in Priority}
+        self.wait_max = {p: 0.0 for p in Priority}
+
+        self._queue: list[Request] = []
+        self._merge: dict[Hashable, Request] = {}
+        self._buckets: dict[Hashable, TokenBucket] = {}
+        self._seq = itertools.count()
+        self._inflight = 0
+        self._wakeup = asyncio.Event()
+        self._runner: asyncio.Task[None] | None = None
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def submit(
+        self,
+        priority: Priority,
+        route: Hashable | None,
+        call: Callable[[], Awaitable[Any]],
+        merge_key: Hashable | None = None,
+    ) -> asyncio.Future[Any]:
+        if merge_key is not None and (queued := self._merge.get(merge_key)) is not None:
+            # still waiting, so the newer call supersedes it and both callers get its result
+            queued.call = call
+            if priority < queued.priority:
+                self._queue.remove(queued)
+                queued.priority = priority
+                bisect.insort(self._queue, queued)
+            self.merged += 1
+            return queued.future
+
+        request = Request(
+            priority, next(self._seq), route, call, merge_key, asyncio.get_running_loop().create_future(), self.clock()
+        )
+        bisect.insort(self._queue, request)
+        if merge_key is not None:
+            self._merge[merge_key] = request
+
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return request.future
+
+    async def request(
+        self,
+        priority: Priority,
+        route: Hashable | None,
+        call: Callable[[], Awaitable[Any]],
+        merge_key: Hashable | None = None,
+    ) -> Any:
+        return await self.submit(priority, route, call, merge_key)
+
+    def depth(self) -> dict[str, int]:
+        depth = {p.name.lower(): 0 for p in Priority}
+        for request in self._queue:
+            depth[Priority(request.priority).name.lower()] += 1
+        return depth
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "depth": self.depth(),
+            "inflight": self._inflight,
+            "merged": self.merged,
+            "failed": self.failed,
+            "completed": {p.name.lower(): n for p, n in self.completed.items()},
+            "wait_avg": {
+                p.name.lower(): self.wait_total[p] / self.completed[p] if self.completed[p] else 0.0 for p in Priority
+            },
+            "wait_max": {p.name.lower(): w for p, w in self.wait_max.items()},
+        }
+
+    def close(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+
+    def _bucket(self, route: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            bucket = self._buckets[route] = TokenBucket(self.rate, self.burst, self.clock)
+        return bucket
+
+    def _pop_ready(self) -> Request | None:
+        blocked: set[Hashable] = set()
+        for i, request in enumerate(self._queue):
+            if request.priority != Priority.INTERACTION and self._inflight >= self.max_inflight:
+                # the queue is sorted, nothing after this is an interaction either
+                return None
+            if request.route is not None:
+                if request.route in blocked:
+                    continue
+                if not self._bucket(request.route).try_acquire():
+                    blocked.add(request.route)
+                    continue
+            del self._queue[i]
+            if request.merge_key is not None:
+                self._merge.pop(request.merge_key, None)
+            return request
+        return None
+
+    def _next_delay(self) -> float | None:
+        if not self._queue or self._inflight >= self.max_inflight:
+            # wait for a request to be submitted or finish
+            return None
+        routes = {request.route for request in self._queue if request.route is not None}
+        return min((self._bucket(route).delay() for route in routes), default=0.0)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            while (request := self._pop_ready()) is not None:
+                self._start(request)
+            timeout = self._next_delay()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self, request: Request):
+        priority = Priority(request.priority)
+        waited = self.clock() - request.enqueued
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+
+        self._inflight += 1
+        task = asyncio.create_task(self._execute(request))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, request: Request):
+        try:
+            result = await request.call()
+        except Exception as e:
+            self.failed += 1
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
+        finally:
+            self._inflight -= 1
+            self.completed[Priority(request.priority)] += 1
+            self._wakeup.set()
+
+
+dispatcher = Dispatcher()
+
+
+# --- helpers for the common calls ---
+async def respond(ctx: discord.ApplicationContext, *args, **kwargs) -> Any:
+    return await dispatcher.request(Priority.INTERACTION, None, partial(ctx.respond, *args, **kwargs))
+
+
+async def send(
+    channel: discord.abc.Messageable, *args, priority: Priority = Priority.ANNOUNCE, **kwargs
+) -> discord.Message:
+    return await dispatcher.request(priority, getattr(channel, "id", None), partial(channel.send, *args, **kwargs))
+
+
+async def edit(
+    message: discord.Message | discord.PartialMessage | discord.InteractionMessage | discord.WebhookMessage,
+    priority: Priority = Priority.UPDATE,
+    **kwargs,
+) -> Any:
+    return await dispatcher.request(
+        priority, message.channel.id, partial(message.edit, **kwargs), merge_key=("edit", message.id)
+    )
+
+
+async def request(priority: Priority, route: Hashable | None, call: Callable[..., Awaitable[Any]], *args, **kwargs):
+    return await dispatcher.request(priority, route, partial(call, *args, **kwargs))
+
+
+async def run_all(*steps: Awaitable[Any]) -> list[Any]:
+    """
+    Await independent steps of a command concurrently and return their results in order. Every step runs to the end
+    even if another one fails, then the first failure is raised, so nothing is left running behind the handler.
+    """
+    results = await asyncio.gather(*steps, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
@@ -0,0 +1,201 @@
+"""
+Writeup bundles: every challenge thread of a CTF, with its attachments, streamed into a zip on disk.
+
+Thread histories are paged through an async generator and each message is written to the zip as soon as it arrives.
+Attachments are downloaded in chunks to temporary files with bounded concurrency and added to the zip once their
+thread is done, so memory use doesn't depend on the size of the CTF.
+"""
+import asyncio
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import re
+import tempfile
+from typing import AsyncIterator
+import zipfile
+
+import aiohttp
+import discord
+
+from util.chall import ChallengeRow
+from util.db import get_database_file
+from util.dispatch import Priority, request
+from util.threads import thread_cache
+
+EXPORT_DIR = os.environ.get("EXPORT_DIR")
+EXPORT_CONCURRENCY = int(os.environ.get("EXPORT_CONCURRENCY", 4))
+
+# messages per history request, the most Discord returns
+PAGE_SIZE = 100
+CHUNK_SIZE = 64 * 1024
+
+
+def safe_name(name: str) -> str:
+    # a single path component that is valid everywhere the zip may be extracted
+    return re.sub(r"[^\w .-]", "_", name).strip(" .")[:100] or "_"
+
+
+async def thread_messages(thread: discord.Thread, page_size: int = PAGE_SIZE) -> AsyncIterator[discord.Message]:
+    """
+    Every message in a thread, oldest first, one page in memory at a time.
+    """
+    after: discord.abc.Snowflake | None = None
+    while True:
+        # no route, reads shouldn't use up the channel's budget for sends and edits
+        page = await request(
+            Priority.ANNOUNCE, None, thread.history(limit=page_size, after=after, oldest_first=True).flatten
+        )
+        for message in page:
+            yield message
+        if len(page) < page_size:
+            return
+        after = page[-1]
+
+
+def message_to_dict(message: discord.Message, attachments: list[dict]) -> dict:
+    return {
+        "id": message.id,
+        "author_id": message.author.id,
+        "author": message.author.display_name,
+        "created_at": message.created_at.isoformat(),
+        "edited_at": message.edited_at.isoformat() if message.edited_at else None,
+        "content": message.content,
+        "reply_to": message.reference.message_id if message.reference else None,
+        "attachments": attachments,
+    }
+
+
+class Exporter:
+    """
+    Writes writeup bundles to `export_dir`, downloading at most `concurrency` attachments at a time per export.
+    """
+
+    def __init__(self, export_dir: str | None = EXPORT_DIR, concurrency: int = EXPORT_CONCURRENCY):
+        self.export_dir = export_dir
+        self.concurrency = concurrency
+
+        self.exports = 0
+        self.messages = 0
+        self.attachments = 0
+        self.failed_attachments = 0
+
+        self._running: set[int] = set()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "running": len(self._running),
+            "exports": self.exports,
+            "messages": self.messages,
+            "attachments": self.attachments,
+            "failed_attachments": self.failed_attachments,
+        }
+
+    def try_start(self, channel_id: int) -> bool:
+        """
+        Claim a channel for an export, before anything is awaited. False if an export of it is already running.
+        """
+        if channel_id in self._running:
+            return False
+        self._running.add(channel_id)
+        return True
+
+    def finish(self, channel_id: int):
+        self._running.discard(channel_id)
+
+    async def export(self, channel: discord.TextChannel, challenges: list[ChallengeRow]) -> str:
+        """
+        Write the bundle of a CTF channel and return its path. The channel is claimed with try_start() and released
+        with finish() by the caller.
+        """
+        export_dir = self.export_dir or os.path.join(os.path.dirname(get_database_file()), "exports")
+        os.makedirs(export_dir, exist_ok=True)
+        name = f"{safe_name(channel.name)}-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.zip"
+        path = os.path.join(export_dir, name)
+        partial = path + ".partial"
+
+        try:
+            threads = await thread_cache.threads(channel)
+            manifest = []
+            folders: set[str] = set()
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=60)) as http:
+                with zipfile.ZipFile(partial, "w", zipfile.ZIP_DEFLATED) as zf, tempfile.TemporaryDirectory(
+                    dir=export_dir
+                ) as tmp:
+                    for challenge in challenges:
+                        entry = {
+                            "name": challenge.name,
+                            "category": challenge.category,
+                            "solved": challenge.solved,
+                            "members": challenge.member_ids,
+                            "thread_id": challenge.thread_id or None,
+                            "messages": 0,
+                        }
+                        thread = threads.get(challenge.thread_id)
+                        if thread is not None:
+                            folder = f"{safe_name(challenge.category)}/{safe_name(challenge.name)}"
+                            if folder in folders:
+                                # names that only differ in characters replaced by safe_name
+                                folder += f"-{challenge.id}"
+                            folders.add(folder)
+                            entry["folder"] = folder
+                            entry["messages"] = await self.export_thread(zf, http, tmp, thread, folder)
+                        manifest.append(entry)
+                    zf.writestr("challenges.json", json.dumps(manifest, indent=2))
+            os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+        self.exports += 1
+        return path
+
+    async def export_thread(
+        self, zf: zipfile.ZipFile, http: aiohttp.ClientSession, tmp: str, thread: discord.Thread, folder: str
+    ) -> int:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        downloads: list[asyncio.Task[bool]] = []
+        files: list[tuple[str, str]] = []  # (temporary path, path in the zip)
+        count = 0
+
+        # the zip takes one writer at a time, attachments are added after the messages
+        with zf.open(f"{folder}/messages.jsonl", "w") as out:
+            async for message in thread_messages(thread):
+                attachments = []
+                for attachment in message.attachments:
+                    arcname = f"{folder}/attachments/{message.id}-{safe_name(attachment.filename)}"
+                    temp_path = os.path.join(tmp, f"{message.id}-{attachment.id}")
+                    downloads.append(asyncio.create_task(self.download(http, semaphore, attachment.url, temp_path)))
+                    files.append((temp_path, arcname))
+                    attachments.append({"filename": attachment.filename, "path": arcname, "size": attachment.size})
+                out.write((json.dumps(message_to_dict(message, attachments)) + "\n").encode())
+                count += 1
+
+        results = await asyncio.gather(*downloads)
+        for (temp_path, arcname), ok in zip(files, results):
+            if ok:
+                await asyncio.to_thread(zf.write, temp_path, arcname, zipfile.ZIP_STORED)
+                os.remove(temp_path)
+
+        self.messages += count
+        return count
+
+    async def download(self, http: aiohttp.ClientSession, semaphore: asyncio.Semaphore, url: str, path: str) -> bool:
+        async with semaphore:
+            try:
+                async with http.get(url) as resp:
+                    resp.raise_for_status()
+                    with open(path, "wb") as f:
+                        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                            f.write(chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                # the message still lists the attachment, only its file is missing from the bundle
+                logging.warning(f"Failed to download attachment {url}: {e}")
+                self.failed_attachments += 1
+                return False
+        self.attachments += 1
+        return True
+
+
+exporter = Exporter()
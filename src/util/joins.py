@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+
+import discord
+
+from util.cache import join_index
+from util.dispatch import Priority, request, send
+
+JOIN_BATCH_WINDOW = float(os.environ.get("JOIN_BATCH_WINDOW", 2))
+
+
+class JoinQueue:
+    """
+    Per-channel queue of join/leave requests from the join message reactions.
+
+    Requests are collected for `window` seconds. Repeated toggles by the same user collapse into their final state,
+    users whose access already matches are skipped, the rest get one combined notice per channel, and the changes go
+    out through the dispatcher: the CTF's role is added or removed if it has one (see util.roles), otherwise a
+    permission overwrite is set on the channel under its rate budget. With a role, an overwrite a member still has
+    from before the CTF was moved onto it counts as joined too, and is dropped when they leave.
+    """
+
+    def __init__(self, window: float = JOIN_BATCH_WINDOW):
+        self.window = window
+
+        self.requested = 0
+        self.merged = 0
+        self.skipped = 0
+        self.applied = 0
+        self.failed = 0
+
+        self._pending: dict[int, dict[int, tuple[discord.abc.User, bool]]] = {}
+        self._workers: dict[int, asyncio.Task[None]] = {}
+
+    def request(self, channel: discord.TextChannel, user: discord.abc.User, join: bool):
+        pending = self._pending.setdefault(channel.id, {})
+        if user.id in pending:
+            self.merged += 1
+        pending[user.id] = (user, join)
+        self.requested += 1
+
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.create_task(self._run(channel))
+
+    def depth(self, channel_id: int | None = None) -> int:
+        if channel_id is not None:
+            return len(self._pending.get(channel_id, {}))
+        return sum(len(pending) for pending in self._pending.values())
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "depth": self.depth(),
+            "channels": len(self._workers),
+            "requested": self.requested,
+            "merged": self.merged,
+            "skipped": self.skipped,
+            "applied": self.applied,
+            "failed": self.failed,
+        }
+
+    async def _run(self, channel: discord.TextChannel):
+        try:
+            while True:
+                await asyncio.sleep(self.window)
+                pending = self._pending.pop(channel.id, None)
+                if not pending:
+                    break
+                try:
+                    await self._apply(channel, list(pending.values()))
+                except Exception:
+                    logging.exception(f"Failed to apply join requests in {channel.id}")
+        finally:
+            self._workers.pop(channel.id, None)
+
+    async def _apply(self, channel: discord.TextChannel, pending: list[tuple[discord.abc.User, bool]]):
+        role_id = join_index.role(channel.id)
+        role = channel.guild.get_role(role_id) if role_id is not None else None
+        changes: list[tuple[discord.abc.User, bool]] = []
+        for user, join in pending:
+            if role is not None:
+                member = channel.guild.get_member(user.id)
+                if member is None:
+                    # no longer in the guild, which takes their roles with it
+                    self.skipped += 1
+                    continue
+                user = member
+                joined = member.get_role(role.id) is not None or channel.overwrites_for(member).view_channel is True
+            else:
+                joined = channel.overwrites_for(user).view_channel is True
+            if joined == join:
+                # toggled back to where it started, or already applied
+                self.skipped += 1
+            else:
+                changes.append((user, join))
+        if not changes:
+            return
+
+        joining = [user.mention for user, join in changes if join]
+        leaving = [user.mention for user, join in changes if not join]
+        lines = []
+        if joining:
+            lines.append(f"{', '.join(joining)} {'is' if len(joining) == 1 else 'are'} joining the channel")
+        if leaving:
+            lines.append(f"{', '.join(leaving)} {'is' if len(leaving) == 1 else 'are'} leaving the channel")
+        await send(channel, "\n".join(lines))
+
+        for user, join in changes:
+            try:
+                if isinstance(user, discord.Member) and role is not None:
+                    if join or user.get_role(role.id) is not None:
+                        change = user.add_roles if join else user.remove_roles
+                        await request(Priority.ACTION, channel.guild.id, change, role, reason="CTF members")
+                    overwrite = channel.overwrites_for(user)
+                    if not join and overwrite.view_channel is not None:
+                        overwrite.view_channel = None
+                        await request(
+                            Priority.ACTION,
+                            channel.id,
+                            channel.set_permissions,
+                            user,
+                            overwrite=None if overwrite.is_empty() else overwrite,
+                        )
+                else:
+                    await request(Priority.ACTION, channel.id, channel.set_permissions, user, view_channel=join)
+                self.applied += 1
+            except discord.HTTPException:
+                self.failed += 1
+                logging.exception(f"Failed to change access for {user.id} in {channel.id}")
+
+
+join_queue = JoinQueue()
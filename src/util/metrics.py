@@ -0,0 +1,283 @@
+"""
+In-process metrics: a latency histogram per slash command, autocomplete and listener, database queries and commits
+per invocation, and Discord REST calls and 429s. Shown by /dev stats and, if METRICS_PORT is set, served in the
+Prometheus text format on localhost.
+"""
+import bisect
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+import logging
+import os
+import time
+from typing import Any, Callable
+
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_PORT = os.environ.get("METRICS_PORT")
+
+# seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-th quantile, inf if it is past the last bucket.
+        """
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+
+@dataclass
+class Invocation:
+    queries: int = 0
+    commits: int = 0
+
+
+@dataclass
+class HandlerStats:
+    latency: Histogram = field(default_factory=Histogram)
+    errors: int = 0
+    queries: int = 0
+    commits: int = 0
+
+
+_current: ContextVar[Invocation | None] = ContextVar("invocation", default=None)
+
+
+class Metrics:
+    def __init__(self):
+        self.handlers: dict[tuple[str, str], HandlerStats] = {}
+        self.queries = 0
+        self.commits = 0
+        self.rest_requests: dict[str, int] = {}
+        self.rest_errors = 0
+        self.rate_limited = 0
+
+        self._collectors: dict[str, Callable[[], dict[str, Any]]] = {}
+
+    @asynccontextmanager
+    async def track(self, kind: str, name: str):
+        """
+        Time the block and count the database queries made inside it, including in tasks it starts.
+        """
+        stats = self._stats(kind, name)
+        invocation = Invocation()
+        token = _current.set(invocation)
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            stats.errors += 1
+            raise
+        finally:
+            stats.latency.observe(time.perf_counter() - start)
+            stats.queries += invocation.queries
+            stats.commits += invocation.commits
+            _current.reset(token)
+
+    def record_error(self, kind: str, name: str):
+        """
+        Count an error that was handled before it could reach track(), e.g. by the command error handler.
+        """
+        self._stats(kind, name).errors += 1
+
+    def _stats(self, kind: str, name: str) -> HandlerStats:
+        stats = self.handlers.get((kind, name))
+        if stats is None:
+            stats = self.handlers[(kind, name)] = HandlerStats()
+        return stats
+
+    def instrument(self, kind: str):
+        """
+        Decorator form of track() for listeners and autocomplete callbacks, named after the function.
+        """
+
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                async with self.track(kind, func.__name__):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def register(self, name: str, collector: Callable[[], dict[str, Any]]):
+        """
+        Export the numbers returned by collector() as gauges, e.g. a component's stats().
+        """
+        self._collectors[name] = collector
+
+    # --- hooks ---
+    def attach_engine(self, engine: Engine):
+        event.listen(engine, "before_cursor_execute", self._on_query)
+        event.listen(engine, "commit", self._on_commit)
+
+    def _on_query(self, *args):
+        self.queries += 1
+        if (invocation := _current.get()) is not None:
+            invocation.queries += 1
+
+    def _on_commit(self, *args):
+        self.commits += 1
+        if (invocation := _current.get()) is not None:
+            invocation.commits += 1
+
+    def attach_http(self, http):
+        """
+        Count the REST calls made through a discord.py HTTPClient. 429s are retried inside the client, so they are
+        counted from its rate limit warnings instead.
+        """
+        request = http.request
+
+        @wraps(request)
+        async def counted(route, **kwargs):
+            self.rest_requests[route.method] = self.rest_requests.get(route.method, 0) + 1
+            try:
+                return await request(route, **kwargs)
+            except Exception:
+                self.rest_errors += 1
+                raise
+
+        http.request = counted
+        logging.getLogger("discord.http").addFilter(self._count_rate_limit)
+        logging.getLogger("discord.webhook.async_").addFilter(self._count_rate_limit)
+
+    def _count_rate_limit(self, record: logging.LogRecord) -> bool:
+        # "We are being rate limited. Retrying in ..." and "Webhook ID ... is rate limited. Retrying in ..."
+        if isinstance(record.msg, str) and "rate limited. Retrying" in record.msg:
+            self.rate_limited += 1
+        return True
+
+    # --- output ---
+    def render(self) -> str:
+        lines = []
+
+        def header(name: str, type: str, help: str):
+            lines.append(f"# HELP ctfcord_{name} {help}")
+            lines.append(f"# TYPE ctfcord_{name} {type}")
+
+        header("handler_seconds", "histogram", "Latency of slash commands, autocomplete callbacks and listeners")
+        for (kind, name), stats in sorted(self.handlers.items()):
+            labels = f'kind="{kind}",name="{name}"'
+            cumulative = 0
+            for bound, count in zip(stats.latency.buckets, stats.latency.counts):
+                cumulative += count
+                lines.append(f'ctfcord_handler_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'ctfcord_handler_seconds_bucket{{{labels},le="+Inf"}} {stats.latency.count}')
+            lines.append(f"ctfcord_handler_seconds_sum{{{labels}}} {stats.latency.sum}")
+            lines.append(f"ctfcord_handler_seconds_count{{{labels}}} {stats.latency.count}")
+
+        for metric, help, attr in (
+            ("handler_errors_total", "Invocations that raised", "errors"),
+            ("handler_db_queries_total", "Database queries made by invocations", "queries"),
+            ("handler_db_commits_total", "Database commits made by invocations", "commits"),
+        ):
+            header(metric, "counter", help)
+            for (kind, name), stats in sorted(self.handlers.items()):
+                lines.append(f'ctfcord_{metric}{{kind="{kind}",name="{name}"}} {getattr(stats, attr)}')
+
+        header("db_queries_total", "counter", "Database queries")
+        lines.append(f"ctfcord_db_queries_total {self.queries}")
+        header("db_commits_total", "counter", "Database commits")
+        lines.append(f"ctfcord_db_commits_total {self.commits}")
+        header("discord_requests_total", "counter", "Discord REST calls")
+        for method, count in sorted(self.rest_requests.items()):
+            lines.append(f'ctfcord_discord_requests_total{{method="{method}"}} {count}')
+        header("discord_request_errors_total", "counter", "Discord REST calls that failed")
+        lines.append(f"ctfcord_discord_request_errors_total {self.rest_errors}")
+        header("discord_rate_limited_total", "counter", "429 responses from Discord")
+        lines.append(f"ctfcord_discord_rate_limited_total {self.rate_limited}")
+
+        for prefix, collector in sorted(self._collectors.items()):
+            for key, value in flatten(collector()):
+                name = f"{prefix}_{key}"
+                header(name, "gauge", f"{prefix} {key.replace('_', ' ')}")
+                lines.append(f"ctfcord_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """
+        Plain text overview for /dev stats.
+        """
+        lines = [f"{'handler':<32} {'n':>6} {'p50':>7} {'p95':>7} {'err':>4} {'q/inv':>6} {'c/inv':>6}"]
+        for (kind, name), stats in sorted(self.handlers.items(), key=lambda i: -i[1].latency.count):
+            n = stats.latency.count
+            lines.append(
+                f"{kind[0]}:{name[:30]:<30} {n:>6} {format_seconds(stats.latency.quantile(0.5)):>7} "
+                f"{format_seconds(stats.latency.quantile(0.95)):>7} {stats.errors:>4} "
+                f"{stats.queries / n if n else 0:>6.1f} {stats.commits / n if n else 0:>6.1f}"
+            )
+        lines.append("")
+        lines.append(f"db: {self.queries} queries, {self.commits} commits")
+        lines.append(
+            f"discord: {sum(self.rest_requests.values())} requests, {self.rest_errors} failed, "
+            f"{self.rate_limited} rate limited"
+        )
+        for prefix, collector in sorted(self._collectors.items()):
+            values = ", ".join(f"{key}={format_value(value)}" for key, value in flatten(collector()))
+            lines.append(f"{prefix}: {values}")
+        return "\n".join(lines)
+
+
+def flatten(stats: dict[str, Any], prefix: str = "") -> list[tuple[str, float]]:
+    out = []
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            out += flatten(value, f"{prefix}{key}_")
+        elif isinstance(value, (int, float)):
+            out.append((f"{prefix}{key}", value))
+    return out
+
+
+def format_seconds(value: float) -> str:
+    if value == float("inf"):
+        return f">{BUCKETS[-1]:g}s"
+    if value < 1:
+        return f"{value * 1000:g}ms"
+    return f"{value:g}s"
+
+
+def format_value(value: float) -> str:
+    return f"{value:.3g}" if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
+
+
+# --- Prometheus endpoint ---
+async def serve(port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(
+            body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,175 @@
+"""
+Versioned schema migrations for the bot's SQLite database.
+
+The schema version is stored in SQLite's `user_version` pragma. A new database is created straight from the models
+and stamped with the latest version. An existing database gets every migration newer than its version applied in
+order, so `data/data.db` is upgraded in place at startup.
+
+Migrations are plain functions taking a Connection. Append new ones to the end of the list, never reorder or remove
+them, and keep them safe to re-run (`IF NOT EXISTS` etc.) in case the bot dies halfway through one.
+"""
+import json
+import logging
+from typing import Callable
+import zlib
+
+from sqlalchemy import Connection, MetaData, inspect
+
+MIGRATIONS: list[Callable[[Connection], None]] = []
+
+
+def migration(fn: Callable[[Connection], None]) -> Callable[[Connection], None]:
+    MIGRATIONS.append(fn)
+    return fn
+
+
+def get_version(conn: Connection) -> int:
+    return conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+
+
+def set_version(conn: Connection, version: int):
+    conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def upgrade(conn: Connection, metadata: MetaData):
+    fresh = not inspect(conn).has_table("ctfs")
+
+    # creates tables that don't exist yet, existing tables are left to the migrations
+    metadata.create_all(conn)
+
+    if fresh:
+        set_version(conn, len(MIGRATIONS))
+        return
+
+    version = get_version(conn)
+    for i, fn in enumerate(MIGRATIONS[version:], start=version):
+        logging.info(f"Migrating database to version {i + 1} ({fn.__name__})")
+        fn(conn)
+        set_version(conn, i + 1)
+
+
+def add_column(conn: Connection, table: str, column: str, ddl: str):
+    if column not in [c["name"] for c in inspect(conn).get_columns(table)]:
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def rebuild_stats(conn: Connection):
+    """
+    Recompute the solve statistics tables from every challenge. A full scan, only for backfilling them.
+    """
+    timed = "c.solved AND c.solved_at > c.added_at"
+    guild = "COALESCE(f.guild_id, c.guild_id, 0)"
+    for table in ("player_stats", "category_stats", "ctf_stats"):
+        conn.exec_driver_sql(f"DELETE FROM {table}")
+    conn.exec_driver_sql(
+        "INSERT INTO category_stats (guild_id, category, challenges, solves, solve_seconds, timed_solves) "
+        f"SELECT {guild}, c.category, COUNT(*), SUM(c.solved), "
+        f"SUM(CASE WHEN {timed} THEN c.solved_at - c.added_at ELSE 0 END), SUM(CASE WHEN {timed} THEN 1 ELSE 0 END) "
+        f"FROM challenges c LEFT JOIN ctfs f ON f.id = c.ctf_id GROUP BY {guild}, c.category"
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO ctf_stats (ctf_id, guild_id, channel_id, challenges, solves, solve_seconds, timed_solves) "
+        f"SELECT c.ctf_id, MAX({guild}), COALESCE(MAX(f.channel_id), 0), COUNT(*), SUM(c.solved), "
+        f"SUM(CASE WHEN {timed} THEN c.solved_at - c.added_at ELSE 0 END), SUM(CASE WHEN {timed} THEN 1 ELSE 0 END) "
+        "FROM challenges c LEFT JOIN ctfs f ON f.id = c.ctf_id GROUP BY c.ctf_id"
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO player_stats (guild_id, user_id, solves) "
+        f'SELECT {guild}, m."User", COUNT(*) FROM chall_to_members m '
+        'JOIN challenges c ON c.id = m."Challenge" LEFT JOIN ctfs f ON f.id = c.ctf_id '
+        f'WHERE c.solved GROUP BY {guild}, m."User"'
+    )
+
+    # archived CTFs are only stored as blobs
+    for guild_id, channel_id, data in conn.exec_driver_sql("SELECT guild_id, channel_id, data FROM archives").all():
+        archive = json.loads(zlib.decompress(data))
+        guild_id = guild_id or 0
+        for c in archive["challenges"]:
+            timed = c["solved"] and c["added_at"] is not None and (c["solved_at"] or 0) > c["added_at"]
+            counts = (1, int(c["solved"]), c["solved_at"] - c["added_at"] if timed else 0, int(timed))
+            conn.exec_driver_sql(
+                "INSERT INTO category_stats (guild_id, category, challenges, solves, solve_seconds, timed_solves) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO UPDATE SET challenges = challenges + excluded.challenges, "
+                "solves = solves + excluded.solves, solve_seconds = solve_seconds + excluded.solve_seconds, "
+                "timed_solves = timed_solves + excluded.timed_solves",
+                (guild_id, c["category"], *counts),
+            )
+            conn.exec_driver_sql(
+                "INSERT INTO ctf_stats (ctf_id, guild_id, channel_id, challenges, solves, solve_seconds, timed_solves) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO UPDATE SET challenges = challenges + excluded.challenges, "
+                "solves = solves + excluded.solves, solve_seconds = solve_seconds + excluded.solve_seconds, "
+                "timed_solves = timed_solves + excluded.timed_solves",
+                (archive["ctf"]["id"], guild_id, channel_id, *counts),
+            )
+            for user_id in c["members"] if c["solved"] else []:
+                conn.exec_driver_sql(
+                    "INSERT INTO player_stats (guild_id, user_id, solves) VALUES (?, ?, 1) "
+                    "ON CONFLICT DO UPDATE SET solves = solves + 1",
+                    (guild_id, user_id),
+                )
+
+
+# --- migrations ---
+@migration
+def add_lookup_indexes(conn: Connection):
+    # challenge names have to be unique within a ctf before the unique index can be built, so rename any duplicates
+    # (all but the oldest) instead of dropping them
+    conn.exec_driver_sql(
+        "UPDATE challenges SET name = name || ' (' || id || ')' "
+        "WHERE id NOT IN (SELECT MIN(id) FROM challenges GROUP BY ctf_id, name)"
+    )
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_ctfs_channel_id ON ctfs (channel_id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_ctfs_join_message_id ON ctfs (join_message_id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_challenges_thread_id ON challenges (thread_id)")
+    conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_challenges_ctf_id_name ON challenges (ctf_id, name)"
+    )
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_chall_to_members_user ON chall_to_members ("User")')
+
+
+@migration
+def add_board_message_id(conn: Connection):
+    add_column(conn, "ctfs", "board_message_id", "INTEGER")
+
+
+@migration
+def add_guild_ids(conn: Connection):
+    # filled in by util.shards.backfill_guild_ids once the bot can see which guild each channel is in
+    for table in ("ctfs", "challenges", "timers"):
+        add_column(conn, table, "guild_id", "INTEGER")
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_{table}_guild_id ON {table} (guild_id)")
+
+
+@migration
+def add_solve_stats(conn: Connection):
+    # the stats tables themselves are created by create_all, fill them in from the existing challenges
+    add_column(conn, "challenges", "added_at", "INTEGER")
+    add_column(conn, "challenges", "solved_at", "INTEGER")
+    rebuild_stats(conn)
+
+
+@migration
+def add_ctf_finish(conn: Connection):
+    # the sweep in util.archive needs to know when each CTF ends, take it from its timers where there are any
+    add_column(conn, "ctfs", "finish", "INTEGER")
+    conn.exec_driver_sql(
+        'UPDATE ctfs SET finish = (SELECT MAX("end") FROM timers WHERE timers.ctf_id = ctfs.id) WHERE finish IS NULL'
+    )
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_ctfs_finish ON ctfs (finish)")
+
+
+@migration
+def add_ctf_role_id(conn: Connection):
+    # CTFs from before keep their per-user overwrites until util.roles moves them onto a role
+    add_column(conn, "ctfs", "role_id", "INTEGER")
+
+
+@migration
+def untime_added_solved(conn: Connection):
+    # challenges added already solved by /chall solve were counted as solved in no time, they have no solve time at
+    # all. That path never creates a thread, which tells them apart from challenges added with one and solved within
+    # the same second
+    conn.exec_driver_sql(
+        "UPDATE challenges SET added_at = NULL WHERE solved AND added_at = solved_at AND thread_id = 0"
+    )
+    rebuild_stats(conn)
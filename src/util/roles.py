@@ -0,0 +1,157 @@
+"""
+Role-based CTF membership.
+
+With CTF_ROLES enabled, /ctf add creates one role per CTF that can view its channel, and joining or leaving adds or
+removes the role instead of editing a permission overwrite for the user on the channel. The channel keeps a fixed
+set of overwrites that threads inherit. Archiving the CTF keeps the role, so its members can still read the channel,
+unless /ctf archive is told to delete it, which drops it from every member in one request.
+
+CTFs created with per-user overwrites are migrated once the bot is ready: each gets a role, every member with an
+overwrite is given the role, and only then are their overwrites dropped in a single channel edit, so nobody loses
+access in between. A CTF whose migration was interrupted is picked up again on the next start.
+"""
+import asyncio
+import logging
+import os
+
+import discord
+from sqlalchemy import select, update
+
+from util.cache import join_index
+from util.db import Ctf, get_session
+from util.dispatch import Priority, request
+from util.shards import shards
+
+CTF_ROLES = os.environ.get("CTF_ROLES", "0") != "0"
+
+
+class CtfRoles:
+    def __init__(self):
+        self.created = 0
+        self.deleted = 0
+        self.migrated = 0
+        self.failed = 0
+
+        self._migration: asyncio.Task[int] | None = None
+
+    def stats(self) -> dict[str, int]:
+        return {"created": self.created, "deleted": self.deleted, "migrated": self.migrated, "failed": self.failed}
+
+    async def create(self, guild: discord.Guild, name: str) -> discord.Role | None:
+        """
+        Create the role of a CTF. Returns None if the bot can't, e.g. without the Manage Roles permission, in which
+        case the CTF falls back to per-user overwrites.
+        """
+        try:
+            role = await request(Priority.ACTION, guild.id, guild.create_role, name=name[:100], reason="CTF members")
+        except discord.HTTPException as e:
+            self.failed += 1
+            logging.warning(f"Failed to create a CTF role in {guild.id}, using per-user overwrites instead: {e}")
+            return None
+        self.created += 1
+        return role
+
+    async def delete(self, guild: discord.Guild, role_ids: list[int], reason: str = "CTF archived") -> int:
+        """
+        Delete CTF roles concurrently. Returns how many were deleted.
+        """
+        roles = [role for role_id in role_ids if (role := guild.get_role(role_id)) is not None]
+        results = await asyncio.gather(
+            *(request(Priority.UPDATE, guild.id, role.delete, reason=reason) for role in roles),
+            return_exceptions=True,
+        )
+        failed = [r for r in results if isinstance(r, BaseException)]
+        for error in failed:
+            logging.warning(f"Failed to delete a CTF role in {guild.id}: {error}")
+        self.failed += len(failed)
+        deleted = len(roles) - len(failed)
+        self.deleted += deleted
+        return deleted
+
+    def start_migration(self, bot: discord.Client):
+        # on_ready fires again after a reconnect, one run at a time is enough
+        if self._migration is None or self._migration.done():
+            self._migration = asyncio.create_task(self.migrate(bot))
+
+    async def migrate(self, bot: discord.Client) -> int:
+        """
+        Move every CTF of this process's shards that still has per-user overwrites onto a role. Returns how many
+        CTFs were changed.
+        """
+        async with get_session() as session:
+            rows = (
+                await session.execute(
+                    select(Ctf.id, Ctf.channel_id, Ctf.role_id).where(shards.filter(Ctf.guild_id))
+                )
+            ).all()
+
+        migrated = 0
+        # one channel at a time, each is a burst of role changes in its guild
+        for ctf_id, channel_id, role_id in rows:
+            channel = bot.get_channel(channel_id)
+            if type(channel) is not discord.TextChannel:
+                continue
+            try:
+                if await self.migrate_channel(ctf_id, channel, role_id):
+                    migrated += 1
+            except Exception:
+                self.failed += 1
+                logging.exception(f"Failed to move {channel.id} onto a CTF role")
+        if migrated:
+            logging.info(f"Moved {migrated} CTFs from per-user overwrites onto roles")
+        return migrated
+
+    async def migrate_channel(self, ctf_id: int, channel: discord.TextChannel, role_id: int | None) -> bool:
+        guild = channel.guild
+        # the overwrites of users joining or leaving left behind, except the bot's own. Users no longer in the guild
+        # can't be given the role, they keep an overwrite that lets them in
+        users = {
+            target: overwrite
+            for target, overwrite in channel.overwrites.items()
+            if not isinstance(target, discord.Role)
+            and target.id != guild.me.id
+            and overwrite.view_channel is not None
+            and (isinstance(target, discord.Member) or not overwrite.view_channel)
+        }
+        role = guild.get_role(role_id) if role_id is not None else None
+        if role is None:
+            # also when nobody has joined yet, so the first join doesn't need an overwrite
+            role = await self.create(guild, channel.name)
+            if role is None:
+                return False
+            async with get_session() as session:
+                await session.execute(update(Ctf).where(Ctf.id == ctf_id).values(role_id=role.id))
+                await session.commit()
+            join_index.set_role(channel.id, role.id)
+        elif not users and channel.overwrites_for(role).view_channel is True:
+            return False
+
+        # the role is given out before any overwrite is removed, a member it couldn't be given to keeps theirs
+        joined = [
+            target
+            for target, overwrite in users.items()
+            if isinstance(target, discord.Member) and overwrite.view_channel
+        ]
+        results = await asyncio.gather(
+            *(request(Priority.UPDATE, guild.id, member.add_roles, role, reason="CTF members") for member in joined),
+            return_exceptions=True,
+        )
+        kept = {member.id for member, result in zip(joined, results) if isinstance(result, BaseException)}
+        for error in (result for result in results if isinstance(result, BaseException)):
+            logging.warning(f"Failed to give a CTF role in {guild.id}: {error}")
+        self.failed += len(kept)
+
+        overwrites = {}
+        for target, overwrite in channel.overwrites.items():
+            if target in users and target.id not in kept:
+                # a denied view would also hide the channel from a member who joins again through the role
+                overwrite.view_channel = None
+            if not overwrite.is_empty():
+                overwrites[target] = overwrite
+        overwrites[role] = discord.PermissionOverwrite(view_channel=True)
+        await request(Priority.UPDATE, channel.id, channel.edit, overwrites=overwrites)
+        self.migrated += 1
+        return True
+
+
+ctf_roles = CtfRoles()
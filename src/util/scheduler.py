@@ -0,0 +1,109 @@
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable
+
+
+@dataclass(order=True)
+class Job:
+    when: float
+    seq: int
+    callback: Callable[[], Awaitable[None]] = field(compare=False)
+    cancelled: bool = field(default=False, compare=False)
+
+
+class Scheduler:
+    """
+    Runs coroutine callbacks at given times.
+
+    Jobs are kept in a min-heap of due times and one task sleeps until the earliest of them, so nothing wakes up
+    while nothing is due. Scheduling a job earlier than the current head wakes the task early. Cancelled jobs are
+    only marked and dropped when they reach the top of the heap.
+
+    `clock` returns the current unix time. Tests can pass a fake clock and call run_pending() directly instead of
+    start().
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self.fired = 0
+        self.wakeups = 0
+
+        self._heap: list[Job] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._runner: asyncio.Task[None] | None = None
+        self._running: set[asyncio.Task[None]] = set()
+
+    def __len__(self) -> int:
+        return sum(not job.cancelled for job in self._heap)
+
+    def stats(self) -> dict[str, int]:
+        return {"jobs": len(self), "fired": self.fired, "wakeups": self.wakeups}
+
+    def schedule(self, when: datetime | float, callback: Callable[[], Awaitable[None]]) -> Job:
+        if isinstance(when, datetime):
+            when = when.timestamp()
+        job = Job(when, next(self._seq), callback)
+        heapq.heappush(self._heap, job)
+        if self._heap[0] is job:
+            # new earliest deadline, the runner has to recompute its sleep
+            self._wakeup.set()
+        return job
+
+    def cancel(self, job: Job):
+        job.cancelled = True
+
+    def next_due(self) -> float | None:
+        while self._heap and self._heap[0].cancelled:
+            heapq.heappop(self._heap)
+        return self._heap[0].when if self._heap else None
+
+    def run_pending(self) -> int:
+        """
+        Start every job that is due, returns how many were started.
+        """
+        now = self.clock()
+        count = 0
+        while (due := self.next_due()) is not None and due <= now:
+            job = heapq.heappop(self._heap)
+            task = asyncio.create_task(self._call(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+            count += 1
+        self.fired += count
+        return count
+
+    async def _call(self, job: Job):
+        try:
+            await job.callback()
+        except Exception:
+            logging.exception("Scheduled job failed")
+
+    def start(self):
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            self.run_pending()
+            due = self.next_due()
+            timeout = None if due is None else max(0, due - self.clock())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeups += 1
+
+
+scheduler = Scheduler()
@@ -0,0 +1,123 @@
+"""
+Optional sharded mode for hosting many guilds from one deployment.
+
+Set SHARD_COUNT to run the bot as an AutoShardedBot with that many shards. SHARD_IDS (e.g. `0-3` or `0,2`) limits
+this process to some of them, so the shards can be split over several processes sharing one database. Each
+process then only loads the CTFs, challenges and timers of the guilds its shards own.
+"""
+import logging
+import os
+
+import discord
+from sqlalchemy import ColumnElement, Integer, or_, select, true, update
+
+from util.db import Archive, Challenge, Ctf, Timer, get_session
+from util.migrations import rebuild_stats
+
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", 0))
+SHARD_IDS = os.environ.get("SHARD_IDS")
+
+
+def parse_shard_ids(spec: str | None, count: int) -> list[int] | None:
+    """
+    Parse `0-3,6` into [0, 1, 2, 3, 6]. None means every shard.
+    """
+    if not spec:
+        return None
+    ids: set[int] = set()
+    for part in spec.split(","):
+        first, _, last = part.strip().partition("-")
+        ids.update(range(int(first), int(last or first) + 1))
+    if not ids or min(ids) < 0 or max(ids) >= count:
+        raise ValueError(f"SHARD_IDS must be between 0 and {count - 1}")
+    return sorted(ids)
+
+
+class ShardConfig:
+    def __init__(self, count: int = SHARD_COUNT, ids: list[int] | None = None):
+        self.count = count
+        self.ids = ids
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 0
+
+    def shard_for(self, guild_id: int) -> int:
+        # same formula Discord uses to pick the shard that receives a guild's events
+        return (guild_id >> 22) % self.count if self.enabled else 0
+
+    def owns(self, guild_id: int | None) -> bool:
+        return guild_id is None or self.ids is None or self.shard_for(guild_id) in self.ids
+
+    def filter(self, column) -> ColumnElement[bool]:
+        """
+        SQL condition for rows owned by this process. Rows whose guild isn't known yet are loaded by everyone.
+        """
+        if not self.enabled or self.ids is None:
+            return true()
+        return or_(column.is_(None), (column.op(">>", return_type=Integer)(22) % self.count).in_(self.ids))
+
+    def label(self) -> str:
+        if not self.enabled:
+            return ""
+        if self.ids is None:
+            return f"shards 0-{self.count - 1}/{self.count}"
+        return f"shards {','.join(map(str, self.ids))}/{self.count}"
+
+
+shards = ShardConfig(SHARD_COUNT, parse_shard_ids(SHARD_IDS, SHARD_COUNT) if SHARD_COUNT else None)
+
+
+def shard_stats(bot: discord.Client) -> dict[str, float]:
+    guilds: dict[int, int] = {}
+    for guild in bot.guilds:
+        guilds[guild.shard_id] = guilds.get(guild.shard_id, 0) + 1
+    stats: dict[str, float] = {}
+    for shard_id, latency in getattr(bot, "latencies", [(0, bot.latency)]):
+        stats[f"{shard_id}_latency"] = latency
+        stats[f"{shard_id}_guilds"] = guilds.get(shard_id, 0)
+    return stats
+
+
+async def backfill_guild_ids(bot: discord.Client) -> int:
+    """
+    Fill in the guild of rows created before guild ids were stored, from the channels the bot can see, and recount
+    the solve statistics if any changed. Returns the number of CTFs updated.
+    """
+    filled = 0
+    async with get_session() as session:
+        ctfs = (await session.execute(select(Ctf.id, Ctf.channel_id).where(Ctf.guild_id.is_(None)))).all()
+        for ctf_id, channel_id in ctfs:
+            channel = bot.get_channel(channel_id)
+            guild = getattr(channel, "guild", None)
+            if guild is None:
+                continue
+            await session.execute(update(Ctf).where(Ctf.id == ctf_id).values(guild_id=guild.id))
+            await session.execute(update(Challenge).where(Challenge.ctf_id == ctf_id).values(guild_id=guild.id))
+            await session.execute(update(Timer).where(Timer.ctf_id == ctf_id).values(guild_id=guild.id))
+            filled += 1
+
+        timers = (
+            await session.execute(select(Timer.id, Timer.channel_id).where(Timer.guild_id.is_(None)))
+        ).all()
+        for timer_id, channel_id in timers:
+            guild = getattr(bot.get_channel(channel_id), "guild", None)
+            if guild is not None:
+                await session.execute(update(Timer).where(Timer.id == timer_id).values(guild_id=guild.id))
+        archives = (
+            await session.execute(select(Archive.ctf_id, Archive.channel_id).where(Archive.guild_id.is_(None)))
+        ).all()
+        for ctf_id, channel_id in archives:
+            guild = getattr(bot.get_channel(channel_id), "guild", None)
+            if guild is not None:
+                await session.execute(update(Archive).where(Archive.ctf_id == ctf_id).values(guild_id=guild.id))
+                filled += 1
+
+        if filled:
+            # the solve statistics of these CTFs were counted without a guild
+            await session.run_sync(lambda sync_session: rebuild_stats(sync_session.connection()))
+        await session.commit()
+
+    if filled:
+        logging.info(f"Filled in the guild of {filled} CTFs")
+    return filled
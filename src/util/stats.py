@@ -0,0 +1,166 @@
+"""
+Solve statistics per player, category and CTF.
+
+The counters are updated by the challenge commands in the same transaction as the change itself, so /ctf stats
+only reads the rows it shows instead of scanning every challenge ever added.
+"""
+from collections import Counter
+import time
+
+import discord
+from sqlalchemy import desc, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from util.db import Base, CategoryStats, Challenge, Ctf, CtfStats, PlayerStats
+
+
+async def bump(session: AsyncSession, model: type[Base], keys: dict[str, int | str], **deltas: int):
+    """
+    Add deltas to a counter row, creating it if it doesn't exist.
+    """
+    stmt = insert(model).values(**keys, **deltas)
+    await session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[column.name for column in model.__table__.primary_key],
+            set_={name: getattr(model, name) + getattr(stmt.excluded, name) for name in deltas},
+        )
+    )
+
+
+def solve_time(challenge: Challenge) -> int | None:
+    # the same rule as rebuild_stats, so a solve is taken back out of the counters the way it was counted
+    if challenge.added_at is None or challenge.solved_at is None or challenge.solved_at <= challenge.added_at:
+        return None
+    return challenge.solved_at - challenge.added_at
+
+
+async def bump_challenge(session: AsyncSession, ctf: Ctf, category: str, sign: int = 1, **deltas: int):
+    deltas = {name: sign * delta for name, delta in deltas.items()}
+    guild_id = ctf.guild_id or 0
+    await bump(session, CategoryStats, {"guild_id": guild_id, "category": category}, **deltas)
+    # only the primary key is matched, the rest is just for creating the row
+    await bump(session, CtfStats, {"ctf_id": ctf.id, "guild_id": guild_id, "channel_id": ctf.channel_id}, **deltas)
+
+
+async def record_added(session: AsyncSession, ctf: Ctf, challenges: list[Challenge]):
+    """
+    Count new challenges, and new challenges that were added already solved. The latter are counted as untimed
+    solves, how long they took before they were added isn't known.
+    """
+    now = int(time.time())
+    for challenge in challenges:
+        if challenge.solved:
+            challenge.solved_at = now
+        else:
+            challenge.added_at = now
+    for category, count in Counter(challenge.category for challenge in challenges).items():
+        await bump_challenge(session, ctf, category, challenges=count)
+    for challenge in challenges:
+        if challenge.solved:
+            await record_solved(session, ctf, challenge, [user.id for user in challenge.members])
+
+
+async def record_solved(session: AsyncSession, ctf: Ctf, challenge: Challenge, user_ids: list[int]):
+    """
+    Count a challenge that was just solved, with every member as a solver.
+    """
+    if challenge.solved_at is None:
+        challenge.solved_at = int(time.time())
+    seconds = solve_time(challenge)
+    if seconds is None:
+        await bump_challenge(session, ctf, challenge.category, solves=1)
+    else:
+        await bump_challenge(session, ctf, challenge.category, solves=1, solve_seconds=seconds, timed_solves=1)
+    for user_id in user_ids:
+        await record_solver(session, ctf, user_id)
+
+
+async def record_solver(session: AsyncSession, ctf: Ctf, user_id: int, sign: int = 1):
+    await bump(session, PlayerStats, {"guild_id": ctf.guild_id or 0, "user_id": user_id}, solves=sign)
+
+
+async def record_removed(session: AsyncSession, ctf: Ctf, challenge: Challenge):
+    """
+    Take a deleted challenge, and its solve if it was solved, back out of the counters.
+    """
+    await bump_challenge(session, ctf, challenge.category, sign=-1, challenges=1)
+    if not challenge.solved:
+        return
+    seconds = solve_time(challenge)
+    if seconds is None:
+        await bump_challenge(session, ctf, challenge.category, sign=-1, solves=1)
+    else:
+        await bump_challenge(
+            session, ctf, challenge.category, sign=-1, solves=1, solve_seconds=seconds, timed_solves=1
+        )
+    for user in challenge.members:
+        await record_solver(session, ctf, user.id, sign=-1)
+
+
+# --- reading ---
+async def get_stats(
+    session: AsyncSession, guild_id: int, limit: int = 10
+) -> tuple[list[PlayerStats], list[CategoryStats], list[CtfStats]]:
+    """
+    The top players and categories by solves and the most recent CTFs of a guild, each read through an index.
+    """
+    players = await session.scalars(
+        select(PlayerStats)
+        .where(PlayerStats.guild_id == guild_id, PlayerStats.solves > 0)
+        .order_by(desc(PlayerStats.solves))
+        .limit(limit)
+    )
+    categories = await session.scalars(
+        select(CategoryStats)
+        .where(CategoryStats.guild_id == guild_id, CategoryStats.challenges > 0)
+        .order_by(desc(CategoryStats.solves))
+        .limit(limit)
+    )
+    ctfs = await session.scalars(
+        select(CtfStats)
+        .where(CtfStats.guild_id == guild_id, CtfStats.challenges > 0)
+        .order_by(desc(CtfStats.ctf_id))
+        .limit(limit)
+    )
+    return list(players), list(categories), list(ctfs)
+
+
+def format_duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return "<1m"
+    if minutes < 60:
+        return f"{minutes}m"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"{hours}h {minutes}m"
+    days, hours = divmod(hours, 24)
+    return f"{days}d {hours}h"
+
+
+def format_solves(row: CategoryStats | CtfStats) -> str:
+    out = f"{row.solves}/{row.challenges} solved"
+    if row.timed_solves:
+        out += f", {format_duration(row.solve_seconds / row.timed_solves)} to solve on average"
+    return out
+
+
+def stats_embed(players: list[PlayerStats], categories: list[CategoryStats], ctfs: list[CtfStats]) -> discord.Embed:
+    embed = discord.Embed(title="Solve statistics", colour=discord.Colour.blurple())
+    embed.add_field(
+        name="Top solvers",
+        value="\n".join(f"<@{p.user_id}>: {p.solves}" for p in players) or "No solves yet",
+        inline=False,
+    )
+    embed.add_field(
+        name="Categories",
+        value="\n".join(f"`{c.category[:40]}`: {format_solves(c)}" for c in categories) or "No challenges yet",
+        inline=False,
+    )
+    embed.add_field(
+        name="Recent CTFs",
+        value="\n".join(f"<#{c.channel_id}>: {format_solves(c)}" for c in ctfs) or "No CTFs yet",
+        inline=False,
+    )
+    return embed
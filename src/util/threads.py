@@ -0,0 +1,85 @@
+"""
+Challenge threads per CTF channel, including archived ones.
+
+py-cord only caches active threads, so a thread that auto-archived can't be found with get_channel. The first lookup
+in a CTF channel lists its active threads from the guild cache and its archived threads in bulk, after which the
+gateway thread events keep the cache current.
+"""
+import asyncio
+import logging
+
+import discord
+
+
+class ThreadCache:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.archived_fetched = 0
+
+        self._threads: dict[int, dict[int, discord.Thread]] = {}
+        self._locks: dict[int, asyncio.Lock] = {}
+
+    async def threads(self, channel: discord.TextChannel) -> dict[int, discord.Thread]:
+        """
+        Every thread in a CTF channel by id, loading the channel on first use.
+        """
+        threads = self._threads.get(channel.id)
+        if threads is not None:
+            return threads
+
+        async with self._locks.setdefault(channel.id, asyncio.Lock()):
+            # another caller may have finished loading while this one waited
+            if channel.id not in self._threads:
+                await self.load(channel)
+        return self._threads[channel.id]
+
+    async def get(self, channel: discord.TextChannel, thread_id: int) -> discord.Thread | None:
+        thread = (await self.threads(channel)).get(thread_id)
+        if thread is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return thread
+
+    async def load(self, channel: discord.TextChannel):
+        threads = {thread.id: thread for thread in channel.threads}
+        try:
+            async for thread in channel.archived_threads(limit=None):
+                threads.setdefault(thread.id, thread)
+                self.archived_fetched += 1
+        except discord.HTTPException:
+            # better to treat archived threads as missing than to fail the command
+            logging.exception(f"Failed to list archived threads in {channel.id}")
+        self._threads[channel.id] = threads
+        self.loads += 1
+
+    def add(self, thread: discord.Thread):
+        """
+        Add or replace a thread. Ignored for channels that haven't been loaded, they will list it when they are.
+        """
+        threads = self._threads.get(thread.parent_id)
+        if threads is not None:
+            threads[thread.id] = thread
+
+    def remove(self, parent_id: int, thread_id: int) -> bool:
+        threads = self._threads.get(parent_id)
+        return threads is not None and threads.pop(thread_id, None) is not None
+
+    def forget(self, channel_id: int):
+        self._threads.pop(channel_id, None)
+        self._locks.pop(channel_id, None)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "channels": len(self._threads),
+            "threads": sum(len(threads) for threads in self._threads.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "archived_fetched": self.archived_fetched,
+        }
+
+
+thread_cache = ThreadCache()
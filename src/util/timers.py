@@ -0,0 +1,157 @@
+from datetime import datetime
+from functools import partial
+import logging
+import time
+from typing import Iterable
+
+import discord
+from sqlalchemy import delete, select, update
+
+from util.db import Timer, get_session
+from util.dispatch import Priority, request, send
+from util.scheduler import Job, scheduler
+from util.shards import shards
+
+# a deadline this late is reported as a plain reminder rather than e.g. "CTF has started!"
+LATE_GRACE = 60
+# seconds before a timer whose channel couldn't be looked up is tried again
+RETRY_DELAY = 60
+
+
+class CtfTimers:
+    """
+    CTF start, reminder and end notices, stored in the timers table so they survive restarts.
+
+    Each row only keeps its next deadline. When it fires, the next one is computed and written back, and the row
+    is deleted after the end notice. Deadlines missed while the bot was down are caught up with a single notice
+    rather than replayed one by one. The scheduler is only started once the bot is ready, so those catch-up notices
+    don't fire before the channels are cached.
+    """
+
+    def __init__(self):
+        self.bot: discord.Client | None = None
+        self._jobs: dict[int, Job] = {}
+
+    async def load(self, bot: discord.Client):
+        self.bot = bot
+        async with get_session() as session:
+            timers = (await session.scalars(select(Timer).where(shards.filter(Timer.guild_id)))).all()
+        for timer in timers:
+            self._schedule(timer.id, timer.next_at)
+
+    async def add(
+        self,
+        channel_id: int,
+        start: datetime,
+        end: datetime,
+        interval: int,
+        ctf_id: int | None = None,
+        announce_start: bool = False,
+        guild_id: int | None = None,
+    ) -> Timer:
+        now = time.time()
+        if announce_start and start.timestamp() > now:
+            next_at = start.timestamp()
+        else:
+            next_at = max(start.timestamp(), now + interval) if interval else end.timestamp()
+
+        timer = Timer(
+            ctf_id=ctf_id,
+            channel_id=channel_id,
+            start=int(start.timestamp()),
+            end=int(end.timestamp()),
+            next_at=int(min(next_at, end.timestamp())),
+            interval=interval,
+            announce_start=announce_start,
+            guild_id=guild_id,
+        )
+        async with get_session() as session:
+            session.add(timer)
+            await session.commit()
+
+        self._schedule(timer.id, timer.next_at)
+        scheduler.start()
+        return timer
+
+    async def remove_ctf(self, ctf_id: int):
+        async with get_session() as session:
+            timer_ids = (await session.scalars(select(Timer.id).where(Timer.ctf_id == ctf_id))).all()
+            await session.execute(delete(Timer).where(Timer.ctf_id == ctf_id))
+            await session.commit()
+        self.cancel(timer_ids)
+
+    def cancel(self, timer_ids: Iterable[int]):
+        """
+        Drop the jobs of timers whose rows were deleted.
+        """
+        for timer_id in timer_ids:
+            job = self._jobs.pop(timer_id, None)
+            if job is not None:
+                scheduler.cancel(job)
+
+    def _schedule(self, timer_id: int, when: float):
+        self._jobs[timer_id] = scheduler.schedule(when, partial(self.fire, timer_id))
+
+    async def get_channel(self, channel_id: int) -> discord.abc.Messageable:
+        assert self.bot is not None
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            # not cached isn't the same as deleted, e.g. while the guild is still unavailable
+            channel = await request(Priority.ANNOUNCE, None, self.bot.fetch_channel, channel_id)
+        return channel
+
+    async def fire(self, timer_id: int):
+        self._jobs.pop(timer_id, None)
+
+        async with get_session() as session:
+            channel_id = await session.scalar(select(Timer.channel_id).where(Timer.id == timer_id))
+        if channel_id is None:
+            return
+        try:
+            channel = await self.get_channel(channel_id)
+        except discord.NotFound:
+            # only a deleted channel ends the timer early
+            channel = None
+        except discord.HTTPException as e:
+            logging.warning(f"Failed to look up {channel_id} for a time check, retrying in {RETRY_DELAY}s: {e}")
+            self._schedule(timer_id, time.time() + RETRY_DELAY)
+            return
+
+        async with get_session() as session:
+            timer = await session.get(Timer, timer_id)
+            if timer is None:
+                return
+
+            now = int(time.time())
+            if channel is None or now >= timer.end:
+                await session.delete(timer)
+                await session.commit()
+                if channel is not None:
+                    await send(channel, "CTF has ended!")
+                return
+
+            late = now - timer.next_at > LATE_GRACE
+            if timer.announce_start and timer.next_at == timer.start and not late:
+                content = f"CTF has started! It ends <t:{timer.end}:R>"
+            else:
+                content = f"CTF ends <t:{timer.end}:R>"
+
+            # skip over every reminder that was missed, then fall back to the end notice
+            next_at = timer.end
+            if timer.interval:
+                next_at = timer.next_at + timer.interval
+                if next_at <= now:
+                    next_at += ((now - next_at) // timer.interval + 1) * timer.interval
+                next_at = min(next_at, timer.end)
+
+            await session.execute(update(Timer).where(Timer.id == timer.id).values(next_at=next_at))
+            await session.commit()
+
+        self._schedule(timer_id, next_at)
+        try:
+            await send(channel, content)
+        except discord.HTTPException:
+            logging.exception(f"Failed to send time check to {timer.channel_id}")
+
+
+timers = CtfTimers()
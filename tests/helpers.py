@@ -0,0 +1,35 @@
+"""
+Shared helpers for the tests.
+
+The engine and the bot's singletons are bound to the event loop that first uses them, so every test runs its whole
+body in one `asyncio.run` and gets fresh instances of the singletons it touches.
+"""
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import AsyncIterator
+
+import discord
+
+import util.db
+
+
+@asynccontextmanager
+async def temp_database(path: str) -> AsyncIterator[None]:
+    await util.db.init_db(path)
+    try:
+        yield
+    finally:
+        await util.db.close_db()
+
+
+def http_error(cls: type[discord.HTTPException], status: int, message: str = "") -> discord.HTTPException:
+    return cls(SimpleNamespace(status=status, reason=message), message)
+
+
+class FakeChannel:
+    def __init__(self, id: int):
+        self.id = id
+        self.sent: list[str] = []
+
+    async def send(self, content: str):
+        self.sent.append(content)
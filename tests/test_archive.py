@@ -0,0 +1,74 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from util.archive import Archiver
+import util.archive
+from util.db import Ctf, get_session
+import util.dispatch
+from util.dispatch import Dispatcher
+from util.scheduler import Scheduler
+import util.timers
+from util.timers import CtfTimers
+
+from tests.helpers import temp_database
+
+
+def test_archive_cancels_timers(tmp_path, monkeypatch):
+    scheduler = Scheduler()
+    timers = CtfTimers()
+    monkeypatch.setattr(util.timers, "scheduler", scheduler)
+    monkeypatch.setattr(util.archive, "timers", timers)
+
+    async def main():
+        async with temp_database(str(tmp_path)):
+            async with get_session() as session:
+                ctf = Ctf(channel_id=1, join_message_id=2, guild_id=3)
+                session.add(ctf)
+                await session.commit()
+            now = datetime.now()
+            timer = await timers.add(1, now, now + timedelta(days=1), 3600, ctf_id=ctf.id)
+            job = timers._jobs[timer.id]
+
+            result = await Archiver(interval=0).archive(ctf.id)
+            scheduler.stop()
+            return result, job
+
+    result, job = asyncio.run(main())
+    assert result is not None
+    assert job.cancelled
+    assert not timers._jobs and len(scheduler) == 0
+
+
+class FakeRole:
+    def __init__(self, id: int):
+        self.id = id
+        self.deleted = False
+
+    async def delete(self, reason: str | None = None):
+        self.deleted = True
+
+
+@pytest.mark.parametrize("delete_role", [False, True])
+def test_role_is_only_deleted_on_request(tmp_path, monkeypatch, delete_role):
+    monkeypatch.setattr(util.dispatch, "dispatcher", Dispatcher())
+    role = FakeRole(4)
+    guild = SimpleNamespace(id=3, get_role=lambda role_id: role if role_id == role.id else None)
+    bot = SimpleNamespace(get_channel=lambda channel_id: None, get_guild=lambda guild_id: guild)
+
+    async def main():
+        async with temp_database(str(tmp_path)):
+            async with get_session() as session:
+                ctf = Ctf(channel_id=1, join_message_id=2, guild_id=guild.id, role_id=role.id)
+                session.add(ctf)
+                await session.commit()
+            archiver = Archiver(interval=0)
+            archiver.bot = bot  # type: ignore[assignment]
+            return await archiver.archive(ctf.id, delete_role=delete_role)
+
+    result = asyncio.run(main())
+    # the role is the members' only access to the channel
+    assert result is not None and result.role_deleted is delete_role
+    assert role.deleted is delete_role
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+from sqlalchemy import event
+
+import util.db
+from util.chall import get_challenge_rows
+from util.db import Challenge, Ctf, User, get_session
+
+from tests.helpers import temp_database
+
+CHANNEL_ID = 1
+
+
+async def populate(size: int):
+    """
+    A CTF in CHANNEL_ID with `size` challenges of up to three members each, next to another CTF just like it.
+    """
+    async with get_session() as session:
+        users = [User(id=1000 + i) for i in range(10)]
+        session.add_all(users)
+        for channel_id in (CHANNEL_ID, CHANNEL_ID + 1):
+            ctf = Ctf(channel_id=channel_id, join_message_id=100 + channel_id)
+            session.add(ctf)
+            await session.flush()
+            session.add_all(
+                Challenge(
+                    name=f"chal-{i}",
+                    category=("crypto", "pwn", "web")[i % 3],
+                    ctf_id=ctf.id,
+                    thread_id=i,
+                    members=users[i % 7 : i % 7 + i % 4],
+                )
+                for i in range(size)
+            )
+        await session.commit()
+
+
+@pytest.mark.parametrize("size", [10, 150])
+def test_one_query_whatever_the_number_of_challenges(tmp_path, size):
+    async def main():
+        async with temp_database(str(tmp_path)):
+            await populate(size)
+            statements: list[str] = []
+
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            assert util.db.engine is not None
+            event.listen(util.db.engine.sync_engine, "before_cursor_execute", count)
+            try:
+                rows = await get_challenge_rows(CHANNEL_ID)
+            finally:
+                event.remove(util.db.engine.sync_engine, "before_cursor_execute", count)
+            return statements, rows
+
+    statements, rows = asyncio.run(main())
+    assert len(statements) == 1, statements
+    assert len(rows) == size
+    assert [r.category for r in rows] == sorted(r.category for r in rows)
+    by_name = {r.name: r for r in rows}
+    for i in range(size):
+        assert sorted(by_name[f"chal-{i}"].member_ids) == [1000 + j for j in range(i % 7, i % 7 + i % 4)]
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import discord
+from discord.ext import commands
+
+import util.commands
+from util.commands import command_tree_hash, restore_command_ids, save_command_ids
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_bot() -> commands.Bot:
+    bot = commands.Bot(intents=discord.Intents.default())
+    state = bot._connection
+    user = {"id": "2", "username": "bot", "discriminator": "0", "avatar": None, "bot": True}
+    state.user = discord.ClientUser(state=state, data=user)  # type: ignore[arg-type]
+    for extension in ("cogs.ctf", "cogs.dev", "cogs.chall"):
+        bot.load_extension(extension)
+    return bot
+
+
+def test_hash_is_stable_across_processes():
+    # the set order in the command payloads depends on the hash seed
+    script = "from tests.test_commands import command_tree_hash, make_bot; print(command_tree_hash(make_bot()))"
+    digests = set()
+    for seed in ("1", "2", "3"):
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=ROOT,
+            env=dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, "src")])),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        digests.add(result.stdout.strip())
+    assert len(digests) == 1
+
+
+def test_restored_ids_resolve_interactions(tmp_path, monkeypatch):
+    monkeypatch.setattr(util.commands, "cache_path", lambda: str(tmp_path / "commands.json"))
+
+    async def main():
+        synced = make_bot()
+        digest = command_tree_hash(synced)
+        # what sync_commands leaves behind, with the ids as Discord sends them
+        for i, cmd in enumerate(synced.pending_application_commands):
+            cmd.id = str(10**17 + i)
+        save_command_ids(synced, digest)
+
+        bot = make_bot()
+        assert restore_command_ids(bot, command_tree_hash(bot))
+        return bot
+
+    bot = asyncio.run(main())
+    for i, cmd in enumerate(bot.pending_application_commands):
+        # the lookup py-cord does with interaction.data["id"]
+        assert bot._application_commands[str(10**17 + i)] is cmd
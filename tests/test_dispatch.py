@@ -0,0 +1,144 @@
+import asyncio
+from types import SimpleNamespace
+
+import util.dispatch
+from util.dispatch import Dispatcher, Priority, edit
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class StubTransport:
+    """
+    Records the calls the dispatcher starts. Each call waits until it is released, so tests control what is in
+    flight.
+    """
+
+    def __init__(self):
+        self.started: list[str] = []
+        self._release: dict[str, asyncio.Event] = {}
+
+    def call(self, name: str, result=None):
+        async def run():
+            self.started.append(name)
+            await self._release.setdefault(name, asyncio.Event()).wait()
+            return result if result is not None else name
+
+        return run
+
+    def release(self, name: str):
+        self._release.setdefault(name, asyncio.Event()).set()
+
+
+def test_interactions_skip_the_inflight_cap():
+    async def main():
+        dispatcher = Dispatcher(rate=1000, burst=1000, max_inflight=1)
+        stub = StubTransport()
+        first = dispatcher.submit(Priority.ACTION, 1, stub.call("action 1"))
+        await asyncio.sleep(0)
+        second = dispatcher.submit(Priority.ANNOUNCE, 2, stub.call("announce"))
+        reply = dispatcher.submit(Priority.INTERACTION, None, stub.call("interaction"))
+        await asyncio.sleep(0.01)
+        # the cap is taken by the first action, only the interaction gets past it
+        assert stub.started == ["action 1", "interaction"]
+
+        stub.release("interaction")
+        assert await reply == "interaction"
+        stub.release("action 1")
+        await first
+        await asyncio.sleep(0.01)
+        assert stub.started[-1] == "announce"
+        stub.release("announce")
+        await second
+        dispatcher.close()
+
+    asyncio.run(main())
+
+
+def test_blocked_route_doesnt_hold_up_others():
+    async def main():
+        clock = FakeClock()
+        # one request per route per second
+        dispatcher = Dispatcher(rate=1, burst=1, max_inflight=4, clock=clock)
+        stub = StubTransport()
+        for name in ("a", "b", "c"):
+            stub.release(name)
+        a = dispatcher.submit(Priority.ACTION, "route 1", stub.call("a"))
+        b = dispatcher.submit(Priority.ACTION, "route 1", stub.call("b"))
+        c = dispatcher.submit(Priority.UPDATE, "route 2", stub.call("c"))
+        assert await a == "a"
+        # lower priority, but its route still has budget
+        assert await c == "c"
+        await asyncio.sleep(0.01)
+        assert not b.done()
+        assert dispatcher.depth()["action"] == 1
+
+        # the budget goes by the dispatcher's clock, not by how long the test took
+        clock.now += 1
+        dispatcher._wakeup.set()
+        assert await asyncio.wait_for(b, 0.1) == "b"
+        dispatcher.close()
+
+    asyncio.run(main())
+
+
+def test_queued_edit_is_replaced(monkeypatch):
+    async def main():
+        dispatcher = Dispatcher(rate=1000, burst=1000, max_inflight=1)
+        monkeypatch.setattr(util.dispatch, "dispatcher", dispatcher)
+        stub = StubTransport()
+        blocker = dispatcher.submit(Priority.ACTION, 1, stub.call("blocker"))
+        await asyncio.sleep(0)
+
+        edits: list[dict] = []
+
+        async def message_edit(**kwargs):
+            edits.append(kwargs)
+            return kwargs["content"]
+
+        message = SimpleNamespace(id=10, channel=SimpleNamespace(id=1), edit=message_edit)
+        first = asyncio.create_task(edit(message, content="first"))  # type: ignore[arg-type]
+        second = asyncio.create_task(edit(message, content="second"))  # type: ignore[arg-type]
+        await asyncio.sleep(0)
+        assert dispatcher.merged == 1
+        assert dispatcher.depth()["update"] == 1
+
+        stub.release("blocker")
+        await blocker
+        # only the newer edit is sent, and both callers get its result
+        assert await first == "second"
+        assert await second == "second"
+        assert edits == [{"content": "second"}]
+        dispatcher.close()
+
+    asyncio.run(main())
+
+
+def test_wait_stats():
+    async def main():
+        clock = FakeClock()
+        dispatcher = Dispatcher(rate=1000, burst=1000, max_inflight=1, clock=clock)
+        stub = StubTransport()
+        first = dispatcher.submit(Priority.ACTION, 1, stub.call("first"))
+        second = dispatcher.submit(Priority.ACTION, 1, stub.call("second"))
+        await asyncio.sleep(0)
+        clock.now += 5
+        stub.release("first")
+        stub.release("second")
+        await first
+        await second
+
+        stats = dispatcher.stats()
+        assert stats["completed"]["action"] == 2
+        # the second one waited for the first to finish
+        assert stats["wait_max"]["action"] == 5
+        assert stats["wait_avg"]["action"] == 2.5
+        assert stats["depth"]["action"] == 0 and stats["inflight"] == 0
+        dispatcher.close()
+
+    asyncio.run(main())
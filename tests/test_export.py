@@ -0,0 +1,12 @@
+from util.export import Exporter
+
+
+def test_one_export_per_channel():
+    exporter = Exporter()
+    assert exporter.try_start(1)
+    assert not exporter.try_start(1)
+    assert exporter.try_start(2)
+    assert exporter.stats()["running"] == 2
+
+    exporter.finish(1)
+    assert exporter.try_start(1)
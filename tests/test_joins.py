@@ -0,0 +1,115 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+
+import util.dispatch
+from util.dispatch import Dispatcher
+import util.joins
+from util.joins import JoinQueue
+from util.roles import CtfRoles
+
+ROLE_ID = 4
+
+
+class FakeMember(discord.Member):
+    def __init__(self, id: int, roles: tuple[int, ...] = ()):
+        self._id = id
+        self.role_ids = set(roles)
+
+    id = property(lambda self: self._id)  # type: ignore[assignment]
+    mention = property(lambda self: f"<@{self._id}>")  # type: ignore[assignment]
+
+    def __eq__(self, other):
+        return isinstance(other, FakeMember) and other.id == self.id
+
+    def __hash__(self):
+        return self.id
+
+    def get_role(self, role_id: int):
+        return role_id if role_id in self.role_ids else None
+
+    async def add_roles(self, role, reason=None):
+        self.role_ids.add(role.id)
+
+    async def remove_roles(self, role, reason=None):
+        self.role_ids.discard(role.id)
+
+
+class FakeChannel:
+    """
+    A CTF channel with a role, and the overwrites of its members.
+    """
+
+    def __init__(self, members: list[FakeMember], overwrites: dict):
+        self.id = 1
+        self.name = "ctf"
+        self.role = discord.Object(ROLE_ID)
+        me = FakeMember(2)
+        by_id = {member.id: member for member in members}
+        self.guild = SimpleNamespace(
+            id=3,
+            me=me,
+            get_role=lambda role_id: self.role if role_id == ROLE_ID else None,
+            get_member=by_id.get,
+        )
+        self.overwrites = {me: discord.PermissionOverwrite(view_channel=True), **overwrites}
+        self.sent: list[str] = []
+
+    def overwrites_for(self, target) -> discord.PermissionOverwrite:
+        overwrite = self.overwrites.get(target, discord.PermissionOverwrite())
+        return discord.PermissionOverwrite(**dict(overwrite))
+
+    async def set_permissions(self, target, overwrite=None):
+        if overwrite is None:
+            self.overwrites.pop(target, None)
+        else:
+            self.overwrites[target] = overwrite
+
+    async def edit(self, overwrites):
+        self.overwrites = overwrites
+
+    async def send(self, content: str):
+        self.sent.append(content)
+
+
+def test_leave_drops_overwrites_from_before_the_role(monkeypatch):
+    monkeypatch.setattr(util.dispatch, "dispatcher", Dispatcher())
+    monkeypatch.setattr(util.joins, "join_index", SimpleNamespace(role=lambda channel_id: ROLE_ID))
+    # a member the migration didn't reach, and one with both
+    unmigrated, both = FakeMember(10), FakeMember(11, (ROLE_ID,))
+    overwrite = discord.PermissionOverwrite(view_channel=True)
+    channel = FakeChannel([unmigrated, both], {unmigrated: overwrite, both: overwrite})
+
+    async def main():
+        await JoinQueue()._apply(channel, [(unmigrated, False), (both, False)])  # type: ignore[arg-type]
+
+    asyncio.run(main())
+    assert channel.sent == ["<@10>, <@11> are leaving the channel"]
+    assert unmigrated not in channel.overwrites and both not in channel.overwrites
+    assert not both.role_ids
+
+
+def test_migration_keeps_overwrites_it_didnt_convert(monkeypatch):
+    monkeypatch.setattr(util.dispatch, "dispatcher", Dispatcher())
+    member = FakeMember(10)
+    # not in the guild anymore, so it can't be given the role
+    gone = discord.Object(12)
+    denied = discord.Object(13)
+    channel = FakeChannel(
+        [member],
+        {
+            member: discord.PermissionOverwrite(view_channel=True),
+            gone: discord.PermissionOverwrite(view_channel=True),
+            denied: discord.PermissionOverwrite(view_channel=False),
+        },
+    )
+
+    async def main():
+        return await CtfRoles().migrate_channel(5, channel, ROLE_ID)  # type: ignore[arg-type]
+
+    assert asyncio.run(main())
+    assert ROLE_ID in member.role_ids
+    assert member not in channel.overwrites and denied not in channel.overwrites
+    assert channel.overwrites[gone].view_channel is True
+    assert channel.overwrites[channel.role].view_channel is True
@@ -0,0 +1,106 @@
+import asyncio
+
+from util.scheduler import Scheduler
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def recorder(fired: list[str], name: str):
+    async def callback():
+        fired.append(name)
+
+    return callback
+
+
+def test_due_jobs_run_in_order():
+    async def main():
+        clock = FakeClock()
+        scheduler = Scheduler(clock)
+        fired: list[str] = []
+        for name, delay in [("c", 30), ("a", 10), ("d", 40), ("b", 20)]:
+            scheduler.schedule(clock.now + delay, recorder(fired, name))
+
+        assert scheduler.run_pending() == 0
+        clock.now += 25
+        assert scheduler.run_pending() == 2
+        await asyncio.sleep(0)
+        assert fired == ["a", "b"]
+        assert scheduler.next_due() == clock.now + 5
+
+        clock.now += 100
+        assert scheduler.run_pending() == 2
+        await asyncio.sleep(0)
+        assert fired == ["a", "b", "c", "d"]
+        assert scheduler.next_due() is None
+        assert scheduler.stats() == {"jobs": 0, "fired": 4, "wakeups": 0}
+
+    asyncio.run(main())
+
+
+def test_cancel_is_lazy():
+    async def main():
+        clock = FakeClock()
+        scheduler = Scheduler(clock)
+        fired: list[str] = []
+        first = scheduler.schedule(clock.now + 10, recorder(fired, "first"))
+        scheduler.schedule(clock.now + 20, recorder(fired, "second"))
+
+        scheduler.cancel(first)
+        # only marked, it stays in the heap until it reaches the top
+        assert len(scheduler._heap) == 2
+        assert len(scheduler) == 1
+        assert scheduler.next_due() == clock.now + 20
+        assert len(scheduler._heap) == 1
+
+        clock.now += 30
+        assert scheduler.run_pending() == 1
+        await asyncio.sleep(0)
+        assert fired == ["second"]
+
+    asyncio.run(main())
+
+
+def test_earlier_job_wakes_the_runner():
+    async def main():
+        clock = FakeClock()
+        scheduler = Scheduler(clock)
+        fired: list[str] = []
+        scheduler.schedule(clock.now + 3600, recorder(fired, "later"))
+        scheduler.start()
+        await asyncio.sleep(0.05)
+        assert scheduler.wakeups == 0
+
+        # due now, so it only runs if the runner stops sleeping towards the hour
+        scheduler.schedule(clock.now, recorder(fired, "now"))
+        await asyncio.sleep(0.05)
+        scheduler.stop()
+        assert fired == ["now"]
+        assert scheduler.wakeups == 1
+
+    asyncio.run(main())
+
+
+def test_no_wakeups_while_idle():
+    async def main():
+        scheduler = Scheduler(FakeClock())
+        scheduler.start()
+        await asyncio.sleep(0.2)
+        assert scheduler.wakeups == 0
+
+        # a cancelled job doesn't count either once it has been dropped
+        job = scheduler.schedule(scheduler.clock() + 3600, recorder([], "cancelled"))
+        scheduler.cancel(job)
+        await asyncio.sleep(0.05)
+        wakeups = scheduler.wakeups
+        await asyncio.sleep(0.2)
+        scheduler.stop()
+        assert scheduler.wakeups == wakeups
+        assert scheduler.next_due() is None
+
+    asyncio.run(main())
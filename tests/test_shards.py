@@ -0,0 +1,109 @@
+import asyncio
+import random
+
+import pytest
+from sqlalchemy import select
+
+import util.timers
+from util.cache import challenge_index, join_index
+from util.db import Challenge, Ctf, Timer, get_session
+from util.scheduler import Scheduler
+from util.shards import parse_shard_ids, shards
+from util.timers import CtfTimers
+
+from tests.helpers import temp_database
+
+COUNT = 4
+# SHARD_IDS of each process
+LAYOUT = [[0, 1], [2], [3]]
+
+
+@pytest.mark.parametrize(
+    "spec, count, ids",
+    [
+        (None, 4, None),
+        ("", 4, None),
+        ("2", 4, [2]),
+        ("0-3,6", 8, [0, 1, 2, 3, 6]),
+        (" 1 , 3-4", 8, [1, 3, 4]),
+        ("0-1,1-2", 4, [0, 1, 2]),
+    ],
+)
+def test_parse_shard_ids(spec, count, ids):
+    assert parse_shard_ids(spec, count) == ids
+
+
+@pytest.mark.parametrize("spec", ["4", "0-4", "0-3,6", "3-1", "-1", "a"])
+def test_parse_shard_ids_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_shard_ids(spec, 4)
+
+
+def guild_for(shard_id: int, timestamp: int, rng: random.Random) -> int:
+    """
+    A guild id whose events Discord sends to `shard_id`: the shard is picked from the timestamp bits, so these are
+    built from a timestamp with the right remainder rather than from the formula under test.
+    """
+    timestamp += shard_id - timestamp % COUNT
+    return (timestamp << 22) | rng.getrandbits(22)
+
+
+async def populate(rng: random.Random) -> dict[int | None, list[int]]:
+    """
+    CTFs with a challenge and a timer in guilds of every shard, including snowflakes with the highest timestamp, and
+    CTFs whose guild isn't known yet. Returns the channels of the CTFs by shard, None for those without a guild.
+    """
+    channels: dict[int | None, list[int]] = {}
+    guilds: list[tuple[int | None, int | None]] = [(None, None)] * 3
+    for shard_id in range(COUNT):
+        guilds += [(shard_id, guild_for(shard_id, rng.randint(2**36, 2**41 - COUNT), rng)) for _ in range(20)]
+        guilds.append((shard_id, guild_for(shard_id, 2**41 - COUNT, rng)))
+
+    async with get_session() as session:
+        for i, (shard_id, guild_id) in enumerate(guilds):
+            channel_id = 10_000 + i
+            ctf = Ctf(channel_id=channel_id, join_message_id=20_000 + i, guild_id=guild_id)
+            session.add(ctf)
+            await session.flush()
+            session.add(Challenge(name=f"chal-{i}", category="misc", ctf_id=ctf.id, thread_id=0, guild_id=guild_id))
+            session.add(
+                Timer(
+                    ctf_id=ctf.id, channel_id=channel_id, start=0, end=1, next_at=1, interval=0, guild_id=guild_id
+                )
+            )
+            channels.setdefault(shard_id, []).append(channel_id)
+        await session.commit()
+    return channels
+
+
+def test_each_process_loads_its_shards(tmp_path, monkeypatch):
+    async def main():
+        monkeypatch.setattr(shards, "count", COUNT)
+        async with temp_database(str(tmp_path)):
+            channels = await populate(random.Random(0))
+            async with get_session() as session:
+                timer_channels = dict((await session.execute(select(Timer.id, Timer.channel_id))).all())
+
+            loaded = []
+            for ids in LAYOUT:
+                monkeypatch.setattr(shards, "ids", ids)
+                monkeypatch.setattr(util.timers, "scheduler", Scheduler())
+                await join_index.load()
+                await challenge_index.load()
+                timers = CtfTimers()
+                await timers.load(None)  # type: ignore[arg-type]
+                loaded.append(
+                    (
+                        set(join_index._channels.values()),
+                        set(challenge_index._sorted),
+                        {timer_channels[timer_id] for timer_id in timers._jobs},
+                    )
+                )
+            return channels, loaded
+
+    channels, loaded = asyncio.run(main())
+    for ids, process in zip(LAYOUT, loaded):
+        # rows whose guild isn't known yet are loaded by every process until it's filled in
+        expected = set(channels[None]).union(*(channels[shard_id] for shard_id in ids))
+        for channel_ids in process:
+            assert channel_ids == expected
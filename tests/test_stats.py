@@ -0,0 +1,72 @@
+import asyncio
+
+from sqlalchemy import select
+
+from util.db import CategoryStats, Challenge, Ctf, User, get_session
+from util.migrations import rebuild_stats, untime_added_solved
+from util.stats import record_added, record_solved
+
+from tests.helpers import temp_database
+
+
+async def category_stats() -> tuple[int, int, int, int]:
+    async with get_session() as session:
+        row = await session.scalar(select(CategoryStats).where(CategoryStats.category == "web"))
+        assert row is not None
+        return row.challenges, row.solves, row.solve_seconds, row.timed_solves
+
+
+def test_added_solved_is_untimed(tmp_path):
+    async def main():
+        async with temp_database(str(tmp_path)):
+            async with get_session() as session:
+                user = User(id=1000)
+                ctf = Ctf(channel_id=1, join_message_id=2, guild_id=3)
+                session.add_all([user, ctf])
+                await session.flush()
+                solved = Challenge(name="solved", category="web", ctf_id=ctf.id, thread_id=0, members=[user])
+                solved.solved = True
+                later = Challenge(name="later", category="web", ctf_id=ctf.id, thread_id=0, members=[user])
+                session.add_all([solved, later])
+                await record_added(session, ctf, [solved, later])
+                await session.commit()
+
+                assert later.added_at is not None
+                later.added_at -= 90
+                later.solved = True
+                await record_solved(session, ctf, later, [user.id])
+                await session.commit()
+
+            live = await category_stats()
+            async with get_session() as session:
+                await session.run_sync(lambda sync_session: rebuild_stats(sync_session.connection()))
+                await session.commit()
+            return live, await category_stats()
+
+    live, rebuilt = asyncio.run(main())
+    # only the challenge solved after it was added has a solve time
+    assert live == (2, 2, 90, 1)
+    assert rebuilt == live
+
+
+def test_migration_only_untimes_challenges_added_solved(tmp_path):
+    async def main():
+        async with temp_database(str(tmp_path)):
+            async with get_session() as session:
+                ctf = Ctf(channel_id=1, join_message_id=2, guild_id=3)
+                session.add(ctf)
+                await session.flush()
+                # added solved by /chall solve, and added with a thread and solved within the same second
+                for name, thread_id in (("solved", 0), ("quick", 5)):
+                    challenge = Challenge(name=name, category="web", ctf_id=ctf.id, thread_id=thread_id)
+                    challenge.solved = True
+                    challenge.added_at = challenge.solved_at = 100
+                    session.add(challenge)
+                await session.commit()
+
+                await session.run_sync(lambda sync_session: untime_added_solved(sync_session.connection()))
+                await session.commit()
+                rows = await session.execute(select(Challenge.name, Challenge.added_at))
+                return dict(rows.all())
+
+    assert asyncio.run(main()) == {"solved": None, "quick": 100}
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import discord
+
+import util.dispatch
+from util.db import Timer, get_session
+from util.dispatch import Dispatcher
+from util.scheduler import Scheduler
+import util.timers
+from util.timers import CtfTimers
+
+from tests.helpers import FakeChannel, http_error, temp_database
+
+
+class FakeBot:
+    def __init__(self, cached: dict[int, FakeChannel], fetched: dict[int, FakeChannel], error=None):
+        self.cached = cached
+        self.fetched = fetched
+        self.error = error
+
+    def get_channel(self, channel_id: int):
+        return self.cached.get(channel_id)
+
+    async def fetch_channel(self, channel_id: int):
+        if self.error is not None:
+            raise self.error
+        return self.fetched[channel_id]
+
+
+def run_missed_timer(tmp_path, monkeypatch, bot: FakeBot) -> tuple[CtfTimers, Timer | None]:
+    """
+    Load a timer of a running CTF whose reminder fell due while the bot was down, and fire it.
+    """
+    monkeypatch.setattr(util.timers, "scheduler", Scheduler())
+    monkeypatch.setattr(util.dispatch, "dispatcher", Dispatcher())
+
+    async def main():
+        async with temp_database(str(tmp_path)):
+            now = int(time.time())
+            timer = Timer(
+                channel_id=1, start=now - 7200, end=now + 7200, next_at=now - 600, interval=1800, announce_start=False
+            )
+            async with get_session() as session:
+                session.add(timer)
+                await session.commit()
+
+            timers = CtfTimers()
+            await timers.load(bot)  # type: ignore[arg-type]
+            # catch-up notices wait until the bot is ready and starts the scheduler
+            assert util.timers.scheduler._runner is None
+            await timers.fire(timer.id)
+            async with get_session() as session:
+                return timers, await session.get(Timer, timer.id)
+
+    return asyncio.run(main())
+
+
+def test_uncached_channel_is_fetched(tmp_path, monkeypatch):
+    channel = FakeChannel(1)
+    timers, timer = run_missed_timer(tmp_path, monkeypatch, FakeBot({}, {1: channel}))
+    assert timer is not None and timer.next_at > time.time()
+    assert channel.sent and channel.sent[0].startswith("CTF ends")
+    assert timer.id in timers._jobs
+
+
+def test_failed_lookup_keeps_the_timer(tmp_path, monkeypatch):
+    error = http_error(discord.HTTPException, 401, "Unauthorized")
+    timers, timer = run_missed_timer(tmp_path, monkeypatch, FakeBot({}, {}, error))
+    assert timer is not None and timer.next_at < time.time()
+    # retried later instead of dropped
+    assert timer.id in timers._jobs
+
+
+def test_deleted_channel_ends_the_timer(tmp_path, monkeypatch):
+    error = http_error(discord.NotFound, 404, "Unknown Channel")
+    timers, timer = run_missed_timer(tmp_path, monkeypatch, FakeBot({}, {}, error))
+    assert timer is None
+    assert not timers._jobs